@@ -0,0 +1,166 @@
+"""Answer a file of questions with the Wikibase agent, concurrently.
+
+Questions are read from a JSONL file with one ``{"id": ..., "question": ...}``
+object per line (the id defaults to the line number) and the answers are
+appended to the output JSONL file as they complete. Each worker thread
+reuses its own agent, and all the workers share a token bucket sized to
+the LLM quota, in requests and optionally prompt tokens per minute.
+
+The output file is the checkpoint: questions already answered in it are
+skipped when the command is run again, so a crashed run resumes where it
+stopped. Questions that failed are retried.
+
+    python batch.py questions.jsonl answers.jsonl --workers 8 --rpm 300
+"""
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+from dotenv import load_dotenv
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import get_buffer_string
+
+from ratelimit import TokenBucket
+from render import count_tokens
+
+logger = logging.getLogger("batch")
+
+
+class RateLimitCallback(BaseCallbackHandler):
+    """Waits for the shared buckets before every LLM call of the agent."""
+
+    run_inline = True
+    raise_error = True
+
+    def __init__(self, requests: TokenBucket, tokens: Optional[TokenBucket] = None) -> None:
+        self.requests = requests
+        self.tokens = tokens
+
+    def _acquire(self, prompts: List[str]) -> None:
+        self.requests.acquire()
+        if self.tokens is not None:
+            self.tokens.acquire(sum(count_tokens(prompt) for prompt in prompts))
+
+    def on_llm_start(self, serialized, prompts, **kwargs) -> None:
+        self._acquire(prompts)
+
+    def on_chat_model_start(self, serialized, messages, **kwargs) -> None:
+        self._acquire([get_buffer_string(m) for m in messages])
+
+
+def read_questions(path: str) -> Iterator[Dict[str, Any]]:
+    with open(path) as f:
+        for number, line in enumerate(f, start=1):
+            if line.strip():
+                item = json.loads(line)
+                item.setdefault("id", number)
+                yield item
+
+
+def answered_ids(path: str) -> Set[str]:
+    """Ids with an answer in the output file, the last line of an id wins."""
+    done: Dict[str, bool] = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    # The line being written when the previous run stopped
+                    continue
+                done[str(item["id"])] = "error" not in item
+    except FileNotFoundError:
+        pass
+    return {item_id for item_id, ok in done.items() if ok}
+
+
+class Batch:
+    """Answers questions on ``workers`` threads, each with its own agent."""
+
+    def __init__(self, workers: int, callback: RateLimitCallback) -> None:
+        self.workers = workers
+        self.callback = callback
+        self._local = threading.local()
+
+    def _agent(self):
+        import wikibase_agent
+
+        if not hasattr(self._local, "agent"):
+            self._local.agent = wikibase_agent.build_agent_executor()
+        return self._local.agent
+
+    def answer(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        import wikibase_agent
+
+        started = time.perf_counter()
+        result = {"id": item["id"], "question": item["question"]}
+        try:
+            output = wikibase_agent.answer_the_question(
+                item["question"], agent_executor=self._agent(), config={"callbacks": [self.callback]}
+            )
+            result["answer"] = output["output"]
+        except Exception as e:
+            logger.warning(f"Question {item['id']} failed: {e}")
+            result["error"] = repr(e)
+        result["seconds"] = round(time.perf_counter() - started, 3)
+        return result
+
+    def run(self, questions: List[Dict[str, Any]], output: str) -> Dict[str, int]:
+        counts = {"answered": 0, "failed": 0}
+        started = time.perf_counter()
+        with open(output, "a") as out, ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="batch"
+        ) as pool:
+            futures = [pool.submit(self.answer, item) for item in questions]
+            for done, future in enumerate(as_completed(futures), start=1):
+                result = future.result()
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                out.flush()
+                os.fsync(out.fileno())
+                counts["failed" if "error" in result else "answered"] += 1
+                if done % 10 == 0 or done == len(futures):
+                    elapsed = time.perf_counter() - started
+                    logger.info(
+                        f"{done}/{len(futures)} questions in {elapsed:.0f}s "
+                        f"({done / elapsed:.2f}/s), rate limit wait {self.callback.requests.stats()['waited']}s"
+                    )
+        return counts
+
+
+def main() -> None:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("questions", help="JSONL file of questions")
+    parser.add_argument("output", help="JSONL file the answers are appended to")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("BATCH_WORKERS", 4)))
+    parser.add_argument(
+        "--rpm", type=float, default=float(os.getenv("BATCH_LLM_RPM", 60)), help="LLM requests per minute"
+    )
+    parser.add_argument(
+        "--tpm",
+        type=float,
+        default=float(os.getenv("BATCH_LLM_TPM", 0)),
+        help="LLM prompt tokens per minute, 0 for no limit",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    done = answered_ids(args.output)
+    questions = [item for item in read_questions(args.questions) if str(item["id"]) not in done]
+    logger.info(f"{len(questions)} questions to answer, {len(done)} already answered")
+
+    # Bursts are limited to one request per worker
+    requests = TokenBucket(args.rpm / 60, capacity=max(args.workers, 1))
+    tokens = TokenBucket(args.tpm / 60, capacity=args.tpm / 60 * 10) if args.tpm > 0 else None
+    counts = Batch(args.workers, RateLimitCallback(requests, tokens)).run(questions, args.output)
+    logger.info(f"{counts['answered']} answered, {counts['failed']} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+"""Offline replay benchmark of the ReAct agents.
+
+Run it from the repository root with ``python -m bench.run``. See
+``bench/run.py`` for the options.
+"""
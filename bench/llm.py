@@ -0,0 +1,44 @@
+"""Deterministic chat model replaying recorded completions."""
+
+from typing import Any, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+# Returned once the recorded completions of a question are used up
+EXHAUSTED = "Thought: I have no more recorded steps.\nFinal Answer: (replay exhausted)"
+
+
+class ReplayChatModel(BaseChatModel):
+    """Chat model answering each call with the next recorded completion.
+
+    ``responses`` are the completions the real model gave, in order, for
+    one question. Call ``reset`` with the completions of the next question.
+    """
+
+    responses: List[str] = []
+    index: int = 0
+
+    def reset(self, responses: List[str]) -> None:
+        self.responses = list(responses)
+        self.index = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "replay"
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if self.index < len(self.responses):
+            text = self.responses[self.index]
+        else:
+            text = EXHAUSTED
+        self.index += 1
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
@@ -0,0 +1,324 @@
+"""Replay the question corpus through the agents and compare with a baseline.
+
+The agents run end to end against ``FixtureServer``, which stands in for
+the MediaWiki API, the Wikibase REST API and the SPARQL endpoint, and a
+``ReplayChatModel`` answering with recorded completions. Nothing leaves
+the machine, so two runs only differ by the code under test.
+
+For every question the run reports the wall time, the time spent in each
+tool, the HTTP calls and bytes served, the agent iterations (LLM calls)
+and the prompt tokens sent to the model.
+
+    python -m bench.run                    # compare with bench/baseline.json
+    python -m bench.run --update-baseline  # store the numbers as the baseline
+    python -m bench.run --check            # exit 1 on a regression
+    python -m bench.run --record           # re-record the fixtures online
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+from typing import Any, Dict, List
+
+from dotenv import dotenv_values
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH = os.path.join(ROOT, "bench")
+
+TARGETS = ("gemini_agent", "wikibase_agent")
+# Metrics compared with the baseline, lower is better
+METRICS = ("wall_time", "http_calls", "iterations", "prompt_tokens")
+# Wall times of replayed questions are a few tens of milliseconds, smaller
+# differences are timer noise
+MIN_WALL_TIME_REGRESSION = 0.05
+
+logger = logging.getLogger("bench")
+
+
+def configure(server_url: str) -> None:
+    """Point the agents at the stand-in server, before they are imported."""
+    for name, value in dotenv_values(os.path.join(ROOT, "template.env")).items():
+        os.environ.setdefault(name, value or "")
+    os.environ.update(
+        {
+            "MEDIAWIKI_API_URL": server_url + "/w/api.php",
+            "MEDIAWIKI_SPARQL_ENDPOINT": server_url + "/sparql",
+            "MEDIAWIKI_REST_API_URL": server_url + "/w/rest.php/wikibase/v0/",
+            # Every question starts cold and reads only the fixtures
+            "LLM_CACHE": "false",
+            "PROPERTY_CATALOG": "false",
+            "ENTITY_CACHE_PATH": "",
+            "ENTITY_INDEX_PATH": "",
+            # The stand-in server never throttles
+            "HTTP_RATE_LIMIT": "0",
+            # Background requests would make the HTTP call counts vary between runs
+            "PREFETCH": "false",
+        }
+    )
+    # The agents read their prompts relative to the working directory
+    os.chdir(ROOT)
+
+
+def upstreams() -> Dict[str, str]:
+    """Real endpoints the fixtures are recorded from."""
+    from bench.server import ROUTES
+
+    values = {**dotenv_values(os.path.join(ROOT, "template.env")), **dotenv_values(os.path.join(ROOT, ".env"))}
+    for name in ROUTES.values():
+        if os.getenv(name):
+            values[name] = os.environ[name]
+    return {prefix: values.get(name) for prefix, name in ROUTES.items()}
+
+
+def patch_modules(server_url: str) -> None:
+    """Redirect the endpoints that are constants rather than settings."""
+    from wikibaseintegrator.wbi_config import config as wbi_config
+
+    import wikibase_agent
+
+    wikibase_agent.WB_SPARQL_URL = server_url + "/sparql"
+    wbi_config["MEDIAWIKI_API_URL"] = server_url + "/w/api.php"
+    wbi_config["SPARQL_ENDPOINT_URL"] = server_url + "/sparql"
+    try:
+        from langchain_community.utilities import wikidata
+    except ImportError:
+        return
+    if hasattr(wikidata, "WIKIDATA_API_URL"):
+        wikidata.WIKIDATA_API_URL = server_url + "/w/api.php"
+    if hasattr(wikidata, "WIKIDATA_REST_API_URL"):
+        wikidata.WIKIDATA_REST_API_URL = server_url + "/w/rest.php/wikibase/v0/"
+
+
+def bench_callback():
+    from langchain_core.callbacks import BaseCallbackHandler
+    from langchain_core.messages import get_buffer_string
+
+    from render import count_tokens
+
+    class BenchCallback(BaseCallbackHandler):
+        """Times the tools and counts the LLM calls and prompt tokens of a run."""
+
+        def __init__(self) -> None:
+            self.tools: Dict[str, float] = defaultdict(float)
+            self.iterations = 0
+            self.prompt_tokens = 0
+            self.completions: List[str] = []
+            self._started: Dict[Any, tuple] = {}
+
+        def on_llm_start(self, serialized, prompts, **kwargs) -> None:
+            self.iterations += 1
+            self.prompt_tokens += sum(count_tokens(prompt) for prompt in prompts)
+
+        def on_chat_model_start(self, serialized, messages, **kwargs) -> None:
+            self.iterations += 1
+            self.prompt_tokens += sum(count_tokens(get_buffer_string(m)) for m in messages)
+
+        def on_llm_end(self, response, **kwargs) -> None:
+            self.completions.append(response.generations[0][0].text)
+
+        def on_tool_start(self, serialized, input_str, run_id=None, **kwargs) -> None:
+            self._started[run_id] = ((serialized or {}).get("name", "tool"), time.perf_counter())
+
+        def on_tool_end(self, output, run_id=None, **kwargs) -> None:
+            self._stop(run_id)
+
+        def on_tool_error(self, error, run_id=None, **kwargs) -> None:
+            self._stop(run_id)
+
+        def _stop(self, run_id) -> None:
+            name, started = self._started.pop(run_id, ("tool", time.perf_counter()))
+            self.tools[name] += time.perf_counter() - started
+
+    return BenchCallback()
+
+
+def reset_caches(module) -> None:
+    """Empty the module level caches, so that every question starts cold."""
+    import langchain_mod.utilities
+
+    langchain_mod.utilities._descriptions.clear()
+    for name in ("entity_cache", "document_cache"):
+        cache = getattr(module, name, None)
+        if cache is not None:
+            cache.clear()
+    sparql_cache = getattr(module, "sparql_cache", None)
+    if sparql_cache is not None:
+        sparql_cache.results.clear()
+
+
+def run_target(target: str, questions: List[Dict], server, completions: Dict, record: bool) -> Dict:
+    from bench.llm import ReplayChatModel
+
+    if target == "gemini_agent":
+        import gemini_agent as module
+    else:
+        import wikibase_agent as module
+
+    replay = ReplayChatModel()
+    if record:
+        llm = module.llm if target == "gemini_agent" else module.load_llm()
+    else:
+        llm = replay
+    executor = module.build_agent_executor(llm)
+
+    results = {}
+    for question in questions:
+        replay.reset(completions.get(target, {}).get(question["id"], []))
+        reset_caches(module)
+        server.reset()
+        callback = bench_callback()
+        config = {"callbacks": [callback]}
+
+        started = time.perf_counter()
+        try:
+            if target == "gemini_agent":
+                output = executor.invoke({"input": question["question"]}, config=config)
+            else:
+                output = module.answer_the_question(
+                    question["question"], agent_executor=executor, config=config
+                )
+            answer = str(output.get("output", ""))
+        except Exception as e:
+            logger.exception(f"{target} failed on {question['id']}")
+            answer = f"error: {e}"
+        wall_time = time.perf_counter() - started
+
+        if record:
+            completions.setdefault(target, {})[question["id"]] = callback.completions
+        results[question["id"]] = {
+            "wall_time": round(wall_time, 4),
+            "tools": {name: round(secs, 4) for name, secs in sorted(callback.tools.items())},
+            "http_calls": server.calls,
+            "http_bytes": server.bytes,
+            "iterations": callback.iterations,
+            "prompt_tokens": callback.prompt_tokens,
+            "missing_fixtures": list(server.missing),
+            "answer": answer,
+            "expected_found": question.get("expected", "") in answer,
+        }
+    return results
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Return the metrics that got worse than the baseline by more than ``tolerance``."""
+    regressions = []
+    for target, questions in results.items():
+        for question_id, current in questions.items():
+            before = baseline.get(target, {}).get(question_id)
+            if not before:
+                continue
+            for metric in METRICS:
+                old, new = before.get(metric), current.get(metric)
+                if old is None or new is None:
+                    continue
+                if new > old * (1 + tolerance) and new - old > (MIN_WALL_TIME_REGRESSION if metric == "wall_time" else 0):
+                    regressions.append(f"{target} {question_id} {metric}: {old} -> {new}")
+    return regressions
+
+
+def report(results: Dict, baseline: Dict) -> None:
+    for target, questions in results.items():
+        print(f"\n{target}")
+        print(f"  {'question':24} {'wall s':>8} {'http':>5} {'KiB':>7} {'iter':>5} {'tokens':>7}  tools")
+        for question_id, m in questions.items():
+            before = baseline.get(target, {}).get(question_id, {})
+            delta = ""
+            if before.get("wall_time"):
+                delta = f" ({(m['wall_time'] / before['wall_time'] - 1) * 100:+.0f}%)"
+            tools = ", ".join(f"{name} {secs:.3f}s" for name, secs in m["tools"].items())
+            print(
+                f"  {question_id:24} {m['wall_time']:8.3f} {m['http_calls']:5} "
+                f"{m['http_bytes'] / 1024:7.1f} {m['iterations']:5} {m['prompt_tokens']:7}  {tools}{delta}"
+            )
+            if m["missing_fixtures"]:
+                print(f"    {len(m['missing_fixtures'])} requests without a fixture")
+            if not m["expected_found"]:
+                print(f"    expected answer not found in: {m['answer'][:120]!r}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", default=os.path.join(BENCH, "questions.jsonl"))
+    parser.add_argument("--fixtures", default=os.path.join(BENCH, "fixtures"))
+    parser.add_argument("--baseline", default=os.path.join(BENCH, "baseline.json"))
+    parser.add_argument("--targets", default=",".join(TARGETS))
+    parser.add_argument("--only", help="Comma separated question ids to run")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true", help="Exit 1 when a metric regressed")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+    parser.add_argument("--record", action="store_true", help="Use the real LLM and endpoints and save what they answer")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    sys.path.insert(0, ROOT)
+    from bench.server import FixtureServer
+
+    with open(args.questions) as f:
+        questions = [json.loads(line) for line in f if line.strip()]
+    if args.only:
+        only = set(args.only.split(","))
+        questions = [q for q in questions if q["id"] in only]
+
+    llm_path = os.path.join(args.fixtures, "llm.json")
+    try:
+        with open(llm_path) as f:
+            completions = json.load(f)
+    except FileNotFoundError:
+        completions = {}
+
+    server = FixtureServer(
+        os.path.join(args.fixtures, "http.json"), upstreams() if args.record else None
+    ).start()
+    configure(server.url)
+    patch_modules(server.url)
+
+    try:
+        results = {
+            target: run_target(target, questions, server, completions, args.record)
+            for target in args.targets.split(",")
+        }
+    finally:
+        server.stop()
+
+    if args.record:
+        server.save()
+        with open(llm_path, "w") as f:
+            json.dump(completions, f, indent=1, ensure_ascii=False)
+            f.write("\n")
+        print(f"Recorded {server.recorded} HTTP fixtures and the completions of {len(questions)} questions")
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+
+    report(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=1, ensure_ascii=False)
+            f.write("\n")
+        print(f"\nBaseline written to {args.baseline}")
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("\nRegressions:")
+        for line in regressions:
+            print(f"  {line}")
+    elif baseline:
+        print("\nNo regression against the baseline")
+    return 1 if args.check and regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
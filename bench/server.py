@@ -0,0 +1,175 @@
+"""Local stand-in for the MediaWiki API, Wikibase REST API and SPARQL endpoint.
+
+Requests are answered from recorded fixtures. In record mode, requests
+without a fixture are forwarded to the real upstream and their responses
+are added to the fixtures.
+"""
+
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+from sparql import normalize_query
+
+logger = logging.getLogger(__name__)
+
+# Paths served by the stand-in, mapped to the environment variable of the upstream
+ROUTES = {
+    "/w/api.php": "MEDIAWIKI_API_URL",
+    "/w/rest.php/wikibase/v0/": "MEDIAWIKI_REST_API_URL",
+    "/sparql": "MEDIAWIKI_SPARQL_ENDPOINT",
+}
+
+# Parameters added by the client libraries that do not change the answer
+IGNORED_PARAMS = {"format", "maxlag", "assert", "origin", "utf8", "formatversion", "errorformat"}
+
+
+def _matches(fixture: Dict, path: str, params: Dict[str, str]) -> bool:
+    if fixture["path"] != path:
+        return False
+    for name, value in fixture.get("params", {}).items():
+        got = params.get(name)
+        if got is None:
+            return False
+        if name == "query":
+            # The agents add prefixes and a LIMIT around the generated query
+            if normalize_query(value) not in normalize_query(got):
+                return False
+        elif str(value) != got:
+            return False
+    return True
+
+
+class FixtureServer:
+    """HTTP server replaying ``fixtures``, counting the calls it answers."""
+
+    def __init__(self, fixtures_path: str, upstreams: Optional[Dict[str, str]] = None) -> None:
+        self.fixtures_path = fixtures_path
+        self.upstreams = upstreams or {}
+        try:
+            with open(fixtures_path) as f:
+                self.fixtures: List[Dict] = json.load(f)
+        except FileNotFoundError:
+            self.fixtures = []
+        self.recorded = 0
+        self._lock = threading.Lock()
+        self.reset()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self._server.server_port}"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls = 0
+            self.bytes = 0
+            self.missing: List[str] = []
+
+    def start(self) -> "FixtureServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def save(self) -> None:
+        with open(self.fixtures_path, "w") as f:
+            json.dump(self.fixtures, f, indent=1, ensure_ascii=False)
+            f.write("\n")
+
+    def find(self, path: str, params: Dict[str, str]) -> Optional[Dict]:
+        matching = [f for f in self.fixtures if _matches(f, path, params)]
+        if not matching:
+            return None
+        # The most specific fixture wins
+        return max(matching, key=lambda f: len(f.get("params", {})))
+
+    def _route(self, path: str) -> Optional[str]:
+        for prefix in ROUTES:
+            if path == prefix or (prefix.endswith("/") and path.startswith(prefix)):
+                return prefix
+        return None
+
+    def record(
+        self, method: str, path: str, query: str, params: Dict[str, str], body: bytes, headers
+    ) -> Optional[Dict]:
+        prefix = self._route(path)
+        upstream = self.upstreams.get(prefix) if prefix else None
+        if not upstream:
+            return None
+        import requests
+
+        url = upstream.rstrip("/") + "/" + path[len(prefix):] if prefix.endswith("/") else upstream
+        response = requests.request(
+            method,
+            url,
+            params=query or None,
+            data=body if method == "POST" else None,
+            headers={k: v for k, v in headers.items() if k.lower() in ("user-agent", "accept", "content-type")},
+            timeout=120,
+        )
+        fixture = {
+            "path": path,
+            "params": {k: v for k, v in params.items() if k not in IGNORED_PARAMS},
+            "status": response.status_code,
+        }
+        try:
+            fixture["json"] = response.json()
+        except ValueError:
+            fixture["text"] = response.text
+        with self._lock:
+            self.fixtures.append(fixture)
+            self.recorded += 1
+        return fixture
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _answer(self, method: str) -> None:
+                url = urlsplit(self.path)
+                body = b""
+                if method == "POST":
+                    body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                params.update({k: v[0] for k, v in parse_qs(body.decode()).items()})
+
+                fixture = server.find(url.path, params)
+                if fixture is None:
+                    fixture = server.record(
+                        method, url.path, url.query, params, body, self.headers
+                    )
+                if fixture is None:
+                    with server._lock:
+                        server.missing.append(f"{method} {url.path} {params}")
+                    logger.warning(f"No fixture for {method} {url.path} {params}")
+                    fixture = {"status": 404, "text": "No fixture for this request"}
+
+                if "json" in fixture:
+                    data = json.dumps(fixture["json"]).encode()
+                    content_type = "application/json"
+                else:
+                    data = fixture.get("text", "").encode()
+                    content_type = "text/plain"
+                with server._lock:
+                    server.calls += 1
+                    server.bytes += len(data)
+                self.send_response(fixture.get("status", 200))
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self) -> None:
+                self._answer("GET")
+
+            def do_POST(self) -> None:
+                self._answer("POST")
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        return Handler
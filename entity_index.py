@@ -0,0 +1,310 @@
+"""Offline entity search index built from a Wikibase JSON dump.
+
+The index is a SQLite FTS5 table of labels, aliases and descriptions in one
+language. It answers entity searches locally, replacing wbsearchentities,
+and is kept up to date from the RecentChanges feed of the MediaWiki API.
+
+Usage:
+    python entity_index.py build latest-all.json.gz --index .cache/entities.fts
+    python entity_index.py update --index .cache/entities.fts
+"""
+
+import argparse
+import bz2
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS entities (
+  id TEXT PRIMARY KEY,
+  type TEXT NOT NULL,
+  label TEXT,
+  description TEXT,
+  popularity INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS entities_label ON entities (label COLLATE NOCASE, type);
+CREATE VIRTUAL TABLE IF NOT EXISTS entities_fts USING fts5(
+  label, aliases, description,
+  tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+
+def open_dump(path: str):
+    """Open a plain, gzip or bz2 compressed dump as text."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def iter_dump(path: str) -> Iterator[Dict]:
+    """Yield the entities of a dump one at a time.
+
+    Wikibase JSON dumps are a JSON array with one entity per line, so the
+    file is read line by line and memory use does not grow with its size.
+    """
+    with open_dump(path) as dump:
+        for line in dump:
+            line = line.strip().rstrip(",")
+            if line in ("", "[", "]"):
+                continue
+            yield json.loads(line)
+
+
+def _phrase(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+
+class EntityIndex:
+    """Full-text index of the entities of a Wikibase in one language."""
+
+    def __init__(self, path: str, lang: str = "en") -> None:
+        self.path = path
+        self.lang = lang
+        self._local = threading.local()
+        self._updater: Optional[threading.Thread] = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn.executescript(SCHEMA)
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        # SQLite connections cannot be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+            )
+
+    def _row(self, entity: Dict):
+        lang = self.lang
+        label = entity.get("labels", {}).get(lang, {}).get("value")
+        description = entity.get("descriptions", {}).get(lang, {}).get("value")
+        aliases = [alias["value"] for alias in entity.get("aliases", {}).get(lang, [])]
+        # Rough popularity, used to rank entities sharing a label
+        popularity = 10 * len(entity.get("sitelinks", {})) + len(entity.get("claims", {}))
+        return entity["id"], entity.get("type", "item"), label, aliases, description, popularity
+
+    def upsert(self, entities: Iterable[Dict]) -> int:
+        """Insert or update entities; the FTS row shares the entity rowid."""
+        count = 0
+        with self._conn as conn:
+            for entity in entities:
+                entity_id, entity_type, label, aliases, description, popularity = self._row(entity)
+                (rowid,) = conn.execute(
+                    "INSERT INTO entities (id, type, label, description, popularity)"
+                    " VALUES (?, ?, ?, ?, ?)"
+                    " ON CONFLICT (id) DO UPDATE SET type = excluded.type,"
+                    " label = excluded.label, description = excluded.description,"
+                    " popularity = excluded.popularity"
+                    " RETURNING rowid",
+                    (entity_id, entity_type, label, description, popularity),
+                ).fetchone()
+                conn.execute("DELETE FROM entities_fts WHERE rowid = ?", (rowid,))
+                if label or aliases:
+                    conn.execute(
+                        "INSERT INTO entities_fts (rowid, label, aliases, description)"
+                        " VALUES (?, ?, ?, ?)",
+                        (rowid, label, "\n".join(aliases), description),
+                    )
+                count += 1
+        return count
+
+    def delete(self, ids: Iterable[str]) -> None:
+        with self._conn as conn:
+            for entity_id in ids:
+                row = conn.execute(
+                    "DELETE FROM entities WHERE id = ? RETURNING rowid", (entity_id,)
+                ).fetchone()
+                if row:
+                    conn.execute("DELETE FROM entities_fts WHERE rowid = ?", row)
+
+    def build(self, dump_path: str, batch_size: int = 10000) -> int:
+        """Index every entity of a dump, committing every ``batch_size``.
+
+        RecentChanges updates start from the newest ``modified`` time of the
+        dump entities, so edits made after the dump was taken are picked up.
+        """
+        total = 0
+        batch = []
+        newest = None
+        for entity in iter_dump(dump_path):
+            newest = max(newest or "", entity.get("modified") or "") or None
+            batch.append(entity)
+            if len(batch) >= batch_size:
+                total += self.upsert(batch)
+                batch = []
+                logger.info(f"Indexed {total} entities")
+        total += self.upsert(batch)
+        with self._conn:
+            self._conn.execute("INSERT INTO entities_fts(entities_fts) VALUES ('optimize')")
+        since = self.get_meta("rc_timestamp")
+        if newest is None:
+            # Without it, the next update reads all the RecentChanges the wiki keeps
+            logger.warning("The dump entities have no modified time, RecentChanges will be read from the start")
+        elif since is None or newest < since:
+            # The entities edited after the dump were overwritten with their older version
+            self.set_meta("rc_timestamp", newest)
+        return total
+
+    def search(self, text: str, entity_type: str = "item", limit: int = 1) -> List[Dict]:
+        """Search entities by label or alias, like wbsearchentities.
+
+        Exact label matches are looked up first through the label index,
+        then the full-text index fills the remaining slots, more popular
+        entities first.
+        """
+        text = str(text).strip()
+        if not text:
+            return []
+        try:
+            rows = self._conn.execute(
+                "SELECT id, label, description FROM entities"
+                " WHERE label = ? COLLATE NOCASE AND type = ?"
+                " ORDER BY popularity DESC LIMIT ?",
+                (text, entity_type, limit),
+            ).fetchall()
+            if len(rows) < limit:
+                found = [row[0] for row in rows]
+                rows += self._conn.execute(
+                    "SELECT e.id, e.label, e.description FROM entities_fts f"
+                    " JOIN entities e ON e.rowid = f.rowid"
+                    " WHERE entities_fts MATCH ? AND e.type = ?"
+                    f" AND e.id NOT IN ({','.join('?' * len(found))})"
+                    " ORDER BY e.popularity DESC, f.rank LIMIT ?",
+                    ("{label aliases}: " + _phrase(text), entity_type, *found, limit - len(rows)),
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"Entity index search failed for {text!r}: {e}")
+            return []
+        return [
+            {"id": entity_id, "label": label, "description": description}
+            for entity_id, label, description in rows
+        ]
+
+    def update_from_recent_changes(self, api_url: str, namespaces: str = "0|120") -> int:
+        """Re-index the entities changed since the last update."""
+        import transport
+        from langchain_mod.utilities import fetch_entities
+
+        since = self.get_meta("rc_timestamp")
+        params = {
+            "action": "query",
+            "list": "recentchanges",
+            "rcprop": "title|timestamp",
+            "rctype": "edit|new|log",
+            "rcnamespace": namespaces,
+            "rcdir": "newer",
+            "rclimit": "max",
+            "format": "json",
+        }
+        if since:
+            params["rcstart"] = since
+        session = transport.get_session()
+        changed, latest = set(), since
+        while True:
+            data = session.get(api_url, params=params).json()
+            for change in data["query"]["recentchanges"]:
+                changed.add(change["title"].rsplit(":", 1)[-1])
+                latest = max(latest or "", change["timestamp"])
+            if "continue" not in data:
+                break
+            params.update(data["continue"])
+
+        if changed:
+            entities = fetch_entities(
+                changed,
+                props="labels|descriptions|aliases|sitelinks|claims",
+                lang=self.lang,
+                api_url=api_url,
+            )
+            self.upsert(entities.values())
+            # Deleted entities are reported as missing by wbgetentities
+            self.delete(changed - set(entities))
+        if latest:
+            self.set_meta("rc_timestamp", latest)
+        return len(changed)
+
+    def _update_forever(self, api_url: str, namespaces: str, interval: float) -> None:
+        while True:
+            try:
+                count = self.update_from_recent_changes(api_url, namespaces)
+                logger.info(f"Updated {count} entities from RecentChanges")
+            except Exception as e:
+                logger.warning(f"Could not update the entity index: {e}")
+            time.sleep(interval)
+
+    def start_updates(
+        self, api_url: str, namespaces: str = "0|120", interval: float = 60
+    ) -> None:
+        """Follow RecentChanges in a background thread."""
+        if self._updater is None:
+            self._updater = threading.Thread(
+                target=self._update_forever,
+                args=(api_url, namespaces, interval),
+                name="entity-index",
+                daemon=True,
+            )
+            self._updater.start()
+
+
+def from_env() -> Optional[EntityIndex]:
+    """Open the index configured by ENTITY_INDEX_PATH, if it was built."""
+    path = os.getenv("ENTITY_INDEX_PATH")
+    if not path or not os.path.exists(path):
+        return None
+    return EntityIndex(path, lang=os.getenv("WIKIBASE_LANGUAGE", "en"))
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["build", "update"])
+    parser.add_argument("dump", nargs="?", help="Wikibase JSON dump (.json, .gz or .bz2)")
+    parser.add_argument("--index", default=os.getenv("ENTITY_INDEX_PATH", ".cache/entities.fts"))
+    parser.add_argument("--lang", default=os.getenv("WIKIBASE_LANGUAGE", "en"))
+    parser.add_argument("--api-url", default=os.getenv("MEDIAWIKI_API_URL"))
+    parser.add_argument(
+        "--namespaces",
+        default=os.getenv("ENTITY_INDEX_NAMESPACES", "0|120"),
+        help="Item and Property namespaces followed in RecentChanges",
+    )
+    args = parser.parse_args()
+
+    index = EntityIndex(args.index, lang=args.lang)
+    if args.command == "build":
+        if not args.dump:
+            parser.error("build needs the path of a dump")
+        started = time.time()
+        count = index.build(args.dump)
+        print(f"Indexed {count} entities in {time.time() - started:.0f}s")
+    else:
+        count = index.update_from_recent_changes(args.api_url, args.namespaces)
+        print(f"Updated {count} entities")
@@ -1,32 +1,40 @@
+import time
+
+# Startup time of each component, see startup_report()
+startup_times = {}
+_import_started = time.perf_counter()
+
 import os
 from dotenv import load_dotenv
-import requests
 import re
-import argparse
-import time
-from datetime import datetime
-
-from langchain.agents import AgentExecutor, create_react_agent
-from langchain.agents import tool
-from langchain.prompts import PromptTemplate
-from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_community.chat_message_histories import ChatMessageHistory
+import asyncio
+import threading
+import requests
 
+# The agent, the LLM and their libraries are only imported when first used,
+# so that the UI can start serving before they are ready
+from langchain_core.tools import tool
 from langchain.globals import set_debug
-from langchain_google_genai import ChatGoogleGenerativeAI
-from google.generativeai.types.safety_types import HarmBlockThreshold, HarmCategory
-from langchain_core.prompts.chat import ChatPromptTemplate, MessagesPlaceholder
-
-# Use tho langchain API Wrapper to access Wikidata APIs. Comment this line for local Wikibase instance
-from langchain_community.tools.wikidata.tool import WikidataAPIWrapper, WikidataQueryRun
-
-# Use the modified API Wrapper libraries below to acces a local wikibase instance API
-#from langchain_mod.tools import WikidataQueryRun
-#from langchain_mod.utilities import WikidataAPIWrapper
+from langchain_core.messages import AIMessage, HumanMessage
 
 from wikibaseintegrator import wbi_helpers
 from wikibaseintegrator.wbi_config import config as wbi_config
 
+from cache import LRUCache, TieredCache, MISSING, make_key
+from sparql import SparqlCache, SparqlSyntaxError, normalize_query, parse_results, prepare_query
+from property_catalog import PropertyCatalog
+import entity_index
+from render import Renderer, wikibase_prefixes
+from sessions import SessionStore
+from history import SummarizingChatMessageHistory
+from llm_cache import StreamingCacheMixin, get_llm_cache
+import transport
+import metrics
+from router import Router
+from coalesce import SingleFlight
+from prefetch import Prefetcher
+from statements import asking, current_question
+
 load_dotenv()
 
 wb_url = os.getenv('WIKIBASE_URL')
@@ -43,6 +51,48 @@ WB_USER_AGENT = os.getenv('WIKIBASE_USER_AGENT')
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 
 wbi_config['USER_AGENT'] = WB_USER_AGENT
+transport.install_wbi_session()
+
+# Cache of wbsearchentities results keyed on (search text, type, language)
+entity_cache = TieredCache(
+    max_entries=int(os.getenv('ENTITY_CACHE_MAX_SIZE', 10000)),
+    ttl=float(os.getenv('ENTITY_CACHE_TTL', 86400)),
+    path=os.getenv('ENTITY_CACHE_PATH', '.cache/entities.sqlite'),
+    disk_max_entries=int(os.getenv('ENTITY_CACHE_DISK_MAX_SIZE', 100000)),
+    )
+# Names without a match are cached briefly, a new item or label fix shows up soon
+ENTITY_NEGATIVE_TTL = float(os.getenv('ENTITY_NEGATIVE_TTL', 300))
+
+# Cache of SPARQL results keyed on the endpoint and the normalized final query
+sparql_cache = SparqlCache.from_env()
+
+# Identical concurrent upstream requests of different sessions are sent once
+inflight = SingleFlight()
+
+# Documents returned by WikibaseRetrieval, keyed on its input and the question they are selected for
+document_cache = LRUCache(
+    max_entries=int(os.getenv('WIKIBASE_DOCUMENT_CACHE_MAX_SIZE', 1000)),
+    ttl=float(os.getenv('WIKIBASE_DOCUMENT_CACHE_TTL', 600)),
+    )
+
+# Compact rendering of the observations returned to the agent
+renderer = Renderer(wikibase_prefixes(wb_url))
+
+# Budget of rows and bytes read from a SPARQL response before it is cut
+SPARQL_MAX_ROWS = int(os.getenv('SPARQL_MAX_ROWS', 50))
+SPARQL_MAX_BYTES = int(os.getenv('SPARQL_MAX_BYTES', 262144))
+
+# WikibaseLabels resolves at most this many QIDs per call
+WB_LABELS_MAX_IDS = int(os.getenv('WIKIBASE_LABELS_MAX_IDS', 50))
+INSTANCE_OF_PROPERTY = os.getenv('INSTANCE_OF_PROPERTY', 'P31')
+
+# All the properties of the Wikibase, loaded in the background by warmup()
+PROPERTY_CATALOG = os.getenv('PROPERTY_CATALOG', 'true').lower() == 'true'
+property_catalog = PropertyCatalog.from_env()
+
+# Offline entity search index, see entity_index.py to build it from a dump
+wb_entity_index = entity_index.from_env()
+ENTITY_INDEX_UPDATE_INTERVAL = float(os.getenv('ENTITY_INDEX_UPDATE_INTERVAL', 0))
 
 def extract_error_message(response):
   pattern = re.compile(r'MalformedQueryException:(.*)\n')
@@ -52,67 +102,204 @@ def extract_error_message(response):
   else:
     return None
 
+# Prefixes of this Wikibase added to the queries that use them without declaring them
+SPARQL_PREFIXES = wikibase_prefixes(wb_url)
+
+# Returned when the endpoint still throttles the query after the retries of the transport,
+# so that the agent does not rewrite a query that is valid
+SPARQL_BUSY_MESSAGE = 'The SPARQL endpoint is busy and did not run the query, the query does not need to be changed, run it again.'
+SPARQL_TIMEOUT_MESSAGE = 'The query timed out, write a simpler or more selective one.'
+
+# Default and maximum number of results of a query run by runSparql
+SPARQL_QUERY_LIMIT = int(os.getenv('SPARQL_QUERY_LIMIT', 200))
+
+def buildSparqlQuery(query: str) -> str:
+  """Returns the query that is sent to the endpoint, with the missing prefixes and a limit.
+
+  Raises SparqlSyntaxError, before any request, when the endpoint would reject the query.
+  """
+  return prepare_query(query, prefixes=SPARQL_PREFIXES, limit=SPARQL_QUERY_LIMIT)
+
 def performSparqlQuery(query: str) -> str:
+  """Sends a query built by buildSparqlQuery to the endpoint."""
 #  url = "https://query.wikidata.org/sparql"
   url = wb_sparql_url
   user_agent_header = WB_USER_AGENT
 
-  query = str(query).lstrip('sparql').strip('\n').strip("'").strip('"').strip('`')
-  prefix = f"""
-    PREFIX p: <{wb_url}/prop/>
-    PREFIX pq: <{wb_url}/prop/qualifier/>
-    PREFIX ps: <{wb_url}/prop/statement/>
-    PREFIX wd: <{wb_url}/entity/>
-    PREFIX wdt: <{wb_url}/prop/direct/>
-  """
-  query = prefix+query+'LIMIT'+str(os.getenv('SPARQL_QUERY_LIMIT'))
-
   headers = {"Accept": "application/json"}
   if user_agent_header is not None:
       headers["User-Agent"] = user_agent_header
 
-  return requests.get(
-      url, headers=headers, params={"query": query, "format": "json"}
+  return transport.get_session().get(
+      url, headers=headers, params={"query": query, "format": "json"}, stream=True
   )
 
+_lazy = {}
+_lazy_lock = threading.RLock()
+
+def _once(name, build):
+  """Returns the named object, built by build() on first use only."""
+  if name not in _lazy:
+    with _lazy_lock:
+      if name not in _lazy:
+        started = time.perf_counter()
+        _lazy[name] = build()
+        startup_times[name] = time.perf_counter() - started
+  return _lazy[name]
+
+def _build_wikidata_tool():
+  # Use tho langchain API Wrapper to access Wikidata APIs. Comment this line for local Wikibase instance
+  from langchain_community.tools.wikidata.tool import WikidataAPIWrapper, WikidataQueryRun
+
+  # Use the modified API Wrapper libraries below to acces a local wikibase instance API
+  #from langchain_mod.tools import WikidataQueryRun
+  #from langchain_mod.utilities import WikidataAPIWrapper
+
+  from langchain_mod.utilities import use_shared_transport
+
+  api_wrapper = use_shared_transport(WikidataAPIWrapper())
+  # Only the local WikidataAPIWrapper in langchain_mod knows the catalog
+  if PROPERTY_CATALOG and 'property_catalog' in api_wrapper.__fields__:
+    api_wrapper.property_catalog = property_catalog
+  if wb_entity_index is not None and 'entity_index' in api_wrapper.__fields__:
+    api_wrapper.entity_index = wb_entity_index
+  return WikidataQueryRun(api_wrapper=api_wrapper)
+
+def getWikidataTool():
+  """Returns the shared Wikidata tool, building its API clients only once."""
+  return _once('wikidata_tool', _build_wikidata_tool)
+
+def warmup():
+  """Builds the long lived clients and the agent ahead of the first question."""
+  started = time.perf_counter()
+  if PROPERTY_CATALOG:
+    property_catalog.start()
+  if wb_entity_index is not None and ENTITY_INDEX_UPDATE_INTERVAL > 0:
+    wb_entity_index.start_updates(
+        wb_api_url,
+        namespaces=os.getenv('ENTITY_INDEX_NAMESPACES', '0|120'),
+        interval=ENTITY_INDEX_UPDATE_INTERVAL,
+        )
+  getWikidataTool()
+  get_agent_with_chat_history()
+  startup_times['warmup'] = time.perf_counter() - started
+
+def startup_report():
+  """Returns the time spent building each component, slowest first."""
+  times = sorted(startup_times.items(), key=lambda item: -item[1])
+  return ', '.join(f'{name} {seconds:.2f}s' for name, seconds in times)
+
 @tool
 def WikibaseRetrieval(item: str) -> str:
   """Returns all the information about the input name, label, Q item or property from my Wikibase."""
-  wikidata = WikidataQueryRun(api_wrapper=WikidataAPIWrapper())
-  info = wikidata.run(item)
-  return str(info)
+  return retrieveItem(item)
+
+def retrieveItem(item):
+  """Returns the rendered document of the item, from the document cache when it was read recently."""
+  item = str(item).strip().strip("'").strip('"')
+  key = make_key(item, current_question())
+  document = document_cache.get(key)
+  if document is MISSING:
+    # A prefetch of the same item may be running already
+    document = inflight.do(('retrieve', key), lambda: renderer.document(str(getWikidataTool().run(item))))
+    document_cache.set(key, document)
+  return document
 
 @tool
 def runSparql(query: str) -> str:
   """Given a SPARQL query returns the results."""
 
-  response = performSparqlQuery(str(query))
+  try:
+    final_query = buildSparqlQuery(str(query))
+  except SparqlSyntaxError as e:
+    return f'Query failed with this syntax error: {e}, try to fix it with another one.'
+  results = sparql_cache.get(wb_sparql_url, final_query)
+  if results is MISSING:
+    # The response is streamed, so the fetched results are shared rather than the response
+    results = inflight.do(
+        ('sparql', wb_sparql_url, normalize_query(final_query)), fetchSparqlResults, final_query
+        )
+  if isinstance(results, str):
+    return results
+  return renderer.sparql_results(results)
+
+def fetchSparqlResults(final_query):
+  """Runs the query and returns its parsed results, or the error message for the agent."""
+
+  response = performSparqlQuery(final_query)
 
+  if response.status_code in transport.THROTTLED:
+      response.close()
+      return SPARQL_BUSY_MESSAGE
   if response.status_code != 200:
       error_message = extract_error_message(response)
+      response.close()
       if error_message:
           return f'Query failed with this syntax error: {error_message}, try to fix it with another one.'
       else:
         return 'Query failed, try another one.'
 
-  return response.json()
+  try:
+    results = parse_results(
+        response.iter_content(chunk_size=65536),
+        max_rows=SPARQL_MAX_ROWS,
+        max_bytes=SPARQL_MAX_BYTES,
+        )
+  finally:
+    response.close()
+  if 'truncated' in results:
+    results['truncated'] = (
+        f"Only the first {results['truncated']['rows']} results are shown, "
+        "refine the query or aggregate the results if you need the rest."
+        )
+  sparql_cache.set(wb_sparql_url, final_query, results)
+  return results
 
-@tool
-def getQItem(name: str) -> str:
-  """Returns the Q item from my Wikibase."""
+def searchEntities(name: str, entity_type: str) -> list:
+  """Runs wbsearchentities for the name, answering from the entity index or cache when possible."""
 
-  name = str(name).strip("'").strip('"')
+  if wb_entity_index is not None:
+    results = wb_entity_index.search(name, entity_type, WB_LIMIT)
+    if results:
+      return results
+
+  key = make_key(name, entity_type, WB_LANGUAGE)
+  results = entity_cache.get(key)
+  if results is not MISSING:
+    return results
 
   data = {
     'action': 'wbsearchentities',
     'search': name,
-    'type': 'item',
+    'type': entity_type,
     'language': WB_LANGUAGE,
     'limit': WB_LIMIT
   }
-  result = wbi_helpers.mediawiki_api_call_helper(data=data, mediawiki_api_url=wb_api_url, allow_anonymous=True)
-  if result['search']:
-      return result['search'][0]['id']
+  result = inflight.do(
+      ('search', key),
+      wbi_helpers.mediawiki_api_call_helper,
+      data=data,
+      mediawiki_api_url=wb_api_url,
+      allow_anonymous=True,
+      )
+  results = result['search']
+  if results:
+    entity_cache.set(key, results)
+  elif ENTITY_NEGATIVE_TTL > 0:
+    entity_cache.set(key, results, ttl=ENTITY_NEGATIVE_TTL)
+  return results
+
+@tool
+def getQItem(name: str) -> str:
+  """Returns the Q item from my Wikibase."""
+
+  name = str(name).strip("'").strip('"')
+
+  results = searchEntities(name, 'item')
+  if results:
+      if PREFETCH:
+        prefetcher.submit((results[0]['id'], current_question()))
+      return results[0]['id']
   else:
     return 'Item not found by this name, try another name.'
 
@@ -122,66 +309,169 @@ def getProperty(name: str) -> str:
 
   name = str(name).strip("'").strip('"')
 
-  data = {
-    'action': 'wbsearchentities',
-    'search': name,
-    'type': 'property',
-    'language': WB_LANGUAGE,
-    'limit': WB_LIMIT
-  }
-  result = wbi_helpers.mediawiki_api_call_helper(data=data, mediawiki_api_url=wb_api_url, allow_anonymous=True)
-  if result['search']:
-    return result['search'][0]['id']
+  if PROPERTY_CATALOG and property_catalog.ready:
+    pid = property_catalog.lookup(name)
+    if pid:
+      return pid
+
+  results = searchEntities(name, 'property')
+  if results:
+    return results[0]['id']
   else:
     return 'Property not found by this name, try another name.'
 
+@tool
+def WikibaseLabels(qids: str) -> str:
+  """Given a list of QIDs like Q548, Q507, Q502 returns the label, description and instance of of all of them at once from my Wikibase."""
+  from langchain_mod.utilities import describe_entities
+
+  ids = list(dict.fromkeys(re.findall(r'\b[QP]\d+\b', str(qids))))[:WB_LABELS_MAX_IDS]
+  if not ids:
+    return 'No QIDs found in the input, pass a list like Q548, Q507, Q502.'
+
+  return describe_entities(ids, lang=WB_LANGUAGE, instance_of=instanceOfProperty(), api_url=wb_api_url)
+
+def instanceOfProperty():
+  if PROPERTY_CATALOG and property_catalog.ready:
+    return property_catalog.lookup('instance of') or INSTANCE_OF_PROPERTY
+  return INSTANCE_OF_PROPERTY
+
+def prefetchItem(key):
+  """Reads what the agent usually asks for after getQItem: the item and the items its claims point to."""
+  from langchain_mod.utilities import claim_targets, describe_entities
+
+  qid, question = key
+  # The document is selected for the question of the session that resolved the item
+  with asking(question):
+    retrieveItem(qid)
+  targets = claim_targets(qid, api_url=wb_api_url)[:PREFETCH_MAX_TARGETS]
+  if targets:
+    # Fills the cache read by WikibaseLabels
+    describe_entities(targets, lang=WB_LANGUAGE, instance_of=instanceOfProperty(), api_url=wb_api_url)
+
+# Items resolved by getQItem are prefetched in the background while the LLM writes its next step
+PREFETCH = os.getenv('PREFETCH', 'true').lower() == 'true'
+PREFETCH_MAX_TARGETS = int(os.getenv('PREFETCH_MAX_TARGETS', 50))
+prefetcher = Prefetcher(
+    prefetchItem,
+    workers=int(os.getenv('PREFETCH_WORKERS', 2)),
+    budget=int(os.getenv('PREFETCH_BUDGET', 5)),
+    max_sessions=int(os.getenv('UI_MAX_SESSIONS', 100)),
+    )
+
 @tool
 def runSparqlQuery(query: str) -> str:
   """Given a SPARQL query returns the results."""
   try:
-    results = wbi_helpers.execute_sparql_query(query, max_retries=1)
+    query = prepare_query(str(query), prefixes=SPARQL_PREFIXES)
+  except SparqlSyntaxError as e:
+    return f'Query is not working: {e}, try another one.'
+  results = sparql_cache.get(wb_sparql_url, query, kind='raw')
+  if results is not MISSING:
     return results
-  except Exception as e:
-    return 'Query is not working, try another one.'
-
-llm = ChatGoogleGenerativeAI(
-            model=os.getenv('GEMINI_MODEL'), 
-            temperature=float(os.getenv('TEMPERATURE')),
-            top_p=float(os.getenv('TOP_P')),
-            top_k=int(os.getenv('TOP_K')),
-            max_output_token=int(os.getenv('MAX_OUTPUT_TOKEN')),
-            safety_settings = {
-                  HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_LOW_AND_ABOVE,
-                  HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-                  HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_LOW_AND_ABOVE,
-                  HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_LOW_AND_ABOVE
-              }
-            )
-
-tools = [getQItem, getProperty, runSparql, WikibaseRetrieval]
-
-file_prompt = open('prompts/gemini.prompt', 'r')
-
-system_prompt = file_prompt.read()
-
-user_prompt = '''
+  try:
+    results = inflight.do(
+        ('sparql_query', wb_sparql_url, normalize_query(query)), fetchSparqlQuery, query
+        )
+  except requests.Timeout:
+    return SPARQL_TIMEOUT_MESSAGE
+  except (requests.RequestException, ValueError) as e:
+    return f'Query is not working: {e}, try another one.'
+  if not isinstance(results, str):
+    sparql_cache.set(wb_sparql_url, query, results, kind='raw')
+  return results
+
+def fetchSparqlQuery(query):
+  """Runs the query and returns its JSON results, or the error message for the agent."""
+
+  response = performSparqlQuery(query)
+  try:
+    if response.status_code in transport.THROTTLED:
+      # The transport already retried it until HTTP_MAX_RETRIES or a too long Retry-After
+      return SPARQL_BUSY_MESSAGE
+    if response.status_code != 200:
+      error_message = extract_error_message(response)
+      if error_message:
+        return f'Query is not working: {error_message}, try another one.'
+      if 'TimeoutException' in response.text:
+        return SPARQL_TIMEOUT_MESSAGE
+      return f'Query is not working (HTTP {response.status_code}), try another one.'
+    return response.json()
+  finally:
+    response.close()
+
+def _build_llm():
+  from langchain_google_genai import ChatGoogleGenerativeAI
+  from google.generativeai.types.safety_types import HarmBlockThreshold, HarmCategory
+
+  class CachedChatGoogleGenerativeAI(StreamingCacheMixin, ChatGoogleGenerativeAI):
+    """Gemini chat model whose streamed calls also go through the LLM cache."""
+
+  llm = CachedChatGoogleGenerativeAI(
+              model=os.getenv('GEMINI_MODEL'), 
+              temperature=float(os.getenv('TEMPERATURE')),
+              cache=get_llm_cache(float(os.getenv('TEMPERATURE'))),
+              top_p=float(os.getenv('TOP_P')),
+              top_k=int(os.getenv('TOP_K')),
+              max_output_token=int(os.getenv('MAX_OUTPUT_TOKEN')),
+              safety_settings = {
+                    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_LOW_AND_ABOVE,
+                    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+                    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_LOW_AND_ABOVE,
+                    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_LOW_AND_ABOVE
+                }
+              )
+  metrics.register_cache('llm', llm.cache)
+  return llm
+
+def get_llm():
+  return _once('llm', _build_llm)
+
+tools = [getQItem, getProperty, runSparql, WikibaseRetrieval, WikibaseLabels]
+
+def _build_prompt():
+  from langchain_core.prompts.chat import ChatPromptTemplate, MessagesPlaceholder
+
+  with open('prompts/gemini.prompt', 'r') as file_prompt:
+    system_prompt = file_prompt.read()
+
+  user_prompt = '''
 Question: {input}
 Thought:{agent_scratchpad}
 '''
-prompt = ChatPromptTemplate.from_messages(
-    [
-        ("system", system_prompt),
-        MessagesPlaceholder("chat_history", optional=True),
-        ("human", user_prompt),
-    ]
-)
+  return ChatPromptTemplate.from_messages(
+      [
+          ("system", system_prompt),
+          MessagesPlaceholder("chat_history", optional=True),
+          ("human", user_prompt),
+      ]
+  )
+
+def get_prompt():
+  return _once('prompt', _build_prompt)
+
+def build_agent_executor(llm):
+  """Returns the agent executor of this module running on llm.
+
+  With AGENT_MODE=tools and a model supporting function calling, the agent
+  can call several tools in one turn, see tool_agent.py. Otherwise it is
+  the ReAct agent.
+  """
+  import tool_agent
 
-agent = create_react_agent(llm, tools, prompt)
+  if tool_agent.agent_mode() == 'tools' and tool_agent.supports_tool_calling(llm):
+    return tool_agent.build_tool_calling_executor(
+        llm,
+        tools,
+        _once('tools_prompt', lambda: tool_agent.load_tools_prompt('prompts/gemini_tools.prompt')),
+        verbose=True,
+        return_intermediate_steps=True,
+        )
 
-memory = ChatMessageHistory(session_id="test-session")
+  from langchain.agents import AgentExecutor, create_react_agent
 
-agent_executor = AgentExecutor(
-        agent=agent,
+  return AgentExecutor(
+        agent=create_react_agent(llm, tools, get_prompt()),
         tools=tools,
         verbose=True,
         handle_parsing_errors="Check your output and make sure it conforms, use the Action/Action Input syntax",
@@ -190,22 +480,174 @@ agent_executor = AgentExecutor(
         max_iteration=10,
         )
 
-agent_with_chat_history = RunnableWithMessageHistory(
-    agent_executor,
-    # This is needed because in most real world scenarios, a session id is needed
-    # It isn't really used here because we are using a simple in memory ChatMessageHistory
-    lambda session_id: memory,
-    input_messages_key="input",
-    history_messages_key="chat_history",
-)
-
-def agent_chat(question,agent_with_chat_history):
-  
-  result = agent_with_chat_history.invoke(
-      {"input": f"{question}"},
-      config={"configurable": {"session_id": "test-session"}},
+def get_agent_executor():
+  return _once('agent_executor', lambda: build_agent_executor(get_llm()))
+
+def historySize(history):
+  return sum(len(str(message.content)) for message in history.all_messages)
+
+# The model sees the last turns verbatim and a summary of the older ones
+HISTORY_MAX_TOKENS = int(os.getenv('HISTORY_MAX_TOKENS', 2000))
+HISTORY_KEEP_TURNS = int(os.getenv('HISTORY_KEEP_TURNS', 3))
+
+# One chat history per UI session
+memory = SessionStore(
+    lambda session_id: SummarizingChatMessageHistory(
+        llm=get_llm(), max_tokens=HISTORY_MAX_TOKENS, keep_turns=HISTORY_KEEP_TURNS
+        ),
+    max_sessions=int(os.getenv('UI_MAX_SESSIONS', 100)),
+    idle_timeout=float(os.getenv('UI_SESSION_IDLE_TIMEOUT', 1800)),
+    max_bytes=int(os.getenv('UI_SESSIONS_MAX_BYTES', 50000000)),
+    sizeof=historySize,
+    )
+
+metrics.register_cache('entity', entity_cache)
+metrics.register_cache('sparql', sparql_cache)
+metrics.register_cache('inflight', inflight)
+metrics.register_cache('document', document_cache)
+metrics.register_cache('prefetch', prefetcher)
+
+def _build_agent_with_chat_history():
+  from langchain_core.runnables.history import RunnableWithMessageHistory
+
+  return RunnableWithMessageHistory(
+      get_agent_executor(),
+      # Each UI session gets its own chat history from the session store
+      memory.get,
+      input_messages_key="input",
+      history_messages_key="chat_history",
   )
 
+def get_agent_with_chat_history():
+  return _once('agent_with_chat_history', _build_agent_with_chat_history)
+
+# Built on first access of gemini_agent.<name>, see PEP 562
+_lazy_attributes = {
+    'llm': get_llm,
+    'prompt': get_prompt,
+    'agent': lambda: _once('agent', lambda: get_agent_executor().agent.runnable),
+    'agent_executor': get_agent_executor,
+    'agent_with_chat_history': get_agent_with_chat_history,
+    }
+
+def __getattr__(name):
+  if name in _lazy_attributes:
+    return _lazy_attributes[name]()
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Descriptive questions like 'What is Google?' skip the ReAct loop, see router.py
+ROUTER = os.getenv('ROUTER', 'true').lower() == 'true'
+router = Router(
+    search=lambda name: searchEntities(name, 'item'),
+    retrieve=lambda qid, config: WikibaseRetrieval.invoke(qid, config=config),
+    )
+
+def routeQuestion(question, config):
+  """Returns the fast path of a descriptive question, None when the agent must answer it."""
+  if not ROUTER:
+    return None
+  try:
+    return router.route(question, config)
+  except Exception as e:
+    metrics.log_event('route', error=repr(e))
+    return None
+
+def routeTurn(route, answer):
+  return [HumanMessage(content=route.question), AIMessage(content=answer)]
+
+def agent_chat(question,agent_with_chat_history,session_id="test-session"):
+
+  # The question selects the statements shown in the item documents, see statements.py
+  config = {"configurable": {"session_id": session_id, "question": question}, "callbacks": [metrics.callback]}
+  prefetcher.reset(session_id)
+  route = routeQuestion(question, config)
+
+  # Turns of the same session run one at a time so the history stays ordered
+  with memory.session(session_id) as history:
+    if route is not None:
+      # One LLM call writes the answer from the retrieved document
+      answer = get_llm().invoke(route.messages(history.messages), config=config).content
+      history.add_messages(routeTurn(route, answer))
+      result = {"input": question, "output": answer, "intermediate_steps": []}
+    else:
+      result = agent_with_chat_history.invoke({"input": f"{question}"}, config=config)
+
   set_debug(False)
 
   return result
+
+def formatStep(name, text, limit=500):
+  text = str(text).strip()
+  if len(text) > limit:
+    text = text[:limit] + '...'
+  return f"**{name}:** {text}\n\n"
+
+async def agent_chat_stream(question,agent_with_chat_history,session_id="test-session"):
+  """Yields the answer while it is produced.
+
+  Every Thought/Action/Observation is shown as soon as it happens, then the
+  tokens of the final answer are streamed below the collapsed agent steps.
+  The final answer of the ReAct agent follows "Final Answer:", the one of
+  the tool-calling agent (AGENT_MODE=tools) is the model message without
+  tool calls.
+  """
+  import tool_agent
+
+  steps = ''
+  llm_text = ''
+  llm_tool_calls = False
+  answer = None
+  executor = get_agent_executor()
+  tool_calling = isinstance(executor, tool_agent.ParallelAgentExecutor)
+  executor_run = None
+  # The question selects the statements shown in the item documents, see statements.py
+  config = {"configurable": {"session_id": session_id, "question": question}, "callbacks": [metrics.callback]}
+  prefetcher.reset(session_id)
+  route = await asyncio.get_running_loop().run_in_executor(None, routeQuestion, question, config)
+  async with memory.asession(session_id) as history:
+    if route is not None:
+      steps = formatStep(f"Observation from WikibaseRetrieval for {route.qid}", route.document)
+      answer = ''
+      async for chunk in get_llm().astream(route.messages(history.messages), config=config):
+        answer += chunk.content
+        yield f"<details><summary>Agent steps</summary>\n\n{steps}</details>\n\n{answer}"
+      history.add_messages(routeTurn(route, answer))
+      return
+    async for event in agent_with_chat_history.astream_events(
+        {"input": f"{question}"},
+        config=config,
+        version="v1",
+        ):
+      kind = event["event"]
+      if kind == "on_chain_start" and executor_run is None and event["name"] == executor.get_name():
+        executor_run = event["run_id"]
+      elif kind == "on_chat_model_start":
+        llm_text = ''
+        llm_tool_calls = False
+      elif kind == "on_chat_model_stream":
+        chunk = event["data"]["chunk"]
+        llm_text += chunk.content
+        llm_tool_calls = llm_tool_calls or bool(getattr(chunk, "tool_call_chunks", None))
+        if "Final Answer:" in llm_text:
+          answer = llm_text.split("Final Answer:", 1)[1].lstrip()
+          yield f"<details><summary>Agent steps</summary>\n\n{steps}</details>\n\n{answer}"
+        elif tool_calling and not llm_tool_calls and llm_text.strip():
+          answer = llm_text.lstrip()
+          yield f"<details><summary>Agent steps</summary>\n\n{steps}</details>\n\n{answer}"
+        else:
+          yield steps + formatStep("Thought", llm_text, limit=2000)
+      elif kind == "on_chat_model_end":
+        final = "Final Answer:" in llm_text or (tool_calling and not llm_tool_calls)
+        if not final and llm_text.strip():
+          # Text written along tool calls is a step, not the answer
+          steps += formatStep("Thought", llm_text, limit=2000)
+          answer = None
+      elif kind == "on_tool_end":
+        steps += formatStep(f"Observation from {event['name']}", event["data"].get("output"))
+        yield steps
+      elif kind == "on_chain_end" and event["run_id"] == executor_run:
+        output = event["data"].get("output") or {}
+        if answer is None and isinstance(output, dict) and "output" in output:
+          yield f"<details><summary>Agent steps</summary>\n\n{steps}</details>\n\n{output['output']}"
+
+startup_times['import'] = time.perf_counter() - _import_started
@@ -1,8 +1,10 @@
-import google.generativeai as genai
 import os
+import threading
 from dotenv import load_dotenv
 
-genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
+from sessions import SessionStore
+from llm_cache import get_llm_cache
+from cache import MISSING, make_key
 
 # Set up the model
 generation_config = {
@@ -31,13 +33,68 @@ safety_settings = [
   },
 ]
 
-model = genai.GenerativeModel(model_name=os.getenv('GEMINI_MODEL'),
-                              generation_config=generation_config,
-                              safety_settings=safety_settings)
+_model = None
+_model_lock = threading.Lock()
 
-chat_session = model.start_chat(history=[])
+def get_model():
+    """Returns the Gemini model, importing and configuring its client on first use."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                import google.generativeai as genai
+
+                genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
+                _model = genai.GenerativeModel(model_name=os.getenv('GEMINI_MODEL'),
+                                               generation_config=generation_config,
+                                               safety_settings=safety_settings)
+    return _model
+
+def __getattr__(name):
+    # gemini_simple.model and gemini_simple.chat_session are built on first access
+    if name == 'model':
+        return get_model()
+    if name == 'chat_session':
+        globals()['chat_session'] = get_model().start_chat(history=[])
+        return globals()['chat_session']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def history_size(chat_session):
+    return sum(len(part.text) for content in chat_session.history for part in content.parts)
+
+# One chat session per UI session
+chat_sessions = SessionStore(
+    lambda session_id: get_model().start_chat(history=[]),
+    max_sessions=int(os.getenv('UI_MAX_SESSIONS', 100)),
+    idle_timeout=float(os.getenv('UI_SESSION_IDLE_TIMEOUT', 1800)),
+    max_bytes=int(os.getenv('UI_SESSIONS_MAX_BYTES', 50000000)),
+    sizeof=history_size,
+)
+
+def session_chat(question, session_id):
+    with chat_sessions.session(session_id) as chat_session:
+        return simple_chat(question, chat_session)
+
+llm_cache = get_llm_cache(generation_config["temperature"])
 
 def simple_chat(question,chat_session):
-    chat_session.send_message(question)
-    answer = chat_session.last.text
+    if llm_cache is None:
+        chat_session.send_message(question)
+        return chat_session.last.text
+
+    history = [
+        [content.role, [part.text for part in content.parts]]
+        for content in chat_session.history
+    ]
+    key = make_key(os.getenv('GEMINI_MODEL'), generation_config, history, question)
+    answer = llm_cache.store.get(key)
+    if answer is MISSING:
+        chat_session.send_message(question)
+        answer = chat_session.last.text
+        llm_cache.store.set(key, answer)
+    else:
+        chat_session.history = chat_session.history + [
+            {"role": "user", "parts": [question]},
+            {"role": "model", "parts": [answer]},
+        ]
     return answer
@@ -0,0 +1,168 @@
+"""Token-bounded chat history with rolling summarization."""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Sequence
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, get_buffer_string
+
+from render import count_tokens
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = """Progressively summarize the lines of conversation provided, adding onto the previous summary and returning a new summary.
+Keep every entity, Q item, property and value that was mentioned, drop the wording.
+
+Current summary:
+{summary}
+
+New lines of conversation:
+{new_lines}
+
+New summary:"""
+
+SHORTEN_PROMPT = """Shorten this summary of a conversation to at most {words} words.
+Keep the entities, Q items, properties and values the conversation is about, drop the rest.
+
+Summary:
+{summary}
+
+Shorter summary:"""
+
+# Summaries are written in the background, after the turn was answered
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history")
+
+
+class SummarizingChatMessageHistory(BaseChatMessageHistory):
+    """Chat history that hands the model a bounded view of the conversation.
+
+    The last ``keep_turns`` turns are kept verbatim and the older ones are
+    folded into a running summary written by ``llm``. Only the turns that
+    were not summarized yet are sent to the summarizer. When the view is
+    still over ``max_tokens``, more of the recent turns are summarized.
+    The summary itself is kept under half of ``max_tokens``: a longer one
+    is shortened by ``llm`` and cut to its end if it is still too long.
+    Without an ``llm`` the older turns are simply dropped.
+
+    The summary opens the view as a human and AI turn: prompts already
+    start with their own system message, and models like Gemini only
+    accept one, in first position.
+    """
+
+    def __init__(
+        self, llm: Any = None, max_tokens: int = 2000, keep_turns: int = 3
+    ) -> None:
+        self.llm = llm
+        self.max_tokens = max_tokens
+        self.keep_turns = keep_turns
+        self.all_messages: List[BaseMessage] = []
+        self.summary = ""
+        # Messages before this index are folded into the summary
+        self.summarized = 0
+        self.saved_tokens: List[int] = []
+        # Bumped by clear() so that a summary of cleared messages is thrown away
+        self._generation = 0
+        self._lock = threading.Lock()
+        # One summarization at a time, readers only wait for the swap
+        self._compact_lock = threading.Lock()
+
+    def _view(self) -> List[BaseMessage]:
+        view = list(self.all_messages[self.summarized :])
+        if self.summary:
+            view[:0] = [
+                HumanMessage(content=f"Summary of the earlier conversation:\n{self.summary}"),
+                AIMessage(content="I will take the earlier conversation into account."),
+            ]
+        return view
+
+    @property
+    def messages(self) -> List[BaseMessage]:  # type: ignore[override]
+        with self._lock:
+            return self._view()
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        with self._lock:
+            self.all_messages.extend(messages)
+        _executor.submit(self._compact)
+
+    def add_message(self, message: BaseMessage) -> None:
+        self.add_messages([message])
+
+    def clear(self) -> None:
+        with self._lock:
+            self.all_messages = []
+            self.summary = ""
+            self.summarized = 0
+            self._generation += 1
+
+    def _turn_starts(self) -> List[int]:
+        return [
+            i
+            for i, message in enumerate(self.all_messages)
+            if isinstance(message, HumanMessage) and i >= self.summarized
+        ]
+
+    def _summarize(self, summary: str, messages: List[BaseMessage]) -> str:
+        if self.llm is None:
+            return ""
+        prompt = SUMMARY_PROMPT.format(
+            summary=summary or "(empty)", new_lines=get_buffer_string(messages)
+        )
+        response = self.llm.invoke(prompt)
+        return self._shorten(str(getattr(response, "content", response)).strip())
+
+    def _shorten(self, summary: str) -> str:
+        budget = self.max_tokens // 2
+        if count_tokens(summary) <= budget:
+            return summary
+        prompt = SHORTEN_PROMPT.format(words=budget * 3 // 4, summary=summary)
+        response = self.llm.invoke(prompt)
+        summary = str(getattr(response, "content", response)).strip()
+        if count_tokens(summary) <= budget:
+            return summary
+        # Keep the end, the latest turns are folded in last
+        words = summary.split()
+        low, high = 0, len(words)
+        while low < high:
+            middle = (low + high) // 2
+            if count_tokens(" ".join(words[middle:])) <= budget:
+                high = middle
+            else:
+                low = middle + 1
+        return " ".join(words[low:])
+
+    def _compact(self) -> None:
+        try:
+            with self._compact_lock:
+                with self._lock:
+                    starts = self._turn_starts()
+                    # Keep the last turns verbatim, fewer if they go over the budget
+                    keep = min(self.keep_turns, len(starts))
+                    while keep > 1 and count_tokens(
+                        self.summary + get_buffer_string(self.all_messages[starts[-keep]:])
+                    ) > self.max_tokens:
+                        keep -= 1
+                    cut = None
+                    if keep < len(starts):
+                        cut = starts[-keep] if keep else len(self.all_messages)
+                        summary = self.summary
+                        messages = self.all_messages[self.summarized : cut]
+                        generation = self._generation
+
+                # The LLM call is made without holding the lock of the readers
+                if cut is not None:
+                    summary = self._summarize(summary, messages)
+                    with self._lock:
+                        if generation == self._generation:
+                            self.summary = summary
+                            self.summarized = cut
+
+                with self._lock:
+                    full = count_tokens(get_buffer_string(self.all_messages))
+                    bounded = count_tokens(get_buffer_string(self._view()))
+                    self.saved_tokens.append(full - bounded)
+            logger.info(f"Chat history: {full} -> {bounded} tokens per step")
+        except Exception as e:
+            logger.warning(f"Could not summarize the chat history: {e}")
@@ -1,27 +1,239 @@
 """Util that calls Wikidata."""
 
+import contextvars
 import os
+import sys
 from dotenv import load_dotenv
 import logging
-from typing import Any, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional
 
 from langchain_core.documents import Document
 from langchain_core.pydantic_v1 import BaseModel, root_validator
 
+import metrics
+import transport
+from cache import LRUCache, MISSING, make_key
+from coalesce import SingleFlight
+from statements import Statement, current_question, load_importance, select
+
 logger = logging.getLogger(__name__)
 
-load_dotenv(dotenv_path='/u01/app/langchain-test-wikibase-agent/.env')
+load_dotenv()
 
-WIKIDATA_MAX_QUERY_LENGTH = int(os.getenv('WIKIDATA_MAX_QUERY_LENGTH'))
+WIKIDATA_MAX_QUERY_LENGTH = int(os.getenv('WIKIDATA_MAX_QUERY_LENGTH', 300))
 # Default properties are common properties you want to see filtered from https://www.wikidata.org/wiki/Wikidata:Database_reports/List_of_properties/all
 DEFAULT_PROPERTIES = []
-DEFAULT_LANG_CODE = os.getenv('WIKIBASE_LANGUAGE')
+DEFAULT_LANG_CODE = os.getenv('WIKIBASE_LANGUAGE', 'en')
 WIKIDATA_USER_AGENT = "langchain-wikidata"
-WIKIDATA_API_URL = os.getenv('MEDIAWIKI_API_URL')
-WIKIDATA_REST_API_URL = os.getenv('MEDIAWIKI_REST_API_URL')
-TOP_K_RESULTS = os.getenv('TOP_K_RESULTS')
-DOC_CONTENT_CHARS_MAX = os.getenv('DOC_CONTENT_CHARS_MAX')
-WIKIBASE_URL = os.getenv('WIKIBASE_URL')
+WIKIDATA_API_URL = os.getenv('MEDIAWIKI_API_URL', 'https://www.wikidata.org/w/api.php')
+WIKIDATA_REST_API_URL = os.getenv('MEDIAWIKI_REST_API_URL', 'https://www.wikidata.org/w/rest.php/wikibase/v0/')
+TOP_K_RESULTS = os.getenv('TOP_K_RESULTS', 2)
+DOC_CONTENT_CHARS_MAX = os.getenv('DOC_CONTENT_CHARS_MAX', 4000)
+# Tokens of statements kept in an item document, the most relevant to the question first, 0 keeps them all
+STATEMENT_TOKEN_BUDGET = int(os.getenv('STATEMENT_TOKEN_BUDGET', 2000))
+PROPERTY_IMPORTANCE = load_importance(os.getenv('PROPERTY_IMPORTANCE_PATH'))
+WIKIBASE_URL = os.getenv('WIKIBASE_URL', 'http://www.wikidata.org')
+# wbgetentities accepts at most 50 ids per call for anonymous clients
+WBGETENTITIES_MAX_IDS = 50
+BATCH_FETCH = os.getenv('WIKIDATA_BATCH_FETCH', 'true').lower() == 'true'
+MAX_WORKERS = int(os.getenv('WIKIDATA_MAX_WORKERS', 4))
+# Concurrent requests for the same item document share one fetch
+_inflight = SingleFlight()
+# Lines of describe_entities, also filled ahead of the agent by the prefetcher
+_descriptions = LRUCache(
+    max_entries=int(os.getenv('WIKIDATA_DESCRIPTION_CACHE_MAX_SIZE', 10000)),
+    ttl=float(os.getenv('WIKIDATA_DESCRIPTION_CACHE_TTL', 3600)),
+)
+metrics.register_cache('descriptions', _descriptions)
+
+
+def fetch_entities(
+    ids: Iterable[str],
+    props: str = "labels|descriptions|aliases|claims",
+    lang: Optional[str] = DEFAULT_LANG_CODE,
+    api_url: Optional[str] = WIKIDATA_API_URL,
+) -> Dict[str, Dict]:
+    """Fetch entities with wbgetentities, up to 50 ids per request.
+
+    Returns a dictionary from entity id to the entity JSON. Missing
+    entities are left out.
+    """
+    ids = list(dict.fromkeys(ids))
+    entities = {}
+    session = transport.get_session()
+    for start in range(0, len(ids), WBGETENTITIES_MAX_IDS):
+        params = {
+            "action": "wbgetentities",
+            "ids": "|".join(ids[start : start + WBGETENTITIES_MAX_IDS]),
+            "props": props,
+            "format": "json",
+        }
+        if lang:
+            params["languages"] = lang
+        response = session.get(api_url, params=params)
+        response.raise_for_status()
+        data = response.json()
+        if "error" in data:
+            raise ValueError(data["error"].get("info", data["error"]))
+        for entity_id, entity in data.get("entities", {}).items():
+            if "missing" not in entity:
+                entities[entity_id] = entity
+    return entities
+
+
+def describe_entities(
+    ids: List[str],
+    lang: Optional[str] = DEFAULT_LANG_CODE,
+    instance_of: str = "P31",
+    api_url: Optional[str] = WIKIDATA_API_URL,
+) -> str:
+    """One line per entity with its label, description and instance of.
+
+    Entities described recently are taken from a cache, the others need two
+    batched wbgetentities calls, whatever their number.
+    """
+    keys = {entity_id: make_key(api_url, lang, instance_of, entity_id) for entity_id in ids}
+    lines = {}
+    for entity_id, key in keys.items():
+        line = _descriptions.get(key)
+        if line is not MISSING:
+            lines[entity_id] = line
+    missing = [entity_id for entity_id in keys if entity_id not in lines]
+    if missing:
+        for entity_id, line in _describe(missing, lang, instance_of, api_url).items():
+            lines[entity_id] = line
+            _descriptions.set(keys[entity_id], line)
+    return "\n".join(lines.get(entity_id, f"{entity_id}: not found") for entity_id in ids)
+
+
+def _describe(
+    ids: List[str], lang: Optional[str], instance_of: str, api_url: Optional[str]
+) -> Dict[str, str]:
+    """Description lines of the entities found, keyed on their id."""
+    entities = fetch_entities(ids, props="labels|descriptions|claims", lang=lang, api_url=api_url)
+    classes = {
+        entity_id: [
+            claim["mainsnak"]["datavalue"]["value"]["id"]
+            for claim in entity.get("claims", {}).get(instance_of, [])
+            if claim["mainsnak"].get("snaktype") == "value"
+        ]
+        for entity_id, entity in entities.items()
+    }
+    class_ids = [c for values in classes.values() for c in values if c not in entities]
+    fetched = fetch_entities(class_ids, props="labels", lang=lang, api_url=api_url)
+    labels = {
+        entity_id: entity["labels"][lang]["value"]
+        for entity_id, entity in {**fetched, **entities}.items()
+        if lang in entity.get("labels", {})
+    }
+
+    lines = {}
+    for entity_id, entity in entities.items():
+        line = f"{entity_id}: {labels.get(entity_id, entity_id)}"
+        description = entity.get("descriptions", {}).get(lang, {}).get("value")
+        if description:
+            line += f" - {description}"
+        if classes[entity_id]:
+            line += f" (instance of: {', '.join(labels.get(c, c) for c in classes[entity_id])})"
+        lines[entity_id] = line
+    return lines
+
+
+def claim_targets(qid: str, api_url: Optional[str] = WIKIDATA_API_URL) -> List[str]:
+    """Ids of the items the claims of ``qid`` point to, in the order of the claims."""
+    entity = fetch_entities([qid], props="claims", lang=None, api_url=api_url).get(qid, {})
+    return list(dict.fromkeys(i for i in _referenced_ids(entity) if i.startswith("Q") and i != qid))
+
+
+def _to_qid(title: str) -> str:
+    """Remove the namespace of a search result title, e.g. ``Item:Q1``."""
+    return title.rsplit(":", 1)[-1]
+
+
+def _format_snak(snak: Dict, labels: Dict[str, str]) -> Optional[str]:
+    """Render the value of a snak the way it reads in an item document."""
+    if snak.get("snaktype") != "value":
+        return None
+    datavalue = snak["datavalue"]
+    value = datavalue["value"]
+    value_type = datavalue["type"]
+    if value_type == "wikibase-entityid":
+        return labels.get(value["id"], value["id"])
+    if value_type == "time":
+        time = value["time"].lstrip("+")
+        if value.get("precision", 11) >= 11:
+            return time.split("T")[0]
+        if value.get("precision") == 9:
+            return time.split("-")[0]
+        return time
+    if value_type == "quantity":
+        amount = value["amount"].lstrip("+")
+        unit = value.get("unit", "1")
+        if unit != "1":
+            unit_id = _to_qid(unit.rsplit("/", 1)[-1])
+            return f"{amount} {labels.get(unit_id, unit_id)}"
+        return amount
+    if value_type == "monolingualtext":
+        return value["text"]
+    if value_type == "globecoordinate":
+        return f"{value['latitude']}, {value['longitude']}"
+    return str(value)
+
+
+def _referenced_ids(entity: Dict) -> List[str]:
+    """Ids of the properties and entities used in the claims of an entity."""
+    ids = []
+    for pid, claims in entity.get("claims", {}).items():
+        ids.append(pid)
+        for claim in claims:
+            snak = claim.get("mainsnak", {})
+            if snak.get("snaktype") != "value":
+                continue
+            value = snak["datavalue"]["value"]
+            if snak["datavalue"]["type"] == "wikibase-entityid":
+                ids.append(value["id"])
+            elif snak["datavalue"]["type"] == "quantity" and value.get("unit", "1") != "1":
+                ids.append(value["unit"].rsplit("/", 1)[-1])
+    return ids
+
+
+def _shared_request_session() -> Any:
+    """mediawikiapi ``RequestSession`` sending its requests through the shared transport session."""
+    from mediawikiapi.requestsession import RequestSession
+
+    class SharedRequestSession(RequestSession):
+        @property
+        def session(self) -> Any:
+            return transport.get_session()
+
+        def new_session(self) -> None:
+            pass
+
+        def __del__(self) -> None:
+            # The shared session outlives the wrapper
+            pass
+
+    return SharedRequestSession()
+
+
+def use_shared_transport(api_wrapper: Any) -> Any:
+    """Send the requests of a Wikidata API wrapper through the shared transport.
+
+    The ``WikidataAPIWrapper`` of langchain_community opens its own
+    MediaWiki session and REST API client, so its requests would skip the
+    connection pool, the host limiters and the HTTP metrics. The endpoint
+    and user agent are read from the module of the wrapper.
+    """
+    module = sys.modules[type(api_wrapper).__module__]
+    api_wrapper.wikidata_mw.session = _shared_request_session()
+    api_wrapper.wikidata_rest.set_httpx_client(
+        transport.get_httpx_client(
+            module.WIKIDATA_REST_API_URL, headers={"User-Agent": module.WIKIDATA_USER_AGENT}
+        )
+    )
+    return api_wrapper
+
 
 class WikidataAPIWrapper(BaseModel):
     """Wrapper around the Wikidata API.
@@ -32,15 +244,32 @@ class WikidataAPIWrapper(BaseModel):
     fetch item content. By default, it will return the item content
     of the top-k results.
     It limits the Document content by doc_content_chars_max.
+
+    With ``batch_fetch`` the top-k items are fetched together through
+    ``wbgetentities``, otherwise (or if the batch call fails) they are
+    fetched from the REST API by at most ``max_workers`` threads.
+    When a loaded ``property_catalog`` is set, property labels are taken
+    from it instead of being fetched for every item. The statements of an
+    item are ranked for the current question, see ``statements.py``, and
+    the best ones fill ``statement_token_budget`` tokens. When an
+    ``entity_index`` is set, searches are answered from it and only go to
+    MediaWiki when it has no match.
     """
 
     wikidata_mw: Any  #: :meta private:
     wikidata_rest: Any  # : :meta private:
+    wikidata_fluent: Any  # : :meta private:
     top_k_results: int = int(TOP_K_RESULTS)
     load_all_available_meta: bool = False
     doc_content_chars_max: int = int(DOC_CONTENT_CHARS_MAX)
     wikidata_props: List[str] = DEFAULT_PROPERTIES
     lang: str = DEFAULT_LANG_CODE
+    batch_fetch: bool = BATCH_FETCH
+    max_workers: int = MAX_WORKERS
+    property_catalog: Any = None
+    entity_index: Any = None
+    statement_token_budget: int = STATEMENT_TOKEN_BUDGET
+    property_importance: Dict[str, float] = PROPERTY_IMPORTANCE
 
     @root_validator()
     def validate_environment(cls, values: Dict) -> Dict:
@@ -49,9 +278,11 @@ class WikidataAPIWrapper(BaseModel):
             from mediawikiapi import MediaWikiAPI
             from mediawikiapi.config import Config
 
-            values["wikidata_mw"] = MediaWikiAPI(
+            wikidata_mw = MediaWikiAPI(
                 Config(user_agent=WIKIDATA_USER_AGENT, mediawiki_url=WIKIDATA_API_URL)
             )
+            wikidata_mw.session = _shared_request_session()
+            values["wikidata_mw"] = wikidata_mw
         except ImportError:
             raise ImportError(
                 "Could not import mediawikiapi python package. "
@@ -67,7 +298,19 @@ class WikidataAPIWrapper(BaseModel):
                 headers={"User-Agent": WIKIDATA_USER_AGENT},
                 follow_redirects=True,
             )
+            client.set_httpx_client(
+                transport.get_httpx_client(
+                    WIKIDATA_REST_API_URL, headers={"User-Agent": WIKIDATA_USER_AGENT}
+                )
+            )
             values["wikidata_rest"] = client
+            # The fluent client only holds the REST client and the settings,
+            # so a single instance can be shared by concurrent calls.
+            from wikibase_rest_api_client.utilities.fluent import FluentWikibaseClient
+
+            values["wikidata_fluent"] = FluentWikibaseClient(
+                client, supported_props=values["wikidata_props"], lang=values["lang"]
+            )
         except ImportError:
             raise ImportError(
                 "Could not import wikibase_rest_api_client python package. "
@@ -76,12 +319,17 @@ class WikidataAPIWrapper(BaseModel):
         return values
 
     def _item_to_document(self, qid: str) -> Optional[Document]:
-        from wikibase_rest_api_client.utilities.fluent import FluentWikibaseClient
+        # Keyed on the wrapper and the question too, they shape the document
+        return _inflight.do((id(self), qid, current_question()), self._load_item_document, qid)
 
-        fluent_client: FluentWikibaseClient = FluentWikibaseClient(
-            self.wikidata_rest, supported_props=self.wikidata_props, lang=self.lang
-        )
-        resp = fluent_client.get_item(qid.strip('Item:'))
+    def _load_item_document(self, qid: str) -> Optional[Document]:
+        if self.property_catalog is not None and self.property_catalog.ready:
+            try:
+                return self._fetch_documents([qid])[0]
+            except Exception as e:
+                logger.warning(f"Could not fetch {qid} with wbgetentities: {e}")
+
+        resp = self.wikidata_fluent.get_item(qid.strip('Item:'))
 
         if not resp:
             logger.warning(f"Could not find item {qid} in Wikidata")
@@ -94,38 +342,136 @@ class WikidataAPIWrapper(BaseModel):
             doc_lines.append(f"Description: {resp.description}")
         if resp.aliases:
             doc_lines.append(f"Aliases: {', '.join(resp.aliases)}")
+        statements = []
         for prop, values in resp.statements.items():
             if values:
-                doc_lines.append(f"{prop.label}: {', '.join(values)}")
+                datatype = getattr(prop, "datatype", None) or self._datatype(prop.pid)
+                # A value stated twice, e.g. with other qualifiers, is shown once
+                values = list(dict.fromkeys(str(value) for value in values))
+                statements.append(Statement(prop.pid, prop.label, values, datatype))
+        doc_lines.extend(self._select(statements))
 
         return Document(
             page_content=("\n".join(doc_lines))[: self.doc_content_chars_max],
             meta={"title": qid, "source": f"{WIKIBASE_URL}/wiki/Item:{qid}"},
         )
 
+    def _datatype(self, pid: Optional[str]) -> Optional[str]:
+        if pid and self.property_catalog is not None and self.property_catalog.ready:
+            return self.property_catalog.datatype(pid)
+        return None
+
+    def _select(self, statements: List[Statement]) -> List[str]:
+        return select(
+            statements,
+            question=current_question(),
+            budget=self.statement_token_budget,
+            importance=self.property_importance,
+        )
+
+    def _entity_to_document(
+        self, qid: str, entity: Dict, labels: Dict[str, str]
+    ) -> Document:
+        lang = self.lang
+        doc_lines = []
+        if label := entity.get("labels", {}).get(lang, {}).get("value"):
+            doc_lines.append(f"Label: {label}")
+        if description := entity.get("descriptions", {}).get(lang, {}).get("value"):
+            doc_lines.append(f"Description: {description}")
+        if aliases := entity.get("aliases", {}).get(lang):
+            doc_lines.append(f"Aliases: {', '.join(a['value'] for a in aliases)}")
+        statements = []
+        for pid, claims in entity.get("claims", {}).items():
+            if self.wikidata_props and pid not in self.wikidata_props:
+                continue
+            values = [_format_snak(claim["mainsnak"], labels) for claim in claims]
+            values = list(dict.fromkeys(value for value in values if value))
+            if values:
+                datatype = claims[0]["mainsnak"].get("datatype")
+                statements.append(Statement(pid, labels.get(pid, pid), values, datatype))
+        doc_lines.extend(self._select(statements))
+
+        return Document(
+            page_content=("\n".join(doc_lines))[: self.doc_content_chars_max],
+            meta={"title": qid, "source": f"{WIKIBASE_URL}/wiki/Item:{qid}"},
+        )
+
+    def _fetch_documents(self, items: List[str]) -> List[Optional[Document]]:
+        """Fetch the items and the labels they reference in batched calls."""
+        qids = [_to_qid(item) for item in items]
+        entities = fetch_entities(qids, lang=self.lang)
+        labels = {}
+        referenced = []
+        for entity in entities.values():
+            referenced.extend(_referenced_ids(entity))
+        if self.property_catalog is not None and self.property_catalog.ready:
+            catalog_labels = self.property_catalog.labels()
+            labels.update(
+                (pid, catalog_labels[pid]) for pid in referenced if pid in catalog_labels
+            )
+            referenced = [entity_id for entity_id in referenced if entity_id not in labels]
+        labels.update(
+            (entity_id, entity["labels"][self.lang]["value"])
+            for entity_id, entity in fetch_entities(
+                referenced, props="labels", lang=self.lang
+            ).items()
+            if self.lang in entity.get("labels", {})
+        )
+        docs = []
+        for qid in qids:
+            if qid not in entities:
+                logger.warning(f"Could not find item {qid} in Wikidata")
+                docs.append(None)
+            else:
+                docs.append(self._entity_to_document(qid, entities[qid], labels))
+        return docs
+
+    def _items_to_documents(self, items: List[str]) -> List[Optional[Document]]:
+        """Documents of the items, in the same order, None for missing items."""
+        if not items:
+            return []
+        if self.batch_fetch:
+            try:
+                return self._fetch_documents(items)
+            except Exception as e:
+                logger.warning(f"Batched fetch failed, using the REST API: {e}")
+        if len(items) == 1 or self.max_workers <= 1:
+            return [self._item_to_document(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as pool:
+            # Each item runs in a copy of the context, which holds the question of the documents
+            futures = [
+                pool.submit(contextvars.copy_context().run, self._item_to_document, item)
+                for item in items
+            ]
+            return [future.result() for future in futures]
+
+    def _search(self, query: str) -> List[str]:
+        if self.entity_index is not None:
+            hits = self.entity_index.search(
+                query[:WIKIDATA_MAX_QUERY_LENGTH], limit=self.top_k_results
+            )
+            if hits:
+                return [hit["id"] for hit in hits]
+        clipped_query = 'Item:'+query[:WIKIDATA_MAX_QUERY_LENGTH]
+        return self.wikidata_mw.search(clipped_query, results=self.top_k_results)
+
     def load(self, query: str) -> List[Document]:
         """
         Run Wikidata search and get the item documents plus the meta information.
         """
 
-        clipped_query = 'Item:'+query[:WIKIDATA_MAX_QUERY_LENGTH]
-        items = self.wikidata_mw.search(clipped_query, results=self.top_k_results)
-        docs = []
-        for item in items[: self.top_k_results]:
-            if doc := self._item_to_document(item):
-                docs.append(doc)
-        return docs
+        items = self._search(query)
+        docs = self._items_to_documents(items[: self.top_k_results])
+        return [doc for doc in docs if doc]
 
 
     def run(self, query: str) -> str:
         """Run Wikidata search and get item summaries."""
 
-        clipped_query = 'Item:'+query[:WIKIDATA_MAX_QUERY_LENGTH]
-        items = self.wikidata_mw.search(clipped_query, results=self.top_k_results)
-
+        items = self._search(query)[: self.top_k_results]
         docs = []
-        for item in items[: self.top_k_results]:
-            if doc := self._item_to_document(item):
+        for item, doc in zip(items, self._items_to_documents(items)):
+            if doc:
                 docs.append(f"Result {item}:\n{doc.page_content}")
         if not docs:
             return "No good Wikidata Search Result was found"
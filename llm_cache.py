@@ -0,0 +1,135 @@
+"""Persistent exact-match cache of LLM responses.
+
+Responses are keyed on the model, its generation parameters and the full
+list of messages, so only a byte-identical request is answered from the
+cache. Caching is turned off when the temperature is above
+``LLM_CACHE_MAX_TEMPERATURE``, where identical requests are expected to
+get different answers.
+"""
+
+import json
+import os
+import threading
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.load import dumps, loads
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk
+
+from cache import MISSING, DiskCache, make_key
+
+_lock = threading.Lock()
+_cache: Optional["DiskLLMCache"] = None
+
+
+class DiskLLMCache(BaseCache):
+    """LangChain cache stored in a size bounded SQLite ``DiskCache``."""
+
+    def __init__(self, path: str, max_bytes: Optional[int] = None) -> None:
+        self.store = DiskCache(path, max_bytes=max_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        value = self.store.get(make_key(llm_string, prompt))
+        if value is MISSING:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [loads(generation) for generation in value]
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        self.store.set(
+            make_key(llm_string, prompt), [dumps(generation) for generation in return_val]
+        )
+
+    def clear(self, **kwargs: Any) -> None:
+        self.store.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def get_llm_cache(temperature: float) -> Optional[DiskLLMCache]:
+    """Return the shared cache, or None when caching is off for ``temperature``."""
+    global _cache
+    if os.getenv("LLM_CACHE", "true").lower() != "true":
+        return None
+    if temperature > float(os.getenv("LLM_CACHE_MAX_TEMPERATURE", 0.3)):
+        return None
+    with _lock:
+        if _cache is None:
+            _cache = DiskLLMCache(
+                os.getenv("LLM_CACHE_PATH", ".cache/llm.sqlite"),
+                max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", 100 * 1024 * 1024)),
+            )
+    return _cache
+
+
+class StreamingCacheMixin:
+    """Serve streamed calls of a chat model from its cache.
+
+    LangChain only consults the model cache for non streaming calls, while
+    the agent streams its steps. Mixed into a chat model class, this
+    replays a cached response as a single chunk and stores streamed
+    responses once they are complete.
+    """
+
+    def _cache_key(self, messages, stop, **kwargs):
+        if not isinstance(self.cache, BaseCache):
+            return None
+        return dumps(messages), self._get_llm_string(stop=stop, **kwargs)
+
+    def _cached_chunk(self, key) -> Optional[ChatGenerationChunk]:
+        cached = self.cache.lookup(*key) if key else None
+        if not cached:
+            return None
+        message = cached[0].message
+        if not isinstance(message, AIMessageChunk):
+            # Stored by a non streaming call, its tool calls are replayed as chunks
+            message = AIMessageChunk(
+                content=message.content,
+                additional_kwargs=message.additional_kwargs,
+                tool_call_chunks=[
+                    {"name": call["name"], "args": json.dumps(call["args"]), "id": call.get("id"), "index": index}
+                    for index, call in enumerate(getattr(message, "tool_calls", []))
+                ],
+            )
+        return ChatGenerationChunk(message=message)
+
+    def _store(self, key, chunks: List[ChatGenerationChunk]) -> None:
+        if key and chunks:
+            # The merged chunk keeps the tool calls and additional kwargs, not only the text
+            merged = chunks[0]
+            for chunk in chunks[1:]:
+                merged += chunk
+            self.cache.update(*key, [ChatGeneration(message=merged.message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        key = self._cache_key(messages, stop, **kwargs)
+        chunk = self._cached_chunk(key)
+        if chunk is not None:
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+            return
+        chunks = []
+        for chunk in super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            chunks.append(chunk)
+            yield chunk
+        self._store(key, chunks)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        key = self._cache_key(messages, stop, **kwargs)
+        chunk = self._cached_chunk(key)
+        if chunk is not None:
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+            return
+        chunks = []
+        async for chunk in super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            chunks.append(chunk)
+            yield chunk
+        self._store(key, chunks)
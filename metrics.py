@@ -0,0 +1,356 @@
+"""Agent metrics, exposed in the Prometheus text format and as JSON logs.
+
+``MetricsCallback`` is passed in the callbacks of an agent run and records
+the tool calls, LLM calls and ReAct iterations. HTTP requests are recorded
+by hooks installed on the pooled clients of ``transport`` and cache hit
+rates are read from the registered caches when the metrics are scraped.
+
+Set ``METRICS_PORT`` to serve ``/metrics`` and ``METRICS_LOG=true`` to
+write one JSON line per event on stderr.
+"""
+
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from render import count_tokens
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_event_logger = logging.getLogger("metrics.events")
+_log_enabled: Optional[bool] = None
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[Any], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonic counter with a value per combination of labels."""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: Any) -> float:
+        return self._values.get(tuple(labels.get(name, "") for name in self.labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_labels(self.labels, key)} {value}" for key, value in values]
+
+
+class Histogram:
+    """Cumulative histogram of observed values per combination of labels."""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per labels: count in each bucket (the last one is +Inf), sum
+        self._values: Dict[Tuple, Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            values = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{float(bound)!r}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Set of metrics rendered together in the Prometheus text format."""
+
+    def __init__(self) -> None:
+        self.metrics: List[Any] = []
+        self.caches: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), **kwargs: Any) -> Histogram:
+        metric = Histogram(name, help, labels, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def _cache_samples(self) -> Dict[str, List[str]]:
+        samples: Dict[str, List[str]] = {}
+        for cache, stats in list(self.caches.items()):
+            try:
+                values = dict(stats())
+            except Exception:
+                continue
+            if "hit_rate" not in values and "hits" in values and "misses" in values:
+                total = values["hits"] + values["misses"]
+                values["hit_rate"] = values["hits"] / total if total else 0.0
+            for stat, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    samples.setdefault(f"wikibase_cache_{stat}", []).append(
+                        f'wikibase_cache_{stat}{{cache="{_escape(cache)}"}} {value}'
+                    )
+        return samples
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        for name, samples in self._cache_samples().items():
+            lines.append(f"# HELP {name} Cache statistic, see the stats() of the cache.")
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+TOOL_SECONDS = REGISTRY.histogram("wikibase_tool_seconds", "Time spent in each agent tool.", ["tool"])
+TOOL_ERRORS = REGISTRY.counter("wikibase_tool_errors_total", "Agent tool calls that raised.", ["tool"])
+HTTP_SECONDS = REGISTRY.histogram(
+    "wikibase_http_request_seconds", "Time until the response headers, per host.", ["host"]
+)
+HTTP_REQUESTS = REGISTRY.counter("wikibase_http_requests_total", "HTTP requests per host and status.", ["host", "status"])
+HTTP_QUEUE_SECONDS = REGISTRY.histogram(
+    "wikibase_http_queue_seconds", "Time waited for the rate limiter before each HTTP request, per host.", ["host"]
+)
+HTTP_BYTES = REGISTRY.counter("wikibase_http_response_bytes_total", "HTTP response bytes per host.", ["host"])
+LLM_SECONDS = REGISTRY.histogram("wikibase_llm_seconds", "Duration of each LLM call.", ["model"])
+LLM_TOKENS = REGISTRY.counter("wikibase_llm_tokens_total", "LLM tokens per model and kind (prompt or completion).", ["model", "kind"])
+AGENT_ITERATIONS = REGISTRY.histogram(
+    "wikibase_agent_iterations",
+    "ReAct iterations (tool calls) per question.",
+    buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10, 15),
+)
+
+
+def log_event(event: str, **fields: Any) -> None:
+    """Write the event as one JSON line when METRICS_LOG is on."""
+    global _log_enabled
+    if _log_enabled is None:
+        _log_enabled = os.getenv("METRICS_LOG", "false").lower() == "true"
+        if _log_enabled and not _event_logger.handlers:
+            _event_logger.addHandler(logging.StreamHandler())
+            _event_logger.setLevel(logging.INFO)
+            _event_logger.propagate = False
+    if _log_enabled:
+        _event_logger.info(json.dumps({"ts": round(time.time(), 3), "event": event, **fields}, default=str))
+
+
+def register_cache(name: str, cache: Any) -> None:
+    """Report the ``stats()`` of ``cache`` under the ``cache`` label ``name``."""
+    if cache is not None:
+        REGISTRY.caches[name] = cache.stats
+
+
+def _record_http(host: str, status: Any, seconds: Optional[float], size: Optional[int]) -> None:
+    HTTP_REQUESTS.inc(host=host, status=status)
+    if seconds is not None:
+        HTTP_SECONDS.observe(seconds, host=host)
+    if size is not None:
+        HTTP_BYTES.inc(size, host=host)
+    log_event("http", host=host, status=status, seconds=seconds, bytes=size)
+
+
+def _content_length(headers) -> Optional[int]:
+    try:
+        return int(headers["Content-Length"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def record_response(response, *args: Any, **kwargs: Any) -> None:
+    """``requests`` response hook."""
+    # Streamed bodies are read later by the caller, only trust the header
+    if kwargs.get("stream"):
+        size = _content_length(response.headers)
+    else:
+        size = len(response.content)
+    _record_http(
+        urlsplit(response.url).hostname or "", response.status_code, response.elapsed.total_seconds(), size
+    )
+
+
+def record_httpx_request(request) -> None:
+    """``httpx`` request event hook, paired with ``record_httpx_response``."""
+    request.extensions["metrics_started"] = time.perf_counter()
+
+
+def record_httpx_response(response) -> None:
+    """``httpx`` response event hook."""
+    started = response.request.extensions.get("metrics_started")
+    _record_http(
+        response.request.url.host,
+        response.status_code,
+        time.perf_counter() - started if started else None,
+        _content_length(response.headers),
+    )
+
+
+def _usage(response, prompts: List[str]) -> Tuple[int, int]:
+    """Prompt and completion tokens reported by the model, or estimated."""
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    if usage.get("prompt_tokens") is not None:
+        return usage["prompt_tokens"], usage.get("completion_tokens", 0)
+    generations = [g for generation in response.generations for g in generation]
+    metadata = getattr(getattr(generations[0], "message", None), "usage_metadata", None) if generations else None
+    if metadata:
+        return metadata.get("input_tokens", 0), metadata.get("output_tokens", 0)
+    return (
+        sum(count_tokens(prompt) for prompt in prompts),
+        sum(count_tokens(g.text) for g in generations),
+    )
+
+
+class MetricsCallback(BaseCallbackHandler):
+    """Records the tool calls, LLM calls and iterations of the agent runs.
+
+    One instance is shared by all the runs, their state is keyed on the
+    LangChain run ids.
+    """
+
+    run_inline = True
+
+    def __init__(self) -> None:
+        self._tools: Dict[Any, Tuple[str, float]] = {}
+        self._llms: Dict[Any, Tuple[str, List[str], float]] = {}
+        self._iterations: Dict[Any, int] = {}
+
+    @staticmethod
+    def _model(serialized: Optional[Dict], kwargs: Dict) -> str:
+        params = kwargs.get("invocation_params") or {}
+        model = params.get("model") or params.get("model_name")
+        if not model and serialized:
+            model = (serialized.get("kwargs") or {}).get("model") or (serialized.get("id") or ["llm"])[-1]
+        return str(model or "llm")
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs) -> None:
+        self._llms[run_id] = (self._model(serialized, kwargs), list(prompts), time.perf_counter())
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs) -> None:
+        from langchain_core.messages import get_buffer_string
+
+        prompts = [get_buffer_string(m) for m in messages]
+        self._llms[run_id] = (self._model(serialized, kwargs), prompts, time.perf_counter())
+
+    def on_llm_end(self, response, *, run_id, **kwargs) -> None:
+        model, prompts, started = self._llms.pop(run_id, ("llm", [], time.perf_counter()))
+        seconds = time.perf_counter() - started
+        prompt_tokens, completion_tokens = _usage(response, prompts)
+        LLM_SECONDS.observe(seconds, model=model)
+        LLM_TOKENS.inc(prompt_tokens, model=model, kind="prompt")
+        LLM_TOKENS.inc(completion_tokens, model=model, kind="completion")
+        log_event(
+            "llm",
+            model=model,
+            seconds=round(seconds, 4),
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+        )
+
+    def on_llm_error(self, error, *, run_id, **kwargs) -> None:
+        model, _, started = self._llms.pop(run_id, ("llm", [], time.perf_counter()))
+        log_event("llm", model=model, seconds=round(time.perf_counter() - started, 4), error=repr(error))
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs) -> None:
+        self._tools[run_id] = ((serialized or {}).get("name") or "tool", time.perf_counter())
+
+    def _tool_done(self, run_id, error: Optional[BaseException] = None) -> None:
+        name, started = self._tools.pop(run_id, ("tool", time.perf_counter()))
+        seconds = time.perf_counter() - started
+        TOOL_SECONDS.observe(seconds, tool=name)
+        if error is not None:
+            TOOL_ERRORS.inc(tool=name)
+        log_event("tool", tool=name, seconds=round(seconds, 4), error=repr(error) if error else None)
+
+    def on_tool_end(self, output, *, run_id, **kwargs) -> None:
+        self._tool_done(run_id)
+
+    def on_tool_error(self, error, *, run_id, **kwargs) -> None:
+        self._tool_done(run_id, error)
+
+    def on_agent_action(self, action, *, run_id, **kwargs) -> None:
+        self._iterations[run_id] = self._iterations.get(run_id, 0) + 1
+
+    def on_agent_finish(self, finish, *, run_id, **kwargs) -> None:
+        iterations = self._iterations.pop(run_id, 0)
+        AGENT_ITERATIONS.observe(iterations)
+        log_event("agent", iterations=iterations)
+
+
+callback = MetricsCallback()
+
+
+def start_server(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Serve ``/metrics`` in the Prometheus text format on a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            data = REGISTRY.expose().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args) -> None:
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+    return server
@@ -0,0 +1,110 @@
+"""Speculative prefetch of what the agent is likely to read next.
+
+Once ``getQItem`` resolves an item, the next steps of the agent nearly
+always read that item, with ``WikibaseRetrieval``, or query its claims and
+look up the returned items with ``WikibaseLabels``. The prefetcher starts
+those fetches in the background while the LLM writes its next step, so
+their results are in the caches when the tools ask for them.
+
+Prefetching is bounded by a small pool of worker threads and by a budget of
+items per question of each chat session. The session is the ``session_id``
+of the LangChain config the tool runs under.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, Optional
+
+from cache import LRUCache, MISSING
+
+logger = logging.getLogger(__name__)
+
+
+def current_session() -> Optional[Hashable]:
+    """``session_id`` of the agent run calling the tool, None outside of a chat."""
+    from langchain_core.runnables.config import ensure_config
+
+    return ensure_config().get("configurable", {}).get("session_id")
+
+
+class Prefetcher:
+    """Runs ``fetch(key)`` in the background for keys the agent will likely need.
+
+    Each session can prefetch ``budget`` keys per question once ``reset``
+    was called for it, runs outside of a chat session do not prefetch. Keys
+    prefetched less than ``ttl`` seconds ago are skipped, and so are new
+    keys while ``max_pending`` fetches are waiting for a worker.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[str], None],
+        workers: int = 2,
+        budget: int = 5,
+        max_pending: Optional[int] = None,
+        max_sessions: int = 100,
+        ttl: float = 600,
+    ) -> None:
+        self.fetch = fetch
+        self.budget = budget
+        self.max_pending = max_pending if max_pending is not None else workers * 2
+        self.max_sessions = max_sessions
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        self._spent: "OrderedDict[Hashable, int]" = OrderedDict()
+        self._recent = LRUCache(max_entries=1000, ttl=ttl)
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.submitted = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def reset(self, session_id: Hashable) -> None:
+        """Give the session its full budget back, at the start of a question."""
+        with self._lock:
+            self._spent[session_id] = 0
+            self._spent.move_to_end(session_id)
+            while len(self._spent) > self.max_sessions:
+                self._spent.popitem(last=False)
+
+    def submit(self, key: str, session_id: Optional[Hashable] = None) -> bool:
+        """Prefetch ``key`` for the session of the current run, returns whether it was started."""
+        if session_id is None:
+            session_id = current_session()
+        with self._lock:
+            spent = self._spent.get(session_id)
+            if (
+                spent is None
+                or spent >= self.budget
+                or self.pending >= self.max_pending
+                or self._recent.get(key) is not MISSING
+            ):
+                self.skipped += 1
+                return False
+            self._spent[session_id] = spent + 1
+            self._recent.set(key, True)
+            self.pending += 1
+            self.submitted += 1
+        # Pool threads start from an empty context, so the fetch is not
+        # reported as part of the agent run that triggered it
+        self._executor.submit(self._run, key)
+        return True
+
+    def _run(self, key: str) -> None:
+        try:
+            self.fetch(key)
+        except Exception as e:
+            self.failed += 1
+            logger.info(f"Prefetch of {key} failed: {e}")
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "submitted": self.submitted,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "pending": self.pending,
+        }
@@ -0,0 +1,264 @@
+"""In-memory catalog of the Wikibase properties.
+
+A Wikibase only has a few thousand properties, so all of them (id, labels,
+aliases and datatype) are loaded in one pass and kept in memory. Lookups
+by name are answered from an exact match table or, failing that, from a
+trigram index, without any HTTP call.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+from array import array
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional
+
+import transport
+
+logger = logging.getLogger(__name__)
+
+PROPERTIES_QUERY = """
+PREFIX wikibase: <http://wikiba.se/ontology#>
+PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+SELECT ?property ?type ?label ?alias WHERE {
+  ?property a wikibase:Property ; wikibase:propertyType ?type .
+  OPTIONAL { ?property rdfs:label ?label FILTER(LANG(?label) = "%(lang)s") }
+  OPTIONAL { ?property skos:altLabel ?alias FILTER(LANG(?alias) = "%(lang)s") }
+}
+"""
+
+# Seconds before a failed load is tried again
+RETRY_DELAY = 60
+
+
+def normalize_name(name: str) -> str:
+    return re.sub(r"\s+", " ", str(name).strip().strip("'\"").lower())
+
+
+def trigrams(name: str) -> set:
+    padded = f"  {name} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+# Ontology names of the datatypes whose API name is not just the kebab-case of it
+_API_DATATYPES = {"CommonsMedia": "commonsMedia"}
+_CAMEL_RE = re.compile(r"(?<!^)(?=[A-Z])")
+
+
+def api_datatype(name: str) -> str:
+    """API name of a datatype from its ontology name, e.g. ``WikibaseItem`` -> ``wikibase-item``."""
+    return _API_DATATYPES.get(name) or _CAMEL_RE.sub("-", name).lower()
+
+
+class _Index(NamedTuple):
+    labels: Dict[str, str]
+    datatypes: Dict[str, str]
+    exact: Dict[str, str]
+    name_ids: List[str]
+    name_sizes: array
+    trigrams: Dict[str, array]
+
+
+class PropertyCatalog:
+    """All the properties of a Wikibase, indexed for lookups by name.
+
+    ``load`` reads the properties from the SPARQL endpoint, or from the
+    MediaWiki API when the endpoint is not available, and ``start`` loads
+    them and refreshes them every ``refresh_interval`` seconds in a
+    background thread. With a ``refresh_interval`` of 0 they are loaded
+    once, failed loads are still retried.
+    """
+
+    def __init__(
+        self,
+        sparql_url: Optional[str],
+        api_url: Optional[str],
+        lang: str = "en",
+        refresh_interval: float = 3600,
+        min_score: float = 0.7,
+        namespace: int = 120,
+    ) -> None:
+        self.sparql_url = sparql_url
+        self.api_url = api_url
+        self.lang = lang
+        self.refresh_interval = refresh_interval
+        self.min_score = min_score
+        self.namespace = namespace
+        self.loaded_at: Optional[float] = None
+        self._index = _Index({}, {}, {}, [], array("I"), {})
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_env(cls) -> "PropertyCatalog":
+        return cls(
+            sparql_url=os.getenv("MEDIAWIKI_SPARQL_ENDPOINT"),
+            api_url=os.getenv("MEDIAWIKI_API_URL"),
+            lang=os.getenv("WIKIBASE_LANGUAGE", "en"),
+            refresh_interval=float(os.getenv("PROPERTY_CATALOG_REFRESH", 3600)),
+            min_score=float(os.getenv("PROPERTY_CATALOG_MIN_SCORE", 0.7)),
+            namespace=int(os.getenv("PROPERTY_NAMESPACE", 120)),
+        )
+
+    @property
+    def ready(self) -> bool:
+        return self.loaded_at is not None
+
+    def __len__(self) -> int:
+        return len(self._index.labels)
+
+    def _from_sparql(self) -> List[Dict]:
+        response = transport.get_session().get(
+            self.sparql_url,
+            headers={"Accept": "application/sparql-results+json"},
+            params={"query": PROPERTIES_QUERY % {"lang": self.lang}, "format": "json"},
+        )
+        response.raise_for_status()
+        properties: Dict[str, Dict] = {}
+        for row in response.json()["results"]["bindings"]:
+            pid = row["property"]["value"].rsplit("/", 1)[-1]
+            prop = properties.setdefault(
+                pid,
+                {
+                    "id": pid,
+                    "label": None,
+                    "aliases": [],
+                    "datatype": api_datatype(row["type"]["value"].rsplit("#", 1)[-1]),
+                },
+            )
+            if "label" in row:
+                prop["label"] = row["label"]["value"]
+            if "alias" in row and row["alias"]["value"] not in prop["aliases"]:
+                prop["aliases"].append(row["alias"]["value"])
+        return list(properties.values())
+
+    def _from_api(self) -> List[Dict]:
+        from langchain_mod.utilities import fetch_entities
+
+        session = transport.get_session()
+        params = {
+            "action": "query",
+            "list": "allpages",
+            "apnamespace": self.namespace,
+            "aplimit": "max",
+            "format": "json",
+        }
+        pids = []
+        while True:
+            data = session.get(self.api_url, params=params).json()
+            pids.extend(
+                page["title"].rsplit(":", 1)[-1] for page in data["query"]["allpages"]
+            )
+            if "continue" not in data:
+                break
+            params.update(data["continue"])
+        properties = []
+        entities = fetch_entities(
+            pids, props="labels|aliases|datatype", lang=self.lang, api_url=self.api_url
+        )
+        for pid, entity in entities.items():
+            properties.append(
+                {
+                    "id": pid,
+                    "label": entity.get("labels", {}).get(self.lang, {}).get("value"),
+                    "aliases": [
+                        alias["value"]
+                        for alias in entity.get("aliases", {}).get(self.lang, [])
+                    ],
+                    "datatype": entity.get("datatype"),
+                }
+            )
+        return properties
+
+    def load(self) -> None:
+        """Load every property and swap in the new index."""
+        started = time.time()
+        try:
+            properties = self._from_sparql()
+        except Exception as e:
+            logger.warning(f"Could not load properties from SPARQL, using the API: {e}")
+            properties = self._from_api()
+
+        labels, datatypes, exact = {}, {}, {}
+        name_ids, name_sizes = [], array("I")
+        grams: Dict[str, array] = {}
+        for prop in properties:
+            pid = prop["id"]
+            if prop["label"]:
+                labels[pid] = prop["label"]
+            datatypes[pid] = prop["datatype"]
+            for name in [prop["label"], *prop["aliases"]]:
+                if not name:
+                    continue
+                name = normalize_name(name)
+                # Labels win over aliases of other properties
+                if name not in exact or name == normalize_name(prop["label"] or ""):
+                    exact[name] = pid
+                name_grams = trigrams(name)
+                for gram in name_grams:
+                    grams.setdefault(gram, array("I")).append(len(name_ids))
+                name_ids.append(pid)
+                name_sizes.append(len(name_grams))
+
+        # Replace the whole index at once so readers never see a partial one
+        self._index = _Index(labels, datatypes, exact, name_ids, name_sizes, grams)
+        self.loaded_at = time.time()
+        logger.info(
+            f"Loaded {len(labels)} properties in {self.loaded_at - started:.2f}s"
+        )
+
+    def _refresh(self) -> None:
+        while True:
+            try:
+                self.load()
+                if self.refresh_interval <= 0:
+                    return
+                delay = self.refresh_interval
+            except Exception as e:
+                logger.warning(f"Could not refresh the property catalog: {e}")
+                delay = RETRY_DELAY
+                if self.refresh_interval > 0:
+                    delay = min(delay, self.refresh_interval)
+            time.sleep(delay)
+
+    def start(self) -> None:
+        """Load the catalog and keep it fresh in a background thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._refresh, name="property-catalog", daemon=True
+            )
+            self._thread.start()
+
+    def label(self, pid: str) -> Optional[str]:
+        return self._index.labels.get(pid)
+
+    def datatype(self, pid: str) -> Optional[str]:
+        return self._index.datatypes.get(pid)
+
+    def labels(self) -> Dict[str, str]:
+        return self._index.labels
+
+    def lookup(self, name: str) -> Optional[str]:
+        """Return the id of the property best matching name, if any."""
+        name = normalize_name(name)
+        index = self._index
+        if name in index.exact:
+            return index.exact[name]
+        if re.fullmatch(r"p\d+", name) and name.upper() in index.labels:
+            return name.upper()
+
+        query = trigrams(name)
+        shared: Counter = Counter()
+        for gram in query:
+            shared.update(index.trigrams.get(gram, ()))
+        best, best_score = None, 0.0
+        for position, count in shared.items():
+            # Dice coefficient between the trigram sets
+            score = 2 * count / (len(query) + index.name_sizes[position])
+            if score > best_score:
+                best, best_score = position, score
+        if best is not None and best_score >= self.min_score:
+            return index.name_ids[best]
+        return None
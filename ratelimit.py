@@ -0,0 +1,153 @@
+"""Rate limiting shared by concurrent workers."""
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Mapping, Optional
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled with ``rate`` tokens per second.
+
+    At most ``capacity`` tokens accumulate, which is the largest burst
+    allowed after an idle period. ``acquire`` blocks until enough tokens
+    are available, so any number of threads can share one bucket sized to
+    a provider quota.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.acquired = 0.0
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """Take ``tokens`` if they are available right away."""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                self.acquired += tokens
+                return True
+            return False
+
+    def acquire(self, tokens: float = 1, timeout: Optional[float] = None) -> bool:
+        """Wait until ``tokens`` are available and take them.
+
+        Requests larger than the capacity are capped to it, so they wait
+        for a full bucket instead of forever. Returns False when
+        ``timeout`` seconds passed first.
+        """
+        tokens = min(tokens, self.capacity)
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    self.acquired += tokens
+                    self.waited += now - started
+                    return True
+                wait = (tokens - self.tokens) / self.rate
+            if deadline is not None:
+                if now >= deadline:
+                    with self._lock:
+                        self.waited += now - started
+                    return False
+                wait = min(wait, deadline - now)
+            time.sleep(wait)
+
+    def stats(self) -> Dict[str, float]:
+        return {"acquired": self.acquired, "waited": round(self.waited, 3)}
+
+
+class AdaptiveLimiter(TokenBucket):
+    """Token bucket whose rate follows the throttling of an endpoint (AIMD).
+
+    Every successful request adds ``increase`` requests per second to the
+    rate, up to ``max_rate``, and every throttled one (429 or 503)
+    multiplies it by ``decrease``, down to ``min_rate``. So the callers
+    sharing the limiter settle just under the real limit of the endpoint
+    instead of a guess. A throttled response also empties the bucket for
+    its ``Retry-After``, which makes every caller wait, not only the one
+    that was throttled.
+    """
+
+    def __init__(
+        self,
+        max_rate: float,
+        min_rate: Optional[float] = None,
+        increase: Optional[float] = None,
+        decrease: float = 0.5,
+        capacity: Optional[float] = None,
+    ) -> None:
+        super().__init__(max_rate, capacity)
+        self.max_rate = max_rate
+        self.min_rate = min_rate if min_rate is not None else max_rate / 20
+        self.increase = increase if increase is not None else max_rate / 20
+        self.decrease = decrease
+        self.queued = 0
+        self.throttled = 0
+
+    def acquire(self, tokens: float = 1, timeout: Optional[float] = None) -> bool:
+        with self._lock:
+            self.queued += 1
+        try:
+            return super().acquire(tokens, timeout)
+        finally:
+            with self._lock:
+                self.queued -= 1
+
+    def success(self) -> None:
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttle(self, delay: float = 0) -> None:
+        """Slow down after a throttled response, ``delay`` is its Retry-After."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.throttled += 1
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            # The next token is available ``delay`` seconds from now
+            self.tokens = min(self.tokens, 1 - delay * self.rate)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            **super().stats(),
+            "rate": round(self.rate, 3),
+            "queued": self.queued,
+            "throttled": self.throttled,
+        }
+
+
+def retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """Seconds to wait given by a ``Retry-After`` header, in seconds or as a date."""
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt: int, base: float = 1, cap: float = 60) -> float:
+    """Exponential backoff with full jitter for the ``attempt``-th retry (from 0)."""
+    return random.uniform(0, min(cap, base * 2**attempt))
@@ -0,0 +1,143 @@
+"""Token-compact rendering of tool results for the agent prompt.
+
+SPARQL JSON results and item documents are turned into short text tables
+before they become observations: entity and property URIs are written as
+prefixed names (``wd:Q42``, ``wdt:P31``), duplicate rows and values are
+dropped and columns holding a single value are stated once.
+"""
+
+import logging
+import re
+import threading
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_encoding = None
+_XSD = "http://www.w3.org/2001/XMLSchema#"
+
+
+def count_tokens(text: str) -> int:
+    """Count tokens with tiktoken, or estimate them when it is missing."""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def wikibase_prefixes(wb_url: str) -> Dict[str, str]:
+    """Prefixes the query service of the Wikibase at ``wb_url`` predefines for its entities."""
+    return {
+        "wd": f"{wb_url}/entity/",
+        "wds": f"{wb_url}/entity/statement/",
+        "wdv": f"{wb_url}/value/",
+        "wdref": f"{wb_url}/reference/",
+        "wdata": f"{wb_url}/wiki/Special:EntityData/",
+        "wdt": f"{wb_url}/prop/direct/",
+        "wdtn": f"{wb_url}/prop/direct-normalized/",
+        "wdno": f"{wb_url}/prop/novalue/",
+        "p": f"{wb_url}/prop/",
+        "ps": f"{wb_url}/prop/statement/",
+        "psv": f"{wb_url}/prop/statement/value/",
+        "psn": f"{wb_url}/prop/statement/value-normalized/",
+        "pq": f"{wb_url}/prop/qualifier/",
+        "pqv": f"{wb_url}/prop/qualifier/value/",
+        "pqn": f"{wb_url}/prop/qualifier/value-normalized/",
+        "pr": f"{wb_url}/prop/reference/",
+        "prv": f"{wb_url}/prop/reference/value/",
+        "prn": f"{wb_url}/prop/reference/value-normalized/",
+    }
+
+
+class Renderer:
+    """Renders tool results and keeps count of the tokens it saves."""
+
+    def __init__(self, prefixes: Dict[str, str]) -> None:
+        # Longest namespaces first, so wdt: wins over a shorter p: match
+        self.namespaces = sorted(
+            ((namespace, prefix) for prefix, namespace in prefixes.items()),
+            key=lambda item: len(item[0]),
+            reverse=True,
+        )
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self._lock = threading.Lock()
+
+    def shorten(self, uri: str) -> str:
+        for namespace, prefix in self.namespaces:
+            if uri.startswith(namespace):
+                return f"{prefix}:{uri[len(namespace):]}"
+        return uri
+
+    def value(self, binding: Optional[Dict[str, Any]]) -> str:
+        if binding is None:
+            return ""
+        value = binding.get("value", "")
+        if binding.get("type") == "uri":
+            return self.shorten(value)
+        if binding.get("datatype") == _XSD + "dateTime":
+            return value[:-len("T00:00:00Z")] if value.endswith("T00:00:00Z") else value
+        return value
+
+    def _record(self, name: str, before: str, after: str) -> None:
+        tokens_before, tokens_after = count_tokens(before), count_tokens(after)
+        with self._lock:
+            self.tokens_before += tokens_before
+            self.tokens_after += tokens_after
+        logger.info(f"{name} observation: {tokens_before} -> {tokens_after} tokens")
+
+    def sparql_results(self, results: Any) -> str:
+        """Render a SPARQL JSON result as a compact table."""
+        if not isinstance(results, dict) or "results" not in results:
+            return str(results)
+        variables: List[str] = results.get("head", {}).get("vars", [])
+        rows = []
+        seen = set()
+        for binding in results["results"]["bindings"]:
+            row = tuple(self.value(binding.get(var)) for var in variables)
+            if row not in seen:
+                seen.add(row)
+                rows.append(row)
+
+        lines = []
+        columns = list(range(len(variables)))
+        if len(rows) > 1:
+            constant = [i for i in columns if len({row[i] for row in rows}) == 1]
+            for i in constant:
+                lines.append(f"{variables[i]} = {rows[0][i]} (in every row)")
+            columns = [i for i in columns if i not in constant]
+        if columns:
+            lines.append(" | ".join(variables[i] for i in columns))
+            lines.extend(" | ".join(row[i] for i in columns) for row in rows)
+        lines.append(f"({len(rows)} rows)")
+        if results.get("truncated"):
+            lines.append(str(results["truncated"]))
+
+        rendered = "\n".join(lines)
+        self._record("SPARQL", str(results), rendered)
+        return rendered
+
+    def document(self, text: str) -> str:
+        """Shorten URIs and drop empty lines in an item document.
+
+        Repeated values are dropped when the statements are built, a
+        rendered line cannot be split back into its values.
+        """
+        lines = []
+        for line in str(text).splitlines():
+            line = re.sub(r"https?://\S+", lambda m: self.shorten(m.group(0)), line)
+            if line.strip():
+                lines.append(line)
+        rendered = "\n".join(lines)
+        self._record("Item", str(text), rendered)
+        return rendered
+
+    def stats(self) -> Dict[str, int]:
+        return {"tokens_before": self.tokens_before, "tokens_after": self.tokens_after}
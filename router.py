@@ -0,0 +1,106 @@
+"""Fast path for descriptive questions, answered without the ReAct loop.
+
+Questions like "What is Google?" or "Who is Albert Einstein?" only need
+the document of one entity (step 1 of ``prompts/gemini.prompt``). They are
+recognized with a few patterns, the entity is looked up and retrieved
+directly and the answer is written by a single LLM call. Anything else, or
+a name that does not match an entity label or alias exactly, goes to the
+agent.
+"""
+
+import re
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+_DESCRIPTIVE_RES = [
+    re.compile(p, re.IGNORECASE)
+    for p in (
+        r"^(?:what|who)\s+(?:is|are|was|were)\s+(?P<name>.+?)$",
+        r"^(?:tell\s+me|what\s+do\s+you\s+know)\s+about\s+(?P<name>.+?)$",
+        r"^(?:describe|define)\s+(?P<name>.+?)$",
+    )
+]
+_ARTICLE_RE = re.compile(r"^(?:the|a|an)\s+", re.IGNORECASE)
+# A name with these words asks about a relation or a value, not an entity
+_RELATION_RE = re.compile(
+    r"\b(?:of|in|on|for|from|by|with|between|than|when|where|which|how|many|much|date|number)\b|'s\b",
+    re.IGNORECASE,
+)
+MAX_NAME_WORDS = 6
+
+SYSTEM_PROMPT = """Answer the question using only the Wikibase information given with it, never use prior knowledge or your training data.
+Highlight the 'instance of' field of the entity.
+Write the answer using natural language with at least 300 words."""
+
+
+def descriptive_name(question: str) -> Optional[str]:
+    """Return the name asked about by a descriptive question, None for other questions."""
+    question = question.strip().rstrip("?!. ").strip()
+    for pattern in _DESCRIPTIVE_RES:
+        match = pattern.match(question)
+        if match:
+            name = _ARTICLE_RE.sub("", match.group("name").strip(" \"'"))
+            if name and len(name.split()) <= MAX_NAME_WORDS and not _RELATION_RE.search(name):
+                return name
+            return None
+    return None
+
+
+def _matches(result: Dict[str, Any], name: str) -> bool:
+    names = {result.get("label"), (result.get("match") or {}).get("text"), *result.get("aliases", [])}
+    return name.casefold() in {str(n).casefold() for n in names if n}
+
+
+class Route(NamedTuple):
+    """A question answered by the fast path: the entity and its document."""
+
+    question: str
+    qid: str
+    document: str
+
+    def messages(self, history: Sequence[BaseMessage] = ()) -> List[BaseMessage]:
+        return [
+            SystemMessage(content=SYSTEM_PROMPT),
+            *history,
+            HumanMessage(
+                content=f"Question: {self.question}\n\nWikibase information about {self.qid}:\n{self.document}"
+            ),
+        ]
+
+
+class Router:
+    """Decides whether a question can skip the agent.
+
+    ``search(name)`` returns wbsearchentities-like results for an item name
+    and ``retrieve(qid, config)`` the document of the item, or an empty
+    string when there is none.
+    """
+
+    def __init__(
+        self,
+        search: Callable[[str], List[Dict[str, Any]]],
+        retrieve: Callable[[str, Optional[Dict]], str],
+        empty_markers: Sequence[str] = ("No good Wikidata Search Result",),
+    ) -> None:
+        self.search = search
+        self.retrieve = retrieve
+        self.empty_markers = tuple(empty_markers)
+        self.routed = 0
+        self.fallbacks = 0
+
+    def route(self, question: str, config: Optional[Dict] = None) -> Optional[Route]:
+        """Return the fast path of the question, or None when the agent must answer it."""
+        name = descriptive_name(question)
+        if name is None:
+            return None
+        results = [result for result in self.search(name) if _matches(result, name)]
+        document = str(self.retrieve(results[0]["id"], config)) if results else ""
+        if not document.strip() or any(marker in document for marker in self.empty_markers):
+            self.fallbacks += 1
+            return None
+        self.routed += 1
+        return Route(question, results[0]["id"], document)
+
+    def stats(self) -> Dict[str, int]:
+        return {"routed": self.routed, "fallbacks": self.fallbacks}
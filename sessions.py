@@ -0,0 +1,111 @@
+"""Per-session chat state for concurrent users of the UI."""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional
+
+
+class _Entry:
+    __slots__ = ("value", "lock", "last_used")
+
+    def __init__(self, value: Any) -> None:
+        self.value = value
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+
+
+class SessionStore:
+    """Bounded store of per-session state built on demand by ``factory``.
+
+    Sessions idle for more than ``idle_timeout`` seconds are dropped, and
+    the least recently used ones are evicted when there are more than
+    ``max_sessions`` of them or when their estimated size, given by
+    ``sizeof``, goes over ``max_bytes``.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[str], Any],
+        max_sessions: int = 100,
+        idle_timeout: float = 1800,
+        max_bytes: Optional[int] = None,
+        sizeof: Callable[[Any], int] = lambda value: 0,
+    ) -> None:
+        self.factory = factory
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.evictions = 0
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry(self, session_id: str) -> _Entry:
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                entry = _Entry(self.factory(session_id))
+                self._entries[session_id] = entry
+            entry.last_used = time.time()
+            self._entries.move_to_end(session_id)
+            self._evict(keep=session_id)
+            return entry
+
+    def _evict(self, keep: str) -> None:
+        now = time.time()
+        for session_id, entry in list(self._entries.items()):
+            if session_id != keep and now - entry.last_used > self.idle_timeout:
+                del self._entries[session_id]
+                self.evictions += 1
+        while len(self._entries) > max(self.max_sessions, 1):
+            self._pop_oldest(keep)
+        if self.max_bytes:
+            while len(self._entries) > 1 and self.size() > self.max_bytes:
+                self._pop_oldest(keep)
+
+    def _pop_oldest(self, keep: str) -> None:
+        session_id = next(iter(self._entries))
+        if session_id == keep:
+            self._entries.move_to_end(keep)
+            session_id = next(iter(self._entries))
+        del self._entries[session_id]
+        self.evictions += 1
+
+    def get(self, session_id: str) -> Any:
+        """Return the state of the session, creating it when needed."""
+        return self._entry(session_id).value
+
+    @contextmanager
+    def session(self, session_id: str) -> Iterator[Any]:
+        """Hold the session for one request, so its turns do not interleave."""
+        entry = self._entry(session_id)
+        with entry.lock:
+            yield entry.value
+
+    @asynccontextmanager
+    async def asession(self, session_id: str) -> AsyncIterator[Any]:
+        """Async version of ``session``, waiting without blocking the loop."""
+        entry = self._entry(session_id)
+        acquire = asyncio.get_running_loop().run_in_executor(None, entry.lock.acquire)
+        try:
+            await asyncio.shield(acquire)
+        except asyncio.CancelledError:
+            # Give the lock back once the pending acquire completes
+            acquire.add_done_callback(lambda _: entry.lock.release())
+            raise
+        try:
+            yield entry.value
+        finally:
+            entry.lock.release()
+
+    def size(self) -> int:
+        return sum(self.sizeof(entry.value) for entry in self._entries.values())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        return {"sessions": len(self._entries), "evictions": self.evictions}
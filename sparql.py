@@ -0,0 +1,378 @@
+"""SPARQL query helpers shared by the Wikibase tools."""
+
+import codecs
+import json
+import os
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from cache import LRUCache, MISSING, make_key
+
+_LIMIT_RE = re.compile(r"\bLIMIT\s*(\d+)\s*$", re.IGNORECASE)
+
+# Prefixes predefined by the Wikibase query service besides the ones of its entities
+# (render.wikibase_prefixes), also declared when used
+STANDARD_PREFIXES = {
+    "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+    "rdfs": "http://www.w3.org/2000/01/rdf-schema#",
+    "xsd": "http://www.w3.org/2001/XMLSchema#",
+    "owl": "http://www.w3.org/2002/07/owl#",
+    "skos": "http://www.w3.org/2004/02/skos/core#",
+    "schema": "http://schema.org/",
+    "prov": "http://www.w3.org/ns/prov#",
+    "geo": "http://www.opengis.net/ont/geosparql#",
+    "geof": "http://www.opengis.net/def/function/geosparql/",
+    "dct": "http://purl.org/dc/terms/",
+    "cc": "http://creativecommons.org/ns#",
+    "ontolex": "http://www.w3.org/ns/lemon/ontolex#",
+    "wikibase": "http://wikiba.se/ontology#",
+    "bd": "http://www.bigdata.com/rdf#",
+    "bds": "http://www.bigdata.com/rdf/search#",
+    "gas": "http://www.bigdata.com/rdf/gas#",
+    "hint": "http://www.bigdata.com/queryHints#",
+    "mwapi": "https://www.mediawiki.org/ontology#API/",
+}
+
+QUERY_FORMS = ("SELECT", "ASK", "CONSTRUCT", "DESCRIBE")
+
+_FENCE_RE = re.compile(r"^```[\w-]*[ \t]*\n?(.*?)\n?```$", re.DOTALL)
+_PROLOGUE_RE = re.compile(
+    r"\s*(?:PREFIX\s+([A-Za-z][\w.-]*)?\s*:\s*<_*>|BASE\s+<_*>)", re.IGNORECASE
+)
+_PREFIXED_NAME_RE = re.compile(r"(?<![\w?$:.-])([A-Za-z][\w-]*(?:\.[\w-]+)*):")
+_LIMIT_CLAUSE_RE = re.compile(r"\bLIMIT\s+(\d+)", re.IGNORECASE)
+_BRACKETS = {"}": "{", ")": "(", "]": "["}
+
+
+class SparqlSyntaxError(ValueError):
+    """A query that would be rejected by the endpoint, found before sending it."""
+
+
+def _scan(query: str):
+    """Yield (kind, text) chunks of the query.
+
+    ``kind`` is ``"literal"`` for string literals and IRIs, which must be
+    kept verbatim, ``"comment"`` for ``#`` comments and ``"code"`` for the
+    rest of the query.
+    """
+    i = 0
+    start = 0
+    n = len(query)
+    while i < n:
+        c = query[i]
+        if c in "\"'":
+            quote = query[i : i + 3] if query[i : i + 3] == c * 3 else c
+            end = i + len(quote)
+            while end < n and not query.startswith(quote, end):
+                end += 2 if query[end] == "\\" else 1
+            end = min(end + len(quote), n)
+        elif c == "<" and re.match(r"<[^\s<>\"{}|^`\\]*>", query[i:]):
+            end = query.index(">", i) + 1
+        elif c == "#":
+            end = query.find("\n", i)
+            end = n if end == -1 else end
+        else:
+            i += 1
+            continue
+        if start < i:
+            yield "code", query[start:i]
+        yield ("comment" if c == "#" else "literal"), query[i:end]
+        i = start = end
+    if start < n:
+        yield "code", query[start:]
+
+
+def normalize_query(query: str) -> str:
+    """Return a canonical form of the query to be used as a cache key.
+
+    Comments are dropped, whitespace outside literals and IRIs is collapsed
+    to single spaces and a trailing LIMIT clause is written as ``LIMIT n``.
+    """
+    parts = []
+    for kind, text in _scan(query):
+        if kind == "literal":
+            parts.append(text)
+            continue
+        text = " " if kind == "comment" else re.sub(r"\s+", " ", text)
+        if parts and parts[-1].endswith(" ") and text.startswith(" "):
+            text = text[1:]
+        if text:
+            parts.append(text)
+    normalized = "".join(parts).strip()
+    return _LIMIT_RE.sub(lambda m: f"LIMIT {m.group(1)}", normalized)
+
+
+def _position(query: str, index: int) -> str:
+    line = query.count("\n", 0, index) + 1
+    column = index - query.rfind("\n", 0, index)
+    return f"line {line}, column {column}"
+
+
+def _mask(query: str) -> str:
+    """Return the query with the inside of literals and IRIs blanked out.
+
+    Positions are kept, so matches in the masked query point into the
+    original one, but nothing in a literal, IRI or comment can be mistaken
+    for syntax.
+    """
+    parts = []
+    pos = 0
+    for kind, text in _scan(query):
+        if kind == "literal" and text[0] in "\"'":
+            quote = text[:3] if text[:3] == text[0] * 3 else text[0]
+            if len(text) < 2 * len(quote) or not text.endswith(quote):
+                raise SparqlSyntaxError(f"Unterminated string literal at {_position(query, pos)}")
+            text = quote + " " * (len(text) - 2 * len(quote)) + quote
+        elif kind == "literal":
+            text = "<" + "_" * (len(text) - 2) + ">"
+        elif kind == "comment":
+            text = " " * len(text)
+        parts.append(text)
+        pos += len(text)
+    return "".join(parts)
+
+
+def clean_query(query: str) -> str:
+    """Remove what the LLM tends to wrap around a query.
+
+    Markdown code fences, enclosing quotes or backticks and a leading
+    ``sparql`` word are dropped.
+    """
+    query = str(query).strip()
+    match = _FENCE_RE.match(query)
+    if match:
+        query = match.group(1).strip()
+    while len(query) >= 2 and query[0] == query[-1] and query[0] in "\"'`":
+        query = query[1:-1].strip()
+    return re.sub(r"^sparql\b\s*", "", query, flags=re.IGNORECASE)
+
+
+def _check_brackets(query: str, masked: str) -> List[int]:
+    """Return the nesting depth of ``{`` groups before each character."""
+    stack: List[Tuple[str, int]] = []
+    depths = []
+    depth = 0
+    for i, c in enumerate(masked):
+        depths.append(depth)
+        if c in "{([":
+            stack.append((c, i))
+            depth += c == "{"
+        elif c in "})]":
+            if not stack or stack[-1][0] != _BRACKETS[c]:
+                raise SparqlSyntaxError(f"Unexpected '{c}' at {_position(query, i)}")
+            stack.pop()
+            depth -= c == "}"
+    if stack:
+        c, i = stack[-1]
+        closing = {v: k for k, v in _BRACKETS.items()}[c]
+        raise SparqlSyntaxError(f"Missing '{closing}' for the '{c}' opened at {_position(query, i)}")
+    return depths
+
+
+def prepare_query(
+    query: str, prefixes: Optional[Dict[str, str]] = None, limit: Optional[int] = None
+) -> str:
+    """Validate and rewrite a query generated by the agent, before sending it.
+
+    The query is cleaned with ``clean_query`` and checked for unterminated
+    literals, unbalanced brackets, an unknown query form and prefixes that
+    are neither declared nor in ``prefixes`` or ``STANDARD_PREFIXES``,
+    raising ``SparqlSyntaxError`` with the position of the problem. The
+    used prefixes that are not declared are added in front, and the
+    outermost LIMIT is set to ``limit`` when it is missing or larger.
+    """
+    query = clean_query(query)
+    if not query:
+        raise SparqlSyntaxError("The query is empty")
+    masked = _mask(query)
+    depths = _check_brackets(query, masked)
+
+    declared = set()
+    pos = 0
+    while True:
+        match = _PROLOGUE_RE.match(masked, pos)
+        if match is None:
+            break
+        declared.add(match.group(1) or "")
+        pos = match.end()
+    word = re.match(r"\s*([A-Za-z]*)", masked[pos:]).group(1)
+    form = word.upper()
+    if form not in QUERY_FORMS:
+        raise SparqlSyntaxError(
+            f"The query must start with SELECT, ASK, CONSTRUCT or DESCRIBE after the prefixes, "
+            f"found {word or query[pos:].strip()[:20]!r}"
+        )
+
+    known = {**STANDARD_PREFIXES, **(prefixes or {})}
+    missing = {}
+    for match in _PREFIXED_NAME_RE.finditer(masked, pos):
+        name = match.group(1)
+        if name in declared or name in missing:
+            continue
+        if name not in known:
+            raise SparqlSyntaxError(
+                f"Undefined prefix '{name}:' at {_position(query, match.start())}, "
+                f"declare it with PREFIX {name}: <...>"
+            )
+        missing[name] = known[name]
+
+    if limit is not None and form != "ASK":
+        limits = [m for m in _LIMIT_CLAUSE_RE.finditer(masked, pos) if depths[m.start()] == 0]
+        if limits:
+            match = limits[-1]
+            if int(match.group(1)) > limit:
+                query = query[: match.start(1)] + str(limit) + query[match.end(1) :]
+        else:
+            # LIMIT goes before a trailing VALUES block, after the WHERE group
+            first_group = masked.find("{", pos)
+            end = len(query.rstrip())
+            if first_group != -1:
+                closed = next(
+                    (i for i in range(first_group + 1, len(masked)) if depths[i] == 0), len(masked)
+                )
+                values = [
+                    m.start()
+                    for m in re.finditer(r"\bVALUES\b", masked[closed:], re.IGNORECASE)
+                    if depths[closed + m.start()] == 0
+                ]
+                if values:
+                    end = closed + values[0]
+            query = f"{query[:end].rstrip()}\nLIMIT {limit}\n{query[end:]}".rstrip()
+
+    prologue = "".join(f"PREFIX {name}: <{iri}>\n" for name, iri in missing.items())
+    return prologue + query
+
+
+def parse_results(
+    chunks: Iterable[bytes],
+    max_rows: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Incrementally parse a SPARQL JSON result read in chunks.
+
+    Bindings are decoded one at a time as the bytes arrive, and reading
+    stops as soon as ``max_rows`` bindings were parsed or ``max_bytes``
+    were read, so a large result is neither fully downloaded nor fully
+    parsed. A ``truncated`` entry tells why and where the result was cut.
+    """
+    text = codecs.getincrementaldecoder("utf-8")()
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    head: Dict[str, Any] = {"vars": []}
+    rows = []
+    read = 0
+    in_bindings = False
+    truncated = None
+    finished = False
+
+    for chunk in chunks:
+        read += len(chunk)
+        buffer += text.decode(chunk)
+
+        if not in_bindings:
+            match = re.search(r'"bindings"\s*:\s*\[', buffer)
+            if match is None:
+                if max_bytes and read >= max_bytes:
+                    truncated = "bytes"
+                    break
+                continue
+            head_match = re.search(r'"head"\s*:\s*', buffer[: match.start()])
+            if head_match:
+                head = decoder.raw_decode(buffer, head_match.end())[0]
+            in_bindings = True
+            buffer = buffer[match.end() :]
+            pos = 0
+
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buffer):
+                break
+            if buffer[pos] == "]":
+                finished = True
+                break
+            if max_rows is not None and len(rows) >= max_rows:
+                truncated = "rows"
+                break
+            try:
+                row, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The binding continues in the next chunk
+                break
+            rows.append(row)
+        buffer = buffer[pos:]
+        pos = 0
+        if finished or truncated:
+            break
+        if max_bytes and read >= max_bytes:
+            truncated = "bytes"
+            break
+    else:
+        buffer += text.decode(b"", final=True)
+        if not in_bindings:
+            # ASK queries and empty responses have no bindings
+            return json.loads(buffer)
+        if not finished:
+            raise ValueError("Incomplete SPARQL JSON result")
+
+    results: Dict[str, Any] = {"head": head, "results": {"bindings": rows}}
+    if truncated:
+        results["truncated"] = {"reason": truncated, "rows": len(rows), "bytes": read}
+    return results
+
+
+def _parse_endpoint_ttls(value: Optional[str]) -> Dict[str, float]:
+    """Parse ``url=seconds,url=seconds`` into a dictionary."""
+    ttls = {}
+    for item in (value or "").split(","):
+        url, sep, seconds = item.strip().rpartition("=")
+        if sep and url:
+            ttls[url.strip()] = float(seconds)
+    return ttls
+
+
+class SparqlCache:
+    """Bounded cache of SPARQL results keyed on the normalized query.
+
+    Entries are evicted by LRU once the cache holds more than ``max_bytes``
+    of serialized results. Each endpoint can have its own TTL, so a
+    frequently edited local Wikibase can expire faster than Wikidata.
+    Results of different shapes for the same query, like the parsed and
+    truncated results of ``runSparql`` and the raw JSON of
+    ``runSparqlQuery``, are kept apart by their ``kind``.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl: float = 3600,
+        endpoint_ttls: Optional[Dict[str, float]] = None,
+    ) -> None:
+        self.ttl = ttl
+        self.endpoint_ttls = endpoint_ttls or {}
+        self.results = LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+
+    @classmethod
+    def from_env(cls) -> "SparqlCache":
+        return cls(
+            max_entries=int(os.getenv("SPARQL_CACHE_MAX_SIZE", 1000)),
+            max_bytes=int(os.getenv("SPARQL_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+            ttl=float(os.getenv("SPARQL_CACHE_TTL", 3600)),
+            endpoint_ttls=_parse_endpoint_ttls(os.getenv("SPARQL_CACHE_ENDPOINT_TTLS")),
+        )
+
+    def _key(self, endpoint: str, query: str, kind: str) -> str:
+        return make_key(kind, endpoint, normalize_query(query))
+
+    def get(self, endpoint: str, query: str, default: Any = MISSING, kind: str = "parsed") -> Any:
+        return self.results.get(self._key(endpoint, query, kind), default)
+
+    def set(self, endpoint: str, query: str, results: Any, kind: str = "parsed") -> None:
+        ttl = self.endpoint_ttls.get(endpoint, self.ttl)
+        if ttl > 0:
+            self.results.set(self._key(endpoint, query, kind), results, ttl=ttl)
+
+    def stats(self) -> Dict[str, Any]:
+        return self.results.stats()
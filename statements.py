@@ -0,0 +1,187 @@
+"""Selection of the statements shown in an item document.
+
+A large item, like a country or a company, has hundreds of statements and
+most of them are identifiers or lists unrelated to the question. Instead of
+rendering all of them and cutting the document at a number of characters,
+the statements are ranked by their relevance to the current question and
+by the global importance of their property, and the best ones are kept
+until a token budget is spent. The document ends with the number of
+properties left out, so the agent knows there is more to ask for.
+
+The importance of the properties can be read from a JSON file mapping
+property ids to scores, e.g. computed from their usage on the Wikibase.
+Properties missing from it are scored from their datatype.
+"""
+
+import json
+import logging
+import re
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence, Set
+
+from langchain_core.runnables.config import ensure_config
+
+from render import count_tokens
+
+logger = logging.getLogger(__name__)
+
+_question: ContextVar[Optional[str]] = ContextVar("question", default=None)
+
+# Importance of the properties missing from the importance file
+DATATYPE_IMPORTANCE = {
+    "wikibase-item": 0.6,
+    "time": 0.6,
+    "quantity": 0.5,
+    "monolingualtext": 0.5,
+    "globe-coordinate": 0.4,
+    "string": 0.3,
+    "url": 0.2,
+    "commonsMedia": 0.1,
+    "external-id": 0.05,
+}
+DEFAULT_IMPORTANCE = 0.3
+# Always shown first, the prompts ask the agent to highlight them
+ESSENTIAL_LABELS = {"instance of", "subclass of"}
+# Weight of a question term found in the statement, against an importance of at most 1
+RELEVANCE_WEIGHT = 2.0
+# Names of left out properties listed at the end of the document
+MAX_OMITTED_NAMES = 20
+# A statement is cut to its first values when at least this many tokens are left
+MIN_PARTIAL_TOKENS = 20
+
+_WORD_RE = re.compile(r"\w+")
+_STOPWORDS = set(
+    "the and for are was were what who whom which when where how many much does did has have had "
+    "with from that this its his her their there about into tell give list all".split()
+)
+
+
+@contextmanager
+def asking(question: Optional[str]) -> Iterator[None]:
+    """Documents built inside the block are selected for ``question``."""
+    token = _question.set(question)
+    try:
+        yield
+    finally:
+        _question.reset(token)
+
+
+def current_question() -> Optional[str]:
+    """Question set by ``asking``, or the ``question`` of the LangChain run config."""
+    question = _question.get()
+    if question is None:
+        question = ensure_config().get("configurable", {}).get("question")
+    return question
+
+
+def load_importance(path: Optional[str]) -> Dict[str, float]:
+    """Read a ``{"P31": score, ...}`` JSON file, scores are scaled to at most 1."""
+    if not path:
+        return {}
+    try:
+        with open(path) as f:
+            scores = {pid: float(score) for pid, score in json.load(f).items()}
+    except (OSError, ValueError, AttributeError) as e:
+        logger.warning(f"Could not read the property importance from {path}: {e}")
+        return {}
+    top = max(scores.values(), default=0)
+    return {pid: score / top for pid, score in scores.items()} if top > 0 else {}
+
+
+def _terms(text: str) -> Set[str]:
+    # The first 5 letters stand for a stem: founded, founder and foundation match
+    return {
+        word[:5]
+        for word in _WORD_RE.findall(text.casefold())
+        if len(word) > 2 and word not in _STOPWORDS
+    }
+
+
+class Statement(NamedTuple):
+    """The values of one property of an item, rendered."""
+
+    pid: Optional[str]
+    label: str
+    values: List[str]
+    datatype: Optional[str] = None
+
+    def line(self, values: Optional[Sequence[str]] = None) -> str:
+        return f"{self.label}: {', '.join(self.values if values is None else values)}"
+
+
+def score(statement: Statement, terms: Set[str], importance: Dict[str, float]) -> float:
+    """Rank of a statement, higher is better."""
+    if statement.label.casefold() in ESSENTIAL_LABELS:
+        return float("inf")
+    value = importance.get(statement.pid)
+    if value is None:
+        value = DATATYPE_IMPORTANCE.get(statement.datatype, DEFAULT_IMPORTANCE)
+    if terms:
+        # Terms of the question in the property label count twice as much as in the values
+        label_terms = _terms(statement.label)
+        value_terms = _terms(" ".join(statement.values))
+        matches = 2 * len(terms & label_terms) + len(terms & value_terms - label_terms)
+        value += RELEVANCE_WEIGHT * matches / len(terms)
+    return value
+
+
+def _omitted_line(omitted: List[Statement]) -> str:
+    values = sum(len(statement.values) for statement in omitted)
+    names = ", ".join(f"{s.label} ({len(s.values)})" for s in omitted[:MAX_OMITTED_NAMES])
+    if len(omitted) > MAX_OMITTED_NAMES:
+        names += ", ..."
+    return f"Not shown: {len(omitted)} more properties with {values} values: {names}"
+
+
+def _first_values(statement: Statement, budget: int) -> Optional[str]:
+    """Line of a long statement cut to the values fitting in ``budget`` tokens."""
+    # Room for the label and the count of the values left out
+    used = count_tokens(statement.line([f"(+{len(statement.values)} more)"]))
+    values: List[str] = []
+    for value in statement.values:
+        used += count_tokens(value) + 1
+        if used > budget:
+            break
+        values.append(value)
+    if not values:
+        return None
+    return statement.line([*values, f"(+{len(statement.values) - len(values)} more)"])
+
+
+def select(
+    statements: Sequence[Statement],
+    question: Optional[str] = None,
+    budget: int = 0,
+    importance: Optional[Dict[str, float]] = None,
+) -> List[str]:
+    """Lines of the best statements fitting in ``budget`` tokens, best first.
+
+    A last line counts the properties left out. With no budget every
+    statement is kept, in its order.
+    """
+    if budget <= 0:
+        return [statement.line() for statement in statements]
+    terms = _terms(question or "")
+    importance = importance or {}
+    ranked = sorted(statements, key=lambda s: score(s, terms, importance), reverse=True)
+    lines: List[str] = []
+    omitted: List[Statement] = []
+    left = budget
+    for statement in ranked:
+        line = statement.line()
+        tokens = count_tokens(line)
+        if tokens <= left:
+            lines.append(line)
+            left -= tokens
+            continue
+        if left >= MIN_PARTIAL_TOKENS and len(statement.values) > 1:
+            line = _first_values(statement, left)
+            if line:
+                lines.append(line)
+                left -= count_tokens(line)
+                continue
+        omitted.append(statement)
+    if omitted:
+        lines.append(_omitted_line(omitted))
+    return lines
@@ -0,0 +1,93 @@
+import time
+
+from cache import MISSING, DiskCache, LRUCache, TieredCache, make_key
+
+
+def test_make_key_is_stable():
+    assert make_key("Q42", "en") == make_key("Q42", "en")
+    assert make_key("Q42", "en") != make_key("Q42", "fr")
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is MISSING
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["hits"] == 3
+    assert cache.stats()["misses"] == 1
+
+
+def test_lru_cache_expires_entries(monkeypatch):
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    cache = LRUCache(ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=30)
+    monkeypatch.setattr(time, "time", lambda: now + 20)
+    assert cache.get("a", None) is None
+    assert cache.get("b") == 2
+    assert len(cache) == 1
+
+
+def test_lru_cache_bounds_bytes():
+    cache = LRUCache(max_bytes=10)
+    cache.set("a", "xxx")
+    cache.set("b", "yyy")
+    assert cache.bytes == 10
+    cache.set("c", "zzz")
+    assert cache.get("a") is MISSING
+    assert cache.bytes == 10
+    # Values larger than the cache are not stored
+    cache.set("d", "x" * 20)
+    assert cache.get("d") is MISSING
+    assert cache.get("c") == "zzz"
+
+
+def test_disk_cache_survives_reopening(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    DiskCache(path).set("Q42", {"label": "Douglas Adams"})
+    assert DiskCache(path).get("Q42") == {"label": "Douglas Adams"}
+
+
+def test_disk_cache_expires_and_evicts(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache.sqlite"), max_entries=2)
+    cache.set("old", 1, ttl=-1)
+    assert cache.get("old") is MISSING
+    for key in ("a", "b", "c"):
+        cache.set(key, key)
+        time.sleep(0.01)
+    assert len(cache) == 2
+    assert cache.get("a") is MISSING
+
+
+def test_disk_cache_bounds_bytes(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache.sqlite"), max_bytes=20)
+    for key in ("a", "b", "c"):
+        cache.set(key, "x" * 6)
+        time.sleep(0.01)
+    # Each value takes 8 bytes as JSON
+    assert cache.get("a") is MISSING
+    assert cache.get("b") == "x" * 6
+    assert cache.get("c") == "x" * 6
+
+
+def test_tiered_cache_promotes_disk_hits(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    TieredCache(path=path).set("Q42", "Douglas Adams")
+    cache = TieredCache(path=path)
+    assert cache.get("Q42") == "Douglas Adams"
+    assert cache.get("Q42") == "Douglas Adams"
+    assert cache.get("Q1") is MISSING
+    stats = cache.stats()
+    assert (stats["disk_hits"], stats["memory_hits"], stats["misses"]) == (1, 1, 1)
+
+
+def test_tiered_cache_without_disk():
+    cache = TieredCache()
+    cache.set("Q42", "Douglas Adams")
+    assert cache.disk is None
+    assert cache.get("Q42") == "Douglas Adams"
@@ -0,0 +1,59 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from coalesce import SingleFlight
+
+
+def _concurrent(flight, fn, callers=4):
+    """Call ``flight.do`` from several threads while the first call is blocked."""
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocked():
+        started.set()
+        release.wait(5)
+        return fn()
+
+    with ThreadPoolExecutor(callers) as pool:
+        futures = [pool.submit(flight.do, "Q42", blocked)]
+        started.wait(5)
+        futures += [pool.submit(flight.do, "Q42", blocked) for _ in range(callers - 1)]
+        while flight.shared < callers - 1:
+            threading.Event().wait(0.001)
+        release.set()
+    return futures
+
+
+def test_concurrent_calls_share_one_call():
+    flight = SingleFlight()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return "Douglas Adams"
+
+    futures = _concurrent(flight, fetch)
+    assert [future.result() for future in futures] == ["Douglas Adams"] * 4
+    assert len(calls) == 1
+    assert flight.stats() == {"hits": 3, "misses": 1, "in_flight": 0}
+
+
+def test_concurrent_calls_share_the_exception():
+    flight = SingleFlight()
+
+    def fetch():
+        raise LookupError("Q42")
+
+    for future in _concurrent(flight, fetch):
+        with pytest.raises(LookupError):
+            future.result()
+
+
+def test_results_are_not_kept():
+    flight = SingleFlight()
+    assert flight.do("Q42", lambda: 1) == 1
+    assert flight.do("Q42", lambda: 2) == 2
+    assert flight.do("Q1", lambda value: value, 3) == 3
+    assert flight.stats()["hits"] == 0
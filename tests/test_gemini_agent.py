@@ -0,0 +1,221 @@
+import asyncio
+import importlib
+import json
+import os
+import re
+import time
+from typing import List
+
+import pytest
+import requests
+from dotenv import dotenv_values
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.tools import tool
+
+import transport
+from cache import MISSING, TieredCache, make_key
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def gemini_agent():
+    """gemini_agent configured from template.env, without the background services."""
+    with pytest.MonkeyPatch.context() as mp:
+        for name, value in dotenv_values(os.path.join(ROOT, "template.env")).items():
+            if name not in os.environ:
+                mp.setenv(name, value or "")
+        for name, value in {
+            "LLM_CACHE": "false",
+            "PROPERTY_CATALOG": "false",
+            "ENTITY_CACHE_PATH": "",
+            "ENTITY_INDEX_PATH": "",
+            "PREFETCH": "false",
+        }.items():
+            mp.setenv(name, value)
+        yield importlib.import_module("gemini_agent")
+
+
+@pytest.fixture
+def offline_mediawikiapi(monkeypatch):
+    # mediawikiapi downloads the list of the Wikipedia languages on first use
+    from mediawikiapi.language import Language
+
+    monkeypatch.setattr(Language, "predefined_languages", {"en": "English"})
+
+
+def test_wikidata_tool_uses_the_shared_transport(gemini_agent, offline_mediawikiapi):
+    from langchain_community.utilities import wikidata
+
+    api_wrapper = gemini_agent.getWikidataTool().api_wrapper
+    assert api_wrapper.wikidata_mw.session.session is transport.get_session()
+    assert api_wrapper.wikidata_rest.get_httpx_client() is transport.get_httpx_client(
+        wikidata.WIKIDATA_REST_API_URL
+    )
+
+
+class _ToolCallingModel(BaseChatModel):
+    """Chat model streaming the given messages, one per call."""
+
+    responses: List[AIMessage]
+
+    @property
+    def _llm_type(self) -> str:
+        return "tool-calling-fake"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return ChatResult(generations=[ChatGeneration(message=self.responses.pop(0))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        message = self.responses.pop(0)
+        for token in re.split(r"(\s)", message.content):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+        for index, call in enumerate(message.tool_calls):
+            chunk = {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"]}
+            yield ChatGenerationChunk(
+                message=AIMessageChunk(content="", tool_call_chunks=[{**chunk, "index": index}])
+            )
+
+
+@tool
+def getQItem(name: str) -> str:
+    """Returns the Q item."""
+    return "Q95"
+
+
+async def _stream(gemini_agent, question):
+    outputs = []
+    async for output in gemini_agent.agent_chat_stream(
+        question, gemini_agent.get_agent_with_chat_history(), session_id="stream-test"
+    ):
+        outputs.append(output)
+    return outputs
+
+
+def test_stream_shows_the_answer_of_the_tool_calling_agent(gemini_agent, monkeypatch):
+    import tool_agent
+
+    answer = "Google was founded in 1998. " * 120
+    llm = _ToolCallingModel(
+        responses=[
+            AIMessage(
+                content="Looking up Google.",
+                tool_calls=[{"name": "getQItem", "args": {"name": "Google"}, "id": "call-1"}],
+            ),
+            AIMessage(content=answer),
+        ]
+    )
+    prompt = tool_agent.load_tools_prompt(os.path.join(ROOT, "prompts", "gemini_tools.prompt"))
+    executor = tool_agent.build_tool_calling_executor(llm, [getQItem], prompt)
+    monkeypatch.setattr(gemini_agent, "ROUTER", False)
+    # The chat history summarizes with the same model
+    monkeypatch.setitem(gemini_agent._lazy, "llm", llm)
+    monkeypatch.setitem(gemini_agent._lazy, "agent_executor", executor)
+    monkeypatch.delitem(gemini_agent._lazy, "agent_with_chat_history", raising=False)
+
+    outputs = asyncio.run(_stream(gemini_agent, "When was Google founded?"))
+
+    steps, _, shown = outputs[-1].partition("</details>\n\n")
+    assert shown.strip() == answer.strip()
+    assert "**Thought:** Looking up Google." in steps
+    assert "**Observation from getQItem:** Q95" in steps
+    assert "Google was founded" not in steps
+
+
+class _SparqlResponse:
+    def __init__(self, status_code, text="", results=None):
+        self.status_code = status_code
+        self.text = text
+        self.results = results
+        self.closed = False
+
+    def json(self):
+        return self.results
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.mark.parametrize(
+    "response, expected",
+    [
+        (_SparqlResponse(429), "busy"),
+        (_SparqlResponse(503), "busy"),
+        (_SparqlResponse(500, "java.util.concurrent.TimeoutException\n"), "timed out"),
+        (
+            _SparqlResponse(400, "MalformedQueryException: Encountered \" \"}\"\n"),
+            "Query is not working: Encountered",
+        ),
+        (_SparqlResponse(502, "Bad Gateway"), "Query is not working (HTTP 502)"),
+    ],
+)
+def test_run_sparql_query_reports_errors(gemini_agent, monkeypatch, response, expected):
+    monkeypatch.setattr(gemini_agent, "performSparqlQuery", lambda query: response)
+    query = f"SELECT ?x WHERE {{ ?x ?p {response.status_code} }}"
+    assert expected in gemini_agent.runSparqlQuery.invoke(query)
+    assert response.closed
+    # Errors are not cached, the next call sends the query again
+    success = _SparqlResponse(200, results={})
+    monkeypatch.setattr(gemini_agent, "performSparqlQuery", lambda query: success)
+    assert gemini_agent.runSparqlQuery.invoke(query) == {}
+
+
+def test_run_sparql_query_reports_read_timeouts(gemini_agent, monkeypatch):
+    def timeout(query):
+        raise requests.ReadTimeout("read timed out")
+
+    monkeypatch.setattr(gemini_agent, "performSparqlQuery", timeout)
+    message = gemini_agent.runSparqlQuery.invoke("SELECT ?x WHERE { ?x ?p ?o }")
+    assert message == gemini_agent.SPARQL_TIMEOUT_MESSAGE
+
+
+@pytest.fixture
+def search(gemini_agent, monkeypatch, tmp_path):
+    """Counts the wbsearchentities calls, which find only Google."""
+    calls = []
+
+    def search(data, **kwargs):
+        calls.append(data["search"])
+        return {"search": [{"id": "Q95"}] if data["search"] == "Google" else []}
+
+    monkeypatch.setattr(gemini_agent.wbi_helpers, "mediawiki_api_call_helper", search)
+    monkeypatch.setattr(
+        gemini_agent, "entity_cache", TieredCache(ttl=86400, path=str(tmp_path / "entities.sqlite"))
+    )
+    return calls
+
+
+def test_search_results_are_cached(gemini_agent, search, monkeypatch):
+    now = time.time()
+    assert gemini_agent.searchEntities("Google", "item") == [{"id": "Q95"}]
+    monkeypatch.setattr(time, "time", lambda: now + 3600)
+    assert gemini_agent.searchEntities("Google", "item") == [{"id": "Q95"}]
+    assert search == ["Google"]
+
+
+def test_empty_search_results_are_cached_briefly(gemini_agent, search, monkeypatch):
+    monkeypatch.setattr(gemini_agent, "ENTITY_NEGATIVE_TTL", 300)
+    now = time.time()
+    assert gemini_agent.searchEntities("Gogle", "item") == []
+    assert gemini_agent.searchEntities("Gogle", "item") == []
+    assert search == ["Gogle"]
+    monkeypatch.setattr(time, "time", lambda: now + 301)
+    # The disk tier, read after a restart, expires them too
+    key = make_key("Gogle", "item", gemini_agent.WB_LANGUAGE)
+    assert gemini_agent.entity_cache.disk.get(key) is MISSING
+    assert gemini_agent.searchEntities("Gogle", "item") == []
+    assert search == ["Gogle", "Gogle"]
+
+
+def test_empty_search_results_are_not_cached_without_negative_ttl(
+    gemini_agent, search, monkeypatch
+):
+    monkeypatch.setattr(gemini_agent, "ENTITY_NEGATIVE_TTL", 0)
+    gemini_agent.searchEntities("Gogle", "item")
+    gemini_agent.searchEntities("Gogle", "item")
+    assert search == ["Gogle", "Gogle"]
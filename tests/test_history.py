@@ -0,0 +1,130 @@
+import threading
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, get_buffer_string
+
+import history
+from history import SummarizingChatMessageHistory
+from render import count_tokens
+
+
+class _Inline:
+    def submit(self, fn, *args):
+        fn(*args)
+
+
+class _LLM:
+    def __init__(self, on_invoke=None):
+        self.prompts = []
+        self.on_invoke = on_invoke
+
+    def invoke(self, prompt):
+        self.prompts.append(prompt)
+        if self.on_invoke:
+            self.on_invoke()
+        return AIMessage(content=f"summary {len(self.prompts)}")
+
+
+@pytest.fixture(autouse=True)
+def inline_compaction(monkeypatch):
+    monkeypatch.setattr(history, "_executor", _Inline())
+
+
+def _turns(chat, count, start=0):
+    for n in range(start, start + count):
+        chat.add_messages([HumanMessage(content=f"question {n}"), AIMessage(content=f"answer {n}")])
+
+
+def test_recent_turns_are_kept_verbatim():
+    chat = SummarizingChatMessageHistory(llm=_LLM(), keep_turns=3)
+    _turns(chat, 3)
+    assert [m.content for m in chat.messages][::2] == ["question 0", "question 1", "question 2"]
+    assert chat.summary == ""
+
+
+def test_older_turns_are_summarized_as_a_human_and_ai_turn():
+    llm = _LLM()
+    chat = SummarizingChatMessageHistory(llm=llm, keep_turns=2)
+    _turns(chat, 4)
+    messages = chat.messages
+    assert not any(isinstance(m, SystemMessage) for m in messages)
+    assert isinstance(messages[0], HumanMessage)
+    assert messages[0].content.endswith(chat.summary)
+    assert isinstance(messages[1], AIMessage)
+    assert [m.content for m in messages[2:]] == ["question 2", "answer 2", "question 3", "answer 3"]
+    # Each turn is sent to the summarizer once
+    assert "question 0" in llm.prompts[0]
+    assert "question 0" not in llm.prompts[1]
+    assert "question 1" in llm.prompts[1]
+    assert chat.summary == "summary 2"
+
+
+def test_older_turns_are_dropped_without_llm():
+    chat = SummarizingChatMessageHistory(keep_turns=1)
+    _turns(chat, 3)
+    assert [m.content for m in chat.messages] == ["question 2", "answer 2"]
+
+
+def test_fewer_turns_are_kept_over_the_token_budget():
+    chat = SummarizingChatMessageHistory(llm=_LLM(), keep_turns=3, max_tokens=30)
+    chat.add_messages([HumanMessage(content="question 0"), AIMessage(content="answer " * 40)])
+    _turns(chat, 2, start=1)
+    assert chat.summary == "summary 1"
+    assert [m.content for m in chat.messages[2:]] == [
+        "question 1",
+        "answer 1",
+        "question 2",
+        "answer 2",
+    ]
+
+
+def test_readers_are_not_blocked_by_the_summarizer():
+    read = []
+
+    def on_invoke():
+        reader = threading.Thread(target=lambda: read.append(chat.messages))
+        reader.start()
+        reader.join(2)
+
+    chat = SummarizingChatMessageHistory(llm=_LLM(on_invoke), keep_turns=1)
+    _turns(chat, 2)
+    assert read and read[0][0].content == "question 0"
+
+
+def test_summary_of_cleared_messages_is_dropped():
+    chat = SummarizingChatMessageHistory(llm=_LLM(lambda: chat.clear()), keep_turns=1)
+    _turns(chat, 2)
+    assert chat.summary == ""
+    assert chat.messages == []
+
+
+class _VerboseLLM:
+    """Writes a summary far over the budget, and a short one when asked to shorten it."""
+
+    def __init__(self, shortens=True):
+        self.shortens = shortens
+        self.prompts = []
+
+    def invoke(self, prompt):
+        self.prompts.append(prompt)
+        if self.shortens and prompt.startswith("Shorten"):
+            return AIMessage(content="Short summary.")
+        return AIMessage(content=" ".join(f"fact{n}" for n in range(2000)))
+
+
+def test_long_summary_is_shortened():
+    llm = _VerboseLLM()
+    chat = SummarizingChatMessageHistory(llm=llm, keep_turns=1, max_tokens=200)
+    _turns(chat, 2)
+    assert chat.summary == "Short summary."
+    assert "at most 75 words" in llm.prompts[-1]
+
+
+def test_summary_is_cut_when_shortening_is_not_enough():
+    llm = _VerboseLLM(shortens=False)
+    chat = SummarizingChatMessageHistory(llm=llm, keep_turns=1, max_tokens=200)
+    for n in range(5):
+        _turns(chat, 1, start=n)
+        assert count_tokens(chat.summary) <= 100
+        assert count_tokens(get_buffer_string(chat.messages)) <= 200
+    assert chat.summary.endswith("fact1999")
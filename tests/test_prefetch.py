@@ -0,0 +1,59 @@
+import threading
+import time
+
+from langchain_core.runnables import RunnableLambda
+
+from prefetch import Prefetcher, current_session
+
+
+def _wait(prefetcher):
+    deadline = time.monotonic() + 5
+    while prefetcher.pending and time.monotonic() < deadline:
+        time.sleep(0.001)
+
+
+def test_prefetch_within_the_budget_of_the_session():
+    fetched = []
+    prefetcher = Prefetcher(fetched.append, budget=2, max_pending=10)
+    assert not prefetcher.submit("Q1", session_id="chat")
+    prefetcher.reset("chat")
+    assert [prefetcher.submit(key, session_id="chat") for key in ("Q1", "Q2", "Q3")] == [
+        True,
+        True,
+        False,
+    ]
+    _wait(prefetcher)
+    assert sorted(fetched) == ["Q1", "Q2"]
+    # A new question gives the budget back, recent keys are still skipped
+    prefetcher.reset("chat")
+    assert not prefetcher.submit("Q1", session_id="chat")
+    assert prefetcher.submit("Q3", session_id="chat")
+    _wait(prefetcher)
+    assert prefetcher.stats() == {"submitted": 3, "skipped": 3, "failed": 0, "pending": 0}
+
+
+def test_prefetch_skips_keys_while_the_workers_are_busy():
+    release = threading.Event()
+    prefetcher = Prefetcher(lambda key: release.wait(5), workers=1, max_pending=1)
+    prefetcher.reset("chat")
+    assert prefetcher.submit("Q1", session_id="chat")
+    assert not prefetcher.submit("Q2", session_id="chat")
+    release.set()
+    _wait(prefetcher)
+
+
+def test_prefetch_failures_are_counted():
+    def fetch(key):
+        raise LookupError(key)
+
+    prefetcher = Prefetcher(fetch)
+    prefetcher.reset("chat")
+    prefetcher.submit("Q1", session_id="chat")
+    _wait(prefetcher)
+    assert prefetcher.stats()["failed"] == 1
+
+
+def test_current_session_from_the_run_config():
+    assert current_session() is None
+    session = RunnableLambda(lambda _: current_session())
+    assert session.invoke(None, {"configurable": {"session_id": "chat"}}) == "chat"
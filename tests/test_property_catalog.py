@@ -0,0 +1,113 @@
+import time
+
+import pytest
+
+import transport
+from property_catalog import RETRY_DELAY, PropertyCatalog, api_datatype
+
+ONTOLOGY = "http://wikiba.se/ontology#"
+ENTITY = "http://www.wikidata.org/entity/"
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        ("WikibaseItem", "wikibase-item"),
+        ("ExternalId", "external-id"),
+        ("GlobeCoordinate", "globe-coordinate"),
+        ("Monolingualtext", "monolingualtext"),
+        ("Time", "time"),
+        ("Url", "url"),
+        ("CommonsMedia", "commonsMedia"),
+    ],
+)
+def test_api_datatype(name, expected):
+    assert api_datatype(name) == expected
+
+
+class _Session:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def get(self, url, **kwargs):
+        return self
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {"results": {"bindings": self.rows}}
+
+
+def _row(pid, datatype, label, alias=None):
+    row = {
+        "property": {"value": ENTITY + pid},
+        "type": {"value": ONTOLOGY + datatype},
+        "label": {"value": label},
+    }
+    if alias:
+        row["alias"] = {"value": alias}
+    return row
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    rows = [
+        _row("P112", "WikibaseItem", "founded by", "founder"),
+        _row("P112", "WikibaseItem", "founded by", "co-founder"),
+        _row("P571", "Time", "inception", "founder"),
+        _row("P2002", "ExternalId", "X username"),
+    ]
+    monkeypatch.setattr(transport, "get_session", lambda: _Session(rows))
+    catalog = PropertyCatalog("https://query.example.org/sparql", None)
+    catalog.load()
+    return catalog
+
+
+def test_catalog_stores_the_api_datatypes(catalog):
+    assert catalog.datatype("P112") == "wikibase-item"
+    assert catalog.datatype("P2002") == "external-id"
+    assert len(catalog) == 3
+
+
+def test_catalog_lookup(catalog):
+    assert catalog.lookup("Founded By") == "P112"
+    assert catalog.lookup("co-founder") == "P112"
+    assert catalog.lookup("founder") == "P112"
+    assert catalog.lookup("p571") == "P571"
+    assert catalog.lookup("X usernames") == "P2002"
+    assert catalog.lookup("population") is None
+
+
+class _Stop(BaseException):
+    """Ends the refresh loop, which goes on after an ``Exception``."""
+
+
+def _loads(monkeypatch, catalog, failures):
+    """Make ``load`` fail or succeed in turn, returns the delays slept in between."""
+    sleeps = []
+
+    def load():
+        if not failures:
+            raise _Stop()
+        if failures.pop(0):
+            raise OSError("endpoint down")
+
+    monkeypatch.setattr(catalog, "load", load)
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    return sleeps
+
+
+def test_refresh_interval_0_loads_once(monkeypatch):
+    catalog = PropertyCatalog(None, None, refresh_interval=0)
+    sleeps = _loads(monkeypatch, catalog, [True, True, False])
+    catalog._refresh()
+    assert sleeps == [RETRY_DELAY, RETRY_DELAY]
+
+
+def test_refresh_waits_between_loads(monkeypatch):
+    catalog = PropertyCatalog(None, None, refresh_interval=10)
+    sleeps = _loads(monkeypatch, catalog, [True, False, False])
+    with pytest.raises(_Stop):
+        catalog._refresh()
+    assert sleeps == [10, 10, 10]
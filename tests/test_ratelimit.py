@@ -0,0 +1,127 @@
+import time
+from email.utils import formatdate
+
+import pytest
+
+import transport
+from ratelimit import AdaptiveLimiter, TokenBucket, backoff, retry_after
+
+
+def test_token_bucket_allows_bursts_up_to_capacity():
+    bucket = TokenBucket(rate=1, capacity=3)
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+
+
+def test_token_bucket_waits_for_tokens():
+    bucket = TokenBucket(rate=50, capacity=1)
+    assert bucket.acquire()
+    started = time.monotonic()
+    assert bucket.acquire()
+    assert time.monotonic() - started >= 0.015
+
+
+def test_token_bucket_acquire_times_out():
+    bucket = TokenBucket(rate=1, capacity=1)
+    bucket.acquire()
+    assert not bucket.acquire(timeout=0.01)
+
+
+def test_token_bucket_rejects_zero_rate():
+    with pytest.raises(ValueError):
+        TokenBucket(rate=0)
+
+
+def test_adaptive_limiter_decreases_and_increases():
+    limiter = AdaptiveLimiter(max_rate=10, increase=1)
+    limiter.throttle()
+    assert limiter.rate == 5
+    limiter.success()
+    assert limiter.rate == 6
+    for _ in range(10):
+        limiter.success()
+    assert limiter.rate == 10
+    for _ in range(10):
+        limiter.throttle()
+    assert limiter.rate == limiter.min_rate == 0.5
+    assert limiter.stats()["throttled"] == 11
+
+
+def test_adaptive_limiter_waits_for_retry_after():
+    limiter = AdaptiveLimiter(max_rate=100, decrease=1)
+    limiter.throttle(0.05)
+    assert not limiter.try_acquire()
+    started = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - started >= 0.04
+
+
+@pytest.mark.parametrize(
+    "headers, expected",
+    [
+        ({}, None),
+        ({"Retry-After": "5"}, 5),
+        ({"Retry-After": "-3"}, 0),
+        ({"Retry-After": "soon"}, None),
+    ],
+)
+def test_retry_after(headers, expected):
+    assert retry_after(headers) == expected
+
+
+def test_retry_after_date():
+    assert 25 < retry_after({"Retry-After": formatdate(time.time() + 30, usegmt=True)}) <= 30
+
+
+def test_backoff_is_capped():
+    for attempt in range(10):
+        assert 0 <= backoff(attempt, base=1, cap=8) <= min(8, 2**attempt)
+
+
+class _Response:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def no_limiters(monkeypatch):
+    monkeypatch.setattr(transport, "_limiters", {})
+    monkeypatch.delenv("HTTP_RATE_LIMIT", raising=False)
+    monkeypatch.delenv("HTTP_RATE_LIMITS", raising=False)
+
+
+def test_hosts_are_unlimited_by_default(no_limiters, monkeypatch):
+    assert transport.get_limiter("query.wikidata.org") is None
+    monkeypatch.setenv("HTTP_RATE_LIMITS", "www.wikidata.org=5")
+    assert transport.get_limiter("www.wikidata.org").max_rate == 5
+
+
+def test_limited_retries_throttled_responses(no_limiters, monkeypatch):
+    monkeypatch.setenv("HTTP_MAX_RETRIES", "4")
+    responses = iter(
+        [_Response(429, {"Retry-After": "0"}), _Response(503, {"Retry-After": "0"}), _Response(200)]
+    )
+    assert transport.limited("query.wikidata.org", lambda: next(responses)).status_code == 200
+
+
+def test_limited_gives_up_after_max_retries(no_limiters, monkeypatch):
+    monkeypatch.setenv("HTTP_MAX_RETRIES", "1")
+    sent = []
+
+    def send():
+        sent.append(1)
+        return _Response(429, {"Retry-After": "0"})
+
+    assert transport.limited("query.wikidata.org", send).status_code == 429
+    assert len(sent) == 2
+
+
+def test_limited_does_not_wait_over_backoff_max(no_limiters, monkeypatch):
+    monkeypatch.setenv("HTTP_BACKOFF_MAX", "30")
+    monkeypatch.setenv("HTTP_RATE_LIMITS", "query.wikidata.org=10")
+    throttled = _Response(429, {"Retry-After": "3600"})
+    assert transport.limited("query.wikidata.org", lambda: throttled) is throttled
+    assert transport.get_limiter("query.wikidata.org").throttled == 1
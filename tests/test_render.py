@@ -0,0 +1,37 @@
+from render import Renderer, wikibase_prefixes
+
+renderer = Renderer(wikibase_prefixes("http://www.wikidata.org"))
+
+
+def test_document_keeps_values_containing_commas():
+    text = "\n".join(
+        [
+            "Description: New York, New York",
+            "coordinate location: 10.5, 10.5",
+            "located in: Mountain View, California, Mountain View, Texas",
+        ]
+    )
+    assert renderer.document(text) == text
+
+
+def test_document_shortens_uris_and_drops_empty_lines():
+    text = "Label: Google\n\nsame as: http://www.wikidata.org/entity/Q95\n"
+    assert renderer.document(text) == "Label: Google\nsame as: wd:Q95"
+
+
+def test_sparql_results_as_a_table():
+    results = {
+        "head": {"vars": ["item", "country"]},
+        "results": {
+            "bindings": [
+                {
+                    "item": {"type": "uri", "value": f"http://www.wikidata.org/entity/Q{n}"},
+                    "country": {"type": "literal", "value": "United States"},
+                }
+                for n in (95, 95, 312)
+            ]
+        },
+    }
+    assert renderer.sparql_results(results) == "\n".join(
+        ["country = United States (in every row)", "item", "wd:Q95", "wd:Q312", "(2 rows)"]
+    )
@@ -0,0 +1,160 @@
+import json
+
+import pytest
+
+from cache import MISSING
+from render import wikibase_prefixes
+from sparql import (
+    SparqlCache,
+    SparqlSyntaxError,
+    clean_query,
+    normalize_query,
+    parse_results,
+    prepare_query,
+)
+
+PREFIXES = wikibase_prefixes("http://www.wikidata.org")
+
+
+def test_prepare_query_declares_used_prefixes():
+    query = prepare_query("SELECT ?x WHERE { ?x wdt:P31 wd:Q5 }", PREFIXES)
+    assert query.startswith(
+        "PREFIX wdt: <http://www.wikidata.org/prop/direct/>\n"
+        "PREFIX wd: <http://www.wikidata.org/entity/>\n"
+    )
+
+
+@pytest.mark.parametrize("prefix", ["psv", "pr", "pqv", "wdno", "hint", "bds", "geof", "mwapi"])
+def test_prepare_query_accepts_predefined_prefixes(prefix):
+    query = prepare_query(f"SELECT ?x WHERE {{ ?x {prefix}:name ?y }}", PREFIXES)
+    assert f"PREFIX {prefix}: <" in query
+
+
+def test_prepare_query_keeps_declared_prefixes():
+    query = "PREFIX foo: <http://example.org/>\nSELECT ?x WHERE { ?x foo:bar ?y }"
+    assert prepare_query(query) == query
+
+
+def test_prepare_query_ignores_prefixes_in_literals():
+    query = "SELECT ?x WHERE { ?x ?p 'foo:bar' }"
+    assert prepare_query(query) == query
+
+
+@pytest.mark.parametrize(
+    "query, message",
+    [
+        ("SELECT ?x WHERE { ?x foo:bar ?y }", "Undefined prefix 'foo:' at line 1, column 22"),
+        ("SELECT ?x WHERE { ?x ?p ?y ", "Missing '}' for the '{' opened at line 1, column 17"),
+        ("SELECT ?x WHERE { ?x ?p ?y )", r"Unexpected '\)' at line 1, column 28"),
+        ("SELECT ?x WHERE { ?x ?p 'abc }", "Unterminated string literal"),
+        ("FIND ?x WHERE { }", "must start with SELECT"),
+        ("  ", "empty"),
+    ],
+)
+def test_prepare_query_rejects_invalid_queries(query, message):
+    with pytest.raises(SparqlSyntaxError, match=message):
+        prepare_query(query)
+
+
+def test_prepare_query_adds_missing_limit():
+    query = prepare_query("SELECT ?x WHERE { ?x ?p ?o }", limit=10)
+    assert query == "SELECT ?x WHERE { ?x ?p ?o }\nLIMIT 10"
+
+
+def test_prepare_query_lowers_larger_limit():
+    assert prepare_query("SELECT ?x WHERE { ?x ?p ?o } LIMIT 500", limit=100).endswith("LIMIT 100")
+    assert prepare_query("SELECT ?x WHERE { ?x ?p ?o } LIMIT 5", limit=100).endswith("LIMIT 5")
+
+
+def test_prepare_query_limits_the_outer_query_before_values():
+    query = prepare_query(
+        "SELECT ?x WHERE { { SELECT ?x WHERE { ?x ?p ?o } LIMIT 5 } } VALUES ?x { 1 }", limit=100
+    )
+    assert query == (
+        "SELECT ?x WHERE { { SELECT ?x WHERE { ?x ?p ?o } LIMIT 5 } }\nLIMIT 100\nVALUES ?x { 1 }"
+    )
+
+
+def test_prepare_query_does_not_limit_ask():
+    assert prepare_query("ASK { ?x ?p ?o }", limit=10) == "ASK { ?x ?p ?o }"
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "```sparql\nSELECT ?x WHERE { }\n```",
+        "```\nSELECT ?x WHERE { }\n```",
+        "`SELECT ?x WHERE { }`",
+        "\"SELECT ?x WHERE { }\"",
+        "sparql SELECT ?x WHERE { }",
+    ],
+)
+def test_clean_query(text):
+    assert clean_query(text) == "SELECT ?x WHERE { }"
+
+
+def test_normalize_query():
+    query = 'SELECT  ?x # the items\n WHERE { ?x ?p "a  b" }\nlimit   5'
+    assert normalize_query(query) == 'SELECT ?x WHERE { ?x ?p "a  b" } LIMIT 5'
+
+
+def _result(rows):
+    bindings = [{"x": {"type": "literal", "value": str(i)}} for i in range(rows)]
+    return {"head": {"vars": ["x"]}, "results": {"bindings": bindings}}
+
+
+def _chunks(data, size=7):
+    data = json.dumps(data).encode()
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def test_parse_results_reads_bindings_split_across_chunks():
+    assert parse_results(_chunks(_result(5))) == _result(5)
+
+
+def test_parse_results_stops_at_max_rows():
+    results = parse_results(_chunks(_result(5)), max_rows=2)
+    assert results["results"]["bindings"] == _result(2)["results"]["bindings"]
+    assert results["truncated"]["reason"] == "rows"
+    assert results["truncated"]["rows"] == 2
+
+
+def test_parse_results_stops_at_max_bytes():
+    chunks = _chunks(_result(50))
+    results = parse_results(iter(chunks), max_bytes=200)
+    assert results["truncated"]["reason"] == "bytes"
+    assert results["truncated"]["bytes"] < 210
+    assert len(results["results"]["bindings"]) < 50
+
+
+def test_parse_results_without_bindings():
+    assert parse_results([b'{"head": {}, ', b'"boolean": true}']) == {"head": {}, "boolean": True}
+
+
+def test_parse_results_rejects_incomplete_results():
+    with pytest.raises(ValueError, match="Incomplete"):
+        parse_results(_chunks(_result(5))[:-3])
+
+
+def test_sparql_cache_matches_normalized_queries():
+    cache = SparqlCache()
+    cache.set("https://query.example.org", "SELECT ?x\nWHERE { ?x ?p ?o }", _result(1))
+    assert cache.get("https://query.example.org", "SELECT ?x WHERE {  ?x ?p ?o }") == _result(1)
+    assert cache.get("https://other.example.org", "SELECT ?x WHERE { ?x ?p ?o }") is MISSING
+
+
+def test_sparql_cache_keeps_kinds_apart():
+    cache = SparqlCache()
+    query = "SELECT ?x WHERE { ?x ?p ?o }"
+    cache.set("https://query.example.org", query, {"truncated": True})
+    cache.set("https://query.example.org", query, "raw json", kind="raw")
+    assert cache.get("https://query.example.org", query) == {"truncated": True}
+    assert cache.get("https://query.example.org", query, kind="raw") == "raw json"
+
+
+def test_sparql_cache_endpoint_ttls():
+    cache = SparqlCache(endpoint_ttls={"https://local.example.org": 0})
+    cache.set("https://local.example.org", "ASK { }", True)
+    cache.set("https://query.example.org", "ASK { }", True)
+    assert cache.get("https://local.example.org", "ASK { }") is MISSING
+    assert cache.get("https://query.example.org", "ASK { }") is True
@@ -0,0 +1,75 @@
+import json
+
+from langchain_core.runnables import RunnableLambda
+
+from render import count_tokens
+from statements import Statement, asking, current_question, load_importance, select
+
+STATEMENTS = [
+    Statement("P2002", "X username", ["google"], "external-id"),
+    Statement("P1128", "employees", [str(n) for n in range(1000, 1100)], "quantity"),
+    Statement("P112", "founded by", ["Larry Page", "Sergey Brin"], "wikibase-item"),
+    Statement("P571", "inception", ["1998-09-04"], "time"),
+    Statement("P31", "instance of", ["business"], "wikibase-item"),
+]
+
+
+def _tokens(lines):
+    return sum(count_tokens(line) for line in lines)
+
+
+def test_select_without_budget_keeps_everything_in_order():
+    assert select(STATEMENTS) == [statement.line() for statement in STATEMENTS]
+
+
+def test_select_ranks_essential_then_relevant_then_important():
+    lines = select(STATEMENTS, "Who founded it?", budget=10000)
+    assert [line.split(":")[0] for line in lines] == [
+        "instance of",
+        "founded by",
+        "inception",
+        "employees",
+        "X username",
+    ]
+
+
+def test_select_uses_the_importance_scores():
+    lines = select(STATEMENTS, budget=10000, importance={"P2002": 1.0})
+    assert lines[1] == "X username: google"
+
+
+def test_select_keeps_to_the_budget_and_counts_the_omitted_properties():
+    budget = _tokens([STATEMENTS[4].line(), STATEMENTS[2].line()])
+    lines = select(STATEMENTS, "Who founded it?", budget=budget)
+    assert lines[:2] == ["instance of: business", "founded by: Larry Page, Sergey Brin"]
+    assert lines[2].startswith("Not shown: 3 more properties with 102 values: ")
+    assert "employees (100)" in lines[2]
+    assert _tokens(lines[:2]) <= budget
+
+
+def test_select_cuts_long_statements_to_their_first_values():
+    budget = count_tokens(STATEMENTS[4].line()) + 60
+    lines = select(STATEMENTS, "How many employees?", budget=budget)
+    assert lines[1].startswith("employees: 1000, 1001, ")
+    assert lines[1].endswith(" more)")
+    assert _tokens(lines[:2]) <= budget
+
+
+def test_asking_sets_the_current_question():
+    assert current_question() is None
+    with asking("Who founded Google?"):
+        assert current_question() == "Who founded Google?"
+    assert current_question() is None
+
+
+def test_current_question_from_the_run_config():
+    ask = RunnableLambda(lambda _: current_question())
+    assert ask.invoke(None, {"configurable": {"question": "When?"}}) == "When?"
+
+
+def test_load_importance_scales_the_scores(tmp_path):
+    path = tmp_path / "importance.json"
+    path.write_text(json.dumps({"P31": 200, "P112": 50}))
+    assert load_importance(str(path)) == {"P31": 1.0, "P112": 0.25}
+    assert load_importance(str(tmp_path / "missing.json")) == {}
+    assert load_importance(None) == {}
@@ -0,0 +1,32 @@
+from langchain_mod.utilities import WikidataAPIWrapper
+
+
+def _claim(value, value_type="string"):
+    return {"mainsnak": {"snaktype": "value", "datavalue": {"type": value_type, "value": value}}}
+
+
+def test_entity_document_shows_repeated_values_once():
+    wrapper = WikidataAPIWrapper.construct(wikidata_props=[], statement_token_budget=0)
+    entity = {
+        "labels": {"en": {"value": "Google"}},
+        "claims": {
+            "P625": [_claim({"latitude": 10.5, "longitude": 10.5}, "globecoordinate")],
+            "P159": [
+                _claim({"id": "Q486860"}, "wikibase-entityid"),
+                _claim({"id": "Q486860"}, "wikibase-entityid"),
+                _claim({"id": "Q1"}, "wikibase-entityid"),
+            ],
+        },
+    }
+    labels = {
+        "P625": "coordinate location",
+        "P159": "headquarters location",
+        "Q486860": "Mountain View, California",
+        "Q1": "Mountain View, Texas",
+    }
+    document = wrapper._entity_to_document("Q95", entity, labels)
+    assert document.page_content.splitlines() == [
+        "Label: Google",
+        "coordinate location: 10.5, 10.5",
+        "headquarters location: Mountain View, California, Mountain View, Texas",
+    ]
@@ -0,0 +1,88 @@
+"""Tool calling agent that runs several tool calls of one turn concurrently.
+
+With ``AGENT_MODE=tools`` the agents use the native function calling of
+the chat model instead of the ReAct text format. The model can then ask
+for several independent lookups in a single turn, for example the Q items
+and properties needed by a SPARQL query, and ``ParallelAgentExecutor``
+runs them at the same time and hands all the observations back together.
+Models without function calling keep using the ReAct agent.
+"""
+
+import contextvars
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Iterator, List, Sequence
+
+from langchain.agents import AgentExecutor, create_tool_calling_agent
+from langchain_core.language_models import BaseChatModel
+from langchain_core.prompts.chat import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.tools import BaseTool
+
+AGENT_TOOL_WORKERS = int(os.getenv("AGENT_TOOL_WORKERS", 8))
+
+_executor = ThreadPoolExecutor(max_workers=AGENT_TOOL_WORKERS, thread_name_prefix="tool")
+
+
+def agent_mode() -> str:
+    """``react`` (default) or ``tools``, from ``AGENT_MODE``."""
+    return os.getenv("AGENT_MODE", "react").lower()
+
+
+def supports_tool_calling(llm: Any) -> bool:
+    """Whether ``llm`` is a chat model implementing ``bind_tools``."""
+    return isinstance(llm, BaseChatModel) and type(llm).bind_tools is not BaseChatModel.bind_tools
+
+
+def load_tools_prompt(path: str) -> ChatPromptTemplate:
+    with open(path, "r") as f:
+        system_prompt = f.read()
+    return ChatPromptTemplate.from_messages(
+        [
+            ("system", system_prompt),
+            MessagesPlaceholder("chat_history", optional=True),
+            ("human", "{input}"),
+            MessagesPlaceholder("agent_scratchpad"),
+        ]
+    )
+
+
+class _Pending:
+    __slots__ = ("future",)
+
+    def __init__(self, future: Future) -> None:
+        self.future = future
+
+
+class ParallelAgentExecutor(AgentExecutor):
+    """Agent executor running the tool calls of one turn concurrently.
+
+    ``AgentExecutor`` only does so in its async methods, this also covers
+    ``invoke``. The observations are returned in the order of the calls.
+    """
+
+    def _perform_agent_action(self, *args: Any, **kwargs: Any) -> Any:
+        # The context carries per question state, like the session of the call
+        context = contextvars.copy_context()
+        run = super()._perform_agent_action
+        return _Pending(_executor.submit(context.run, run, *args, **kwargs))
+
+    def _iter_next_step(self, *args: Any, **kwargs: Any) -> Iterator[Any]:
+        pending: List[_Pending] = []
+        for item in super()._iter_next_step(*args, **kwargs):
+            if isinstance(item, _Pending):
+                pending.append(item)
+            else:
+                yield item
+        for item in pending:
+            yield item.future.result()
+
+
+def build_tool_calling_executor(
+    llm: BaseChatModel, tools: Sequence[BaseTool], prompt: ChatPromptTemplate, **kwargs: Any
+) -> ParallelAgentExecutor:
+    return ParallelAgentExecutor(
+        agent=create_tool_calling_agent(llm, tools, prompt),
+        tools=tools,
+        max_iterations=10,
+        **kwargs,
+    )
@@ -0,0 +1,218 @@
+"""Pooled, keep-alive HTTP transport shared by the Wikibase tools.
+
+All tools go through the same ``requests.Session`` (MediaWiki API, SPARQL
+endpoint, wikibaseintegrator helpers) or the same ``httpx.Client`` per base
+URL (Wikibase REST API), so TCP and TLS connections are reused across calls
+instead of being opened for every request.
+
+A throttled response (429 or 503) is retried after its ``Retry-After``, or
+a jittered backoff. Hosts given a rate in ``HTTP_RATE_LIMITS`` also share
+one ``AdaptiveLimiter``, whatever the session or client their requests go
+through, which a throttled response slows down, so the callers queue for
+the endpoint instead of failing.
+"""
+
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from ratelimit import AdaptiveLimiter, backoff, retry_after
+
+_lock = threading.Lock()
+_session: Optional[requests.Session] = None
+_httpx_clients: Dict[str, object] = {}
+_limiters: Dict[str, Optional[AdaptiveLimiter]] = {}
+
+THROTTLED = (429, 503)
+
+
+def _timeouts():
+    return (
+        float(os.getenv("HTTP_CONNECT_TIMEOUT", 5)),
+        float(os.getenv("HTTP_READ_TIMEOUT", 60)),
+    )
+
+
+def _accept_encoding() -> str:
+    encodings = ["gzip", "deflate"]
+    try:
+        # urllib3 and httpx only decode brotli when it is installed
+        import brotli  # noqa: F401
+
+        encodings.append("br")
+    except ImportError:
+        pass
+    return ", ".join(encodings)
+
+
+def _rate_limits() -> Dict[str, float]:
+    """Parse ``HTTP_RATE_LIMITS``, ``host=requests per second`` pairs separated by commas."""
+    limits = {}
+    for item in os.getenv("HTTP_RATE_LIMITS", "").split(","):
+        host, sep, rate = item.strip().rpartition("=")
+        if sep and host:
+            limits[host.strip()] = float(rate)
+    return limits
+
+
+def get_limiter(host: str) -> Optional[AdaptiveLimiter]:
+    """Return the limiter of ``host``, None when its requests are not limited.
+
+    The rate of a host is at most ``HTTP_RATE_LIMITS`` for that host, or
+    ``HTTP_RATE_LIMIT`` requests per second, 0 (the default) leaves it
+    unlimited.
+    """
+    if host not in _limiters:
+        with _lock:
+            if host not in _limiters:
+                rate = _rate_limits().get(host, float(os.getenv("HTTP_RATE_LIMIT", 0)))
+                _limiters[host] = AdaptiveLimiter(rate) if rate > 0 else None
+    return _limiters[host]
+
+
+def limiter_stats() -> Dict[str, Dict[str, float]]:
+    return {host: limiter.stats() for host, limiter in list(_limiters.items()) if limiter is not None}
+
+
+def limited(host: str, send: Callable[[], Any]) -> Any:
+    """Send a request through the limiter of ``host``, retrying it while it is throttled.
+
+    The last throttled response is returned after ``HTTP_MAX_RETRIES``
+    retries, or right away when its Retry-After is over ``HTTP_BACKOFF_MAX``
+    seconds.
+    """
+    limiter = get_limiter(host)
+    max_retries = int(os.getenv("HTTP_MAX_RETRIES", 4))
+    backoff_max = float(os.getenv("HTTP_BACKOFF_MAX", 30))
+    attempt = 0
+    while True:
+        if limiter is not None:
+            started = time.perf_counter()
+            limiter.acquire()
+            metrics.HTTP_QUEUE_SECONDS.observe(time.perf_counter() - started, host=host)
+        response = send()
+        if response.status_code not in THROTTLED:
+            if limiter is not None:
+                limiter.success()
+            return response
+        delay = retry_after(response.headers)
+        wait = delay if delay is not None else backoff(attempt, cap=backoff_max)
+        metrics.log_event("http_throttled", host=host, status=response.status_code, retry_after=delay, attempt=attempt)
+        if attempt >= max_retries or wait > backoff_max:
+            if limiter is not None:
+                limiter.throttle(wait)
+            return response
+        response.close()
+        if limiter is not None:
+            # Every caller of the host waits, not only this one
+            limiter.throttle(wait)
+        else:
+            time.sleep(wait)
+        attempt += 1
+
+
+class TimeoutSession(requests.Session):
+    """Session that applies a default ``(connect, read)`` timeout and the host limiters."""
+
+    def __init__(self, timeout) -> None:
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        send = super().request
+        return limited(urlsplit(url).hostname or "", lambda: send(method, url, **kwargs))
+
+
+def get_session() -> requests.Session:
+    """Return the process wide pooled session, creating it on first use.
+
+    ``HTTP_POOL_CONNECTIONS`` is the number of hosts kept in the pool and
+    ``HTTP_POOL_MAXSIZE`` the number of keep-alive connections per host.
+    """
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                session = TimeoutSession(_timeouts())
+                adapter = HTTPAdapter(
+                    pool_connections=int(os.getenv("HTTP_POOL_CONNECTIONS", 10)),
+                    pool_maxsize=int(os.getenv("HTTP_POOL_MAXSIZE", 10)),
+                    pool_block=True,
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers["Accept-Encoding"] = _accept_encoding()
+                user_agent = os.getenv("WIKIBASE_USER_AGENT")
+                if user_agent:
+                    session.headers["User-Agent"] = user_agent
+                session.hooks["response"].append(metrics.record_response)
+                _session = session
+    return _session
+
+
+def get_httpx_client(base_url: str, headers: Optional[Dict[str, str]] = None):
+    """Return the shared ``httpx.Client`` for ``base_url``.
+
+    Used by the Wikibase REST API client, which is built on httpx.
+    """
+    client = _httpx_clients.get(base_url)
+    if client is None:
+        import httpx
+
+        class LimitedTransport(httpx.HTTPTransport):
+            """Transport that applies the host limiters, like ``TimeoutSession``."""
+
+            def handle_request(self, request):
+                send = super().handle_request
+                return limited(request.url.host, lambda: send(request))
+
+        with _lock:
+            client = _httpx_clients.get(base_url)
+            if client is None:
+                connect, read = _timeouts()
+                max_connections = int(os.getenv("HTTP_POOL_MAXSIZE", 10))
+                client = httpx.Client(
+                    base_url=base_url,
+                    headers={"Accept-Encoding": _accept_encoding(), **(headers or {})},
+                    timeout=httpx.Timeout(read, connect=connect),
+                    transport=LimitedTransport(
+                        limits=httpx.Limits(
+                            max_connections=max_connections,
+                            max_keepalive_connections=max_connections,
+                        )
+                    ),
+                    follow_redirects=True,
+                    event_hooks={
+                        "request": [metrics.record_httpx_request],
+                        "response": [metrics.record_httpx_response],
+                    },
+                )
+                _httpx_clients[base_url] = client
+    return client
+
+
+def install_wbi_session() -> None:
+    """Make the wikibaseintegrator helpers use the shared session."""
+    from wikibaseintegrator import wbi_helpers
+
+    wbi_helpers.helpers_session = get_session()
+
+
+def close() -> None:
+    """Close every pooled connection."""
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+        for client in _httpx_clients.values():
+            client.close()
+        _httpx_clients.clear()
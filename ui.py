@@ -1,29 +1,72 @@
+import time
+started = time.perf_counter()
+
 import gradio as gr
 import gemini_agent
 import gemini_simple
-from gemini_agent import agent_chat
-from gemini_simple import simple_chat
+import metrics
+from gemini_agent import agent_chat, agent_chat_stream
+from gemini_simple import session_chat
 
 import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Number of questions answered at the same time, the others wait in the queue
+UI_CONCURRENCY_LIMIT = int(os.getenv('UI_CONCURRENCY_LIMIT', 16))
+
+# Stream the agent steps and the final answer while they are generated
+UI_STREAMING = os.getenv('UI_STREAMING', 'true').lower() == 'true'
+
+# Build the agent and the LLM clients in the background once the UI is up,
+# otherwise they are built by the first question
+UI_WARMUP = os.getenv('UI_WARMUP', 'true').lower() == 'true'
+
+# Prometheus metrics are served on this port beside the UI, 0 disables them
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9464))
+
+# The agent and the Gemini client are blocking, they run on these threads
+executor = ThreadPoolExecutor(max_workers=UI_CONCURRENCY_LIMIT, thread_name_prefix='chat')
+
 checkbox = gr.Checkbox(label='Use Wikidata/Wikibase Knowledge Graph.')
 
-def result(question, history, checkbox):
+async def result(question, history, checkbox, request: gr.Request):
+    session_id = request.session_hash
+    loop = asyncio.get_running_loop()
     if checkbox:
-      r = agent_chat(
+      # Built here by the first question when the warm-up has not finished yet
+      agent_with_chat_history = await loop.run_in_executor(
+              executor, gemini_agent.get_agent_with_chat_history
+              )
+    if checkbox and UI_STREAMING:
+      async for partial in agent_chat_stream(
               question,
-              gemini_agent.agent_with_chat_history
+              agent_with_chat_history,
+              session_id
+              ):
+        yield partial
+      return
+    if checkbox:
+      r = await loop.run_in_executor(
+              executor,
+              agent_chat,
+              question,
+              agent_with_chat_history,
+              session_id
               )
       answer = r['output']
     else:
-      answer = simple_chat(
+      answer = await loop.run_in_executor(
+              executor,
+              session_chat,
               question,
-              gemini_simple.chat_session
+              session_id
               )
-    return answer
+    yield answer
 
 chat = gr.ChatInterface(
     result, 
@@ -43,5 +86,16 @@ chat = gr.ChatInterface(
     additional_inputs=[checkbox]
     )
 
+def warmup():
+    gemini_agent.warmup()
+    gemini_simple.get_model()
+    print(f"Warm-up done in {time.perf_counter() - started:.2f}s: {gemini_agent.startup_report()}")
+
 if __name__ == "__main__":
+    print(f"UI imported in {time.perf_counter() - started:.2f}s: {gemini_agent.startup_report()}")
+    if UI_WARMUP:
+      threading.Thread(target=warmup, daemon=True, name='warmup').start()
+    if METRICS_PORT:
+      metrics.start_server(METRICS_PORT)
+    chat.queue(default_concurrency_limit=UI_CONCURRENCY_LIMIT)
     chat.launch(server_name=str(os.getenv('UI_SERVER_NAME')),server_port=int(os.getenv('UI_SERVER_PORT')))
@@ -7,7 +7,7 @@ from datetime import datetime
 
 from langchain.agents import AgentExecutor, create_react_agent, create_openai_tools_agent
 
-from langchain_openai import OpenAI
+from langchain_openai import ChatOpenAI, OpenAI
 
 from langchain.agents import tool
 from langchain.prompts import PromptTemplate
@@ -22,14 +22,23 @@ from google.generativeai.types.safety_types import HarmBlockThreshold, HarmCateg
 from wikibaseintegrator import wbi_helpers
 from wikibaseintegrator.wbi_config import config as wbi_config
 
+import transport
+import metrics
+import tool_agent
+from langchain_mod.utilities import use_shared_transport
+from render import wikibase_prefixes
+from sparql import SparqlSyntaxError, prepare_query
+
 
 WB_LANGUAGE = 'en'
 #WB_LANGUAGE = 'pt-br'
 WB_LIMIT = 200
 WB_USER_AGENT = 'MyWikibaseBot/1.0'
+WB_SPARQL_URL = "https://query.wikidata.org/sparql"
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 
 wbi_config['USER_AGENT'] = 'MyWikibaseBot/1.0'
+transport.install_wbi_session()
 
 def extract_error_message(response):
   pattern = re.compile(r'MalformedQueryException:(.*)\n')
@@ -39,24 +48,26 @@ def extract_error_message(response):
   else:
     return None
 
+SPARQL_BUSY_MESSAGE = 'The SPARQL endpoint is busy and did not run the query, the query does not need to be changed, run it again.'
+
 def performSparqlQuery(query: str) -> str:
-  url = "https://query.wikidata.org/sparql"
+  url = WB_SPARQL_URL
   user_agent_header = WB_USER_AGENT
 
-  query = str(query).lstrip('sparql').strip('\n').strip("'").strip('"').strip('`')
+  query = prepare_query(query, prefixes=wikibase_prefixes('http://www.wikidata.org'))
 
   headers = {"Accept": "application/json"}
   if user_agent_header is not None:
       headers["User-Agent"] = user_agent_header
 
-  return requests.get(
+  return transport.get_session().get(
       url, headers=headers, params={"query": query, "format": "json"}
   )
 
 @tool
 def WikidataRetrieval(item: str) -> str:
   """Returns all the information about the input name, label, Q item or property from Wikidata."""
-  wikidata = WikidataQueryRun(api_wrapper=WikidataAPIWrapper())
+  wikidata = WikidataQueryRun(api_wrapper=use_shared_transport(WikidataAPIWrapper()))
   info = wikidata.run(item)
   return str(info)
 
@@ -64,8 +75,15 @@ def WikidataRetrieval(item: str) -> str:
 def runSparql(query: str) -> str:
   """Given a SPARQL query returns the results."""
 
-  response = performSparqlQuery(str(query))
-
+  try:
+    response = performSparqlQuery(str(query))
+  except SparqlSyntaxError as e:
+    return f'Query failed with this syntax error: {e}, try to fix it with another one.'
+
+  if response.status_code in transport.THROTTLED:
+      # The transport gave up retrying it, release its connection
+      response.close()
+      return SPARQL_BUSY_MESSAGE
   if response.status_code != 200:
       error_message = extract_error_message(response)
       if error_message:
@@ -113,14 +131,30 @@ def getProperty(name: str) -> str:
   else:
     return 'Property not found by this name, try another name.'
 
+@tool
+def WikibaseLabels(qids: str) -> str:
+  """Given a list of QIDs like Q548, Q507, Q502 returns the label, description and instance of of all of them at once from Wikidata."""
+  from langchain_mod.utilities import describe_entities
+
+  ids = list(dict.fromkeys(re.findall(r'\b[QP]\d+\b', str(qids))))[:50]
+  if not ids:
+    return 'No QIDs found in the input, pass a list like Q548, Q507, Q502.'
+  return describe_entities(ids, lang=WB_LANGUAGE, api_url=wbi_config['MEDIAWIKI_API_URL'])
+
 @tool
 def runSparqlQuery(query: str) -> str:
   """Given a SPARQL query returns the results."""
   try:
-    results = wbi_helpers.execute_sparql_query(query, max_retries=1)
+    # The transport already waits for and retries throttled requests
+    results = wbi_helpers.execute_sparql_query(query, max_retries=1, retry_after=0)
     return results
-  except Exception as e:
+  except requests.HTTPError as e:
+    error_message = extract_error_message(e.response)
+    if error_message:
+      return f'Query is not working: {error_message}, try another one.'
     return 'Query is not working, try another one.'
+  except Exception as e:
+    return SPARQL_BUSY_MESSAGE
 
 def load_prompt_file(full_path):
   with open(full_path, 'r') as f:
@@ -129,9 +163,19 @@ def load_prompt_file(full_path):
   return prompt
 
 
-def answer_the_question(question):
+def load_llm(chat=False):
+  """Returns the first LLM available: OpenAI, Gemini or a local Ollama model.
 
-  if 'OPENAI_API_KEY' in os.environ:
+  With chat=True OpenAI is used through its chat model, which supports function calling.
+  """
+
+  if 'OPENAI_API_KEY' in os.environ and chat:
+      llm = ChatOpenAI(
+            temperature=0,
+            top_p=0,
+            max_tokens=1024,
+            model_kwargs={"seed": 42})
+  elif 'OPENAI_API_KEY' in os.environ:
       llm = OpenAI(
             temperature=0,
             top_p=0,
@@ -154,9 +198,33 @@ def answer_the_question(question):
               model="mixtral:latest",
               temperature=0,
               top_p=0)
+  return llm
+
+
+def build_agent_executor(llm=None):
+  """Returns an agent executor, on load_llm() unless an llm is given.
+
+  With AGENT_MODE=tools the agent calls several tools per turn when the
+  model supports function calling (OpenAI and Gemini), the Ollama model
+  falls back to the ReAct agent.
+  """
 
+  tools_mode = tool_agent.agent_mode() == 'tools'
+  if llm is None:
+    llm = load_llm(chat=tools_mode)
+
+  tools = [getQItem, getProperty, runSparql, WikidataRetrieval, WikibaseLabels]
+
+  if tools_mode and tool_agent.supports_tool_calling(llm):
+    return tool_agent.build_tool_calling_executor(
+        llm,
+        tools,
+        tool_agent.load_tools_prompt('prompts/gemini_tools.prompt'),
+        verbose=True,
+        handle_parsing_errors=True,
+        return_intermediate_steps=False,
+        )
 
-  tools = [getQItem, getProperty, runSparql, WikidataRetrieval]
   prompt = load_prompt_file('prompts/gemini.prompt')
 
   agent = create_react_agent(llm, tools, prompt)
@@ -170,8 +238,19 @@ def answer_the_question(question):
           return_intermediate_steps=False,
           max_iteration=10
           )
+  return agent_executor
+
+
+def answer_the_question(question, agent_executor=None, config=None):
+
+  if agent_executor is None:
+    agent_executor = build_agent_executor()
 
   set_debug(False)
 
-  result = agent_executor.invoke({"input": f"{question}"})
-  return result
\ No newline at end of file
+  config = dict(config or {})
+  config["callbacks"] = [*config.get("callbacks", []), metrics.callback]
+  # The question selects the statements shown in the item documents, see statements.py
+  config["configurable"] = {"question": question, **config.get("configurable", {})}
+  result = agent_executor.invoke({"input": f"{question}"}, config=config)
+  return result